@@ -3,7 +3,7 @@
 # * This script runs FreeSurfer
 
 # * Input arguments
-while getopts "s:a:c:i:r:l:n:" OPTION
+while getopts "s:a:c:i:r:l:n:e:" OPTION
 do
     case $OPTION in
         s)
@@ -27,6 +27,9 @@ do
         n)
             N4=${OPTARG}
             ;;
+        e)
+            INCREMENTAL=${OPTARG}
+            ;;
         ?)
         exit
         ;;
@@ -35,6 +38,12 @@ done
 
 
 
+# * Defaults
+# Incremental processing is off unless requested
+INCREMENTAL=${INCREMENTAL:-0}
+
+
+
 # * Logging
 cat <<EOF
 ##############################################################
@@ -47,9 +56,12 @@ cat <<EOF
 EOF
 
 # * Environment
-iDIR=/data/in/sub-${SID}
+# Input data may have been prefetched to scratch (see CVET.py)
+iDIR=${CVET_INPUT_DIR:-/data/in}/sub-${SID}
 oDIR=/data/out/01_FreeSurfer
 mkdir -p ${oDIR}
+source $(dirname $0)/cleanup.sh
+source $(dirname $0)/assets.sh
 
 
 # * Already Processed Data
@@ -69,6 +81,8 @@ EOF
     echo "Copy Processed FreeSurfer data inside the container"
 
     # ** Grab subject folders
+    # (always from the mounted folder: this copies the complete
+    # FreeSurfer subjects, the prefetch only has the files 02-04 read)
     subFolders=(
         $(find /freesurfer \
                -maxdepth 1 \
@@ -161,6 +175,14 @@ EOF
                                -e "s#.nii##g"
                   )
 
+            # **** Incremental processing
+            # Skip T1 images that were already corrected in a
+            # previous run.
+            if [ ${INCREMENTAL} -eq 1 ] && [ -f ${n4oDIR}/sub-${SID}_${SES}_N4_${naming}.nii.gz ]; then
+                echo "N4 corrected image for ${T1img} already exists. Skip."
+                continue
+            fi
+
             # **** Create coarse brain mask
             # We only need a simple brain mask, because
             # it is only for directing the esgtimation
@@ -168,13 +190,13 @@ EOF
             # very precise.
             # Calculate affine registration from MNI to subject
             flirt \
-                -in /software/FSL-templates/MNI152_T1_1mm.nii.gz \
+                -in $(asset /software/FSL-templates/MNI152_T1_1mm.nii.gz) \
                 -ref ${iDIR}/${SES}/anat/${T1img} \
                 -omat ${n4oDIR}/affine_${naming}.mat \
                 -v
             # Apply regsitration to MNI brain mask
             flirt \
-                -in /software/FSL-templates/MNI152_T1_1mm_brain_mask.nii.gz \
+                -in $(asset /software/FSL-templates/MNI152_T1_1mm_brain_mask.nii.gz) \
                 -ref ${iDIR}/${SES}/anat/${T1img} \
                 -applyxfm -init ${n4oDIR}/affine_${naming}.mat \
                 -interp nearestneighbour \
@@ -194,6 +216,23 @@ EOF
                 -c 100x75x50 \
                 --verbose 1
 
+            # **** Quality control image of the bias field correction
+            # 03_Segment.sh does not correct these images again, so the
+            # effect of the correction is shown here. Like all
+            # intermediate files, it is only created if they are kept.
+            if [ ${INTERMEDIATE} -eq 1 ]; then
+                python3 $(dirname $0)/n4Effect.py \
+                        ${iDIR}/${SES}/anat/${T1img} \
+                        ${n4oDIR}/sub-${SID}_${SES}_N4_${naming}.nii.gz \
+                        ${n4oDIR}/N4_effect_${naming}.nii.gz
+            fi
+
+            # **** Release files that were only needed for N4
+            release \
+                ${n4oDIR}/affine_${naming}.mat \
+                ${n4oDIR}/mask_${naming}.nii.gz \
+                ${n4oDIR}/BF_${naming}.nii.gz
+
         done
 
     done
@@ -284,12 +323,28 @@ for SES in ${SESLIST[@]}; do
     # ** Announce
     echo "Working on ${SID}: ${SES} [FreeSurfer CrossSectional Processing]"
 
+    # ** Incremental processing
+    # Sessions that were completed in a previous run are not
+    # imported and processed again.
+    if [ ${INCREMENTAL} -eq 1 ] && [ -f ${oDIR}/sub-${SID}_ses-${SES}/scripts/recon-all.done ]; then
+        echo "Cross sectional processing of session ${SES} already finished. Skip."
+        continue
+    fi
+
     # ** Pick up input
     input="$(echo input_${SES})"
     
     # ** Prepare Freesurfer
     export SUBJECTS_DIR=${oDIR}
     eval "$(echo "recon-all ${!input} -s sub-${SID}_ses-${SES}" | tr "\t" " " | tr "\n" " ")"
+
+    # ** Release N4 corrected images
+    # FreeSurfer imported them, so they are no longer needed. In
+    # incremental mode, they are kept, because they tell which
+    # sessions were corrected in a previous run.
+    if [ ${N4} -eq 1 ] && [ ${INCREMENTAL} -eq 0 ]; then
+        release ${iDIR}/ses-${SES}
+    fi
     
     # ** Run Cross Sectional FreeSurfer
     recon-all \
@@ -330,7 +385,30 @@ TLIST=(
 )
 
 # * Run template creation
-recon-all -base sub-${SID} ${TLIST[@]} -all -parallel -openmp ${CPUS}
+# In incremental mode, an existing base is kept and new sessions
+# are added to it with '-addtp' during longitudinal processing
+# (see below). This avoids rerunning the base and all longitudinal
+# time points when a new session arrives.
+ADDTP=()
+if [ ${INCREMENTAL} -eq 1 ] && [ -f ${oDIR}/sub-${SID}/scripts/recon-all.done ]; then
+
+    # ** Time points that are already part of the base
+    BASETPS=( $(cat ${oDIR}/sub-${SID}/base-tps) )
+    echo "Subject template already exists with time points: ${BASETPS[@]}"
+
+    # ** Sessions that are not part of the base yet
+    for SES in ${SESLIST[@]}; do
+        if ! echo " ${BASETPS[@]} " | grep -q " sub-${SID}_ses-${SES} "; then
+            ADDTP+=( ${SES} )
+        fi
+    done
+    echo "Sessions that will be added to the template: ${ADDTP[@]}"
+
+else
+
+    recon-all -base sub-${SID} ${TLIST[@]} -all -parallel -openmp ${CPUS}
+
+fi
 
 
 
@@ -349,6 +427,18 @@ for SES in ${SESLIST[@]}; do
 
     # ** Announce
     echo "Working on ${SID}: ${SES} [FreeSurfer Longitudinal Processing]"
+
+    # ** Incremental processing
+    if [ ${INCREMENTAL} -eq 1 ] && [ -f ${oDIR}/sub-${SID}_ses-${SES}.long.sub-${SID}/scripts/recon-all.done ]; then
+        echo "Longitudinal processing of session ${SES} already finished. Skip."
+        continue
+    fi
+
+    # ** Add new time points to an existing template
+    ADDFLAG=""
+    if echo " ${ADDTP[@]} " | grep -q " ${SES} "; then
+        ADDFLAG="-addtp"
+    fi
     
     # ** Run Longitudinal FreeSurfer
     recon-all \
@@ -356,16 +446,17 @@ for SES in ${SESLIST[@]}; do
         -openmp ${CPUS} \
         -long sub-${SID}_ses-${SES} \
         sub-${SID} \
+        ${ADDFLAG} \
         -all
     
 done
 
 
 
-# * Clean up if flag to keep intermediate files is not set
-if [ ${INTERMEDIATE} -eq 0 ]; then
-    echo "Removing intermediate files has not been implemented yet"
-fi
+# * Intermediate files
+# The intermediate files of the N4 correction are released as soon
+# as they have been used (see above). All FreeSurfer output is used
+# by later stages.
 
 # * Exit
 exit
@@ -5,7 +5,7 @@
 # calcualtes the warp from this template to SUIT space.
 
 # * Input arguments
-while getopts "s:n:f:u:c:i:l:r:" OPTION
+while getopts "s:n:f:u:c:i:l:r:e:k:p:j:q:" OPTION
 do
      case $OPTION in
          s)
@@ -32,6 +32,21 @@ do
          r)
              REPORT=${OPTARG}
              ;;
+         e)
+             INCREMENTAL=${OPTARG}
+             ;;
+         k)
+             CONVERGENCE=${OPTARG}
+             ;;
+         p)
+             PRESET=${OPTARG}
+             ;;
+         j)
+             INITCACHE=${OPTARG}
+             ;;
+         q)
+             INITMIN=${OPTARG}
+             ;;
          ?)
              exit
              ;;
@@ -40,6 +55,19 @@ done
 
 
 
+# * Defaults
+# Incremental processing is off unless requested
+INCREMENTAL=${INCREMENTAL:-0}
+# Run all template iterations unless a convergence threshold is set
+CONVERGENCE=${CONVERGENCE:-0}
+# Registration schedule
+PRESET=${PRESET:-standard}
+# No cohort cache of initial transforms unless a protocol key is set
+INITCACHE=${INITCACHE:-}
+INITMIN=${INITMIN:-3}
+
+
+
 # * Logging
 cat <<EOF
 ##############################################################
@@ -59,12 +87,22 @@ oDIRs=${oDIR}/03_SUITTemplate
 mkdir -p ${oDIRt} ${oDIRs}
 tDIR="/sofware/ANTS-templates"
 
+# * Release of intermediate files
+source $(dirname $0)/cleanup.sh
+
+# * Registration schedule
+source $(dirname $0)/registration.sh
+setRegistrationPreset ${PRESET}
+
+# * Pre-baked template images
+source $(dirname $0)/assets.sh
+
 # * Set FreeSurfer data location
 if [ ${FSDATA} -eq 0 ]; then
     if [ ${LOCALCOPY} -eq 1 ]; then
         FSDATADIR=/data/tmp/01_FreeSurfer
     elif [ ${LOCALCOPY} -eq 0 ]; then
-        FSDATADIR=/freesurfer
+        FSDATADIR=${CVET_FREESURFER_DIR:-/freesurfer}
     fi
 elif [ ${FSDATA} -eq 1 ]; then
      FSDATADIR=/data/out/01_FreeSurfer
@@ -116,6 +154,22 @@ for SES in ${SESLIST[@]}; do
         exit 1
     fi
 
+    # ** Incremental processing
+    # Keep the cerebellum of a session from a previous run if
+    # it was created from the same FreeSurfer folder. When a
+    # session moves from cross-sectional to longitudinal
+    # processing, the FreeSurfer folder changes and the
+    # cerebellum is created again. Only the name of the folder is
+    # compared, because its location changes when the input is
+    # prefetched to scratch (see CVET.py).
+    if [ ${INCREMENTAL} -eq 1 ] \
+           && [ -f ${oDIRm}/sub-${SID}_ses-${SES}_ccereb.nii.gz ] \
+           && [ "$(cat ${oDIRm}/fs_source.txt 2>/dev/null)" = "${FSDATA} ${FSSUBDIR}" ]; then
+        echo "Cerebellum of session ${SES} already exists. Skip."
+        continue
+    fi
+    echo "${FSDATA} ${FSSUBDIR}" > ${oDIRm}/fs_source.txt
+
     # ** Convert files from FreeSurfer's mgh to Nifti format
     mri_convert \
         ${FSDIR}/mri/aseg.mgz \
@@ -169,6 +223,9 @@ EOF
             -bin \
             ${oDIRm}/cerebellumMask_noBS.nii.gz
 
+        # *** Release label images
+        release ${oDIRm}/{LcWM,LcGM,RcWM,RcGM,BrainStem}.nii.gz
+
     elif [ ${USESUIT} -eq 1 ]; then
 
         # *** Create SUIT cerebellum mask
@@ -193,6 +250,7 @@ EOF
 	% SUIT Cerebellum Isolation Batch
 	% This script was automatically generated on `date` 
 	%-----------------------------------------------------------------------
+	$([ -n "${CVET_NUM_THREADS}" ] && echo "maxNumCompThreads(${CVET_NUM_THREADS});")
 	matlabbatch{1}.spm.tools.suit.isolate_seg.source = {{'${oDIRm}/roT1.nii,1'}};
 	matlabbatch{1}.spm.tools.suit.isolate_seg.bb = [-76 76
 	                                                -108 -6
@@ -324,6 +382,12 @@ EOF
             -bin \
             ${oDIRm}/cerebellumMask_noBS.nii.gz
 
+        # *** Release SUIT isolation and label images
+        release \
+            ${oDIRm}/*roT1* \
+            ${oDIRm}/isolate_job.m \
+            ${oDIRm}/{LcWM,LcGM,RcWM,RcGM,nonBrain,fs_probably_cereb,cerebellum_WM,clusters}.nii.gz
+
     fi
     
     # ** Apply mask
@@ -337,6 +401,12 @@ EOF
         ${oDIRm}/sub-${SID}_ses-${SES}_cereb.nii.gz \
         ${oDIRm}/sub-${SID}_ses-${SES}_ccereb.nii.gz \
         $(fslstats ${oDIRm}/sub-${SID}_ses-${SES}_cereb.nii.gz -w)
+
+    # ** Release images that were only needed to create the cerebellum
+    release \
+        ${oDIRm}/aseg.nii.gz \
+        ${oDIRm}/T1.nii.gz \
+        ${oDIRm}/sub-${SID}_ses-${SES}_cereb.nii.gz
     
 done
 
@@ -358,8 +428,26 @@ EOF
 # * Check for which time points cerebelli are available
 CLIST=( $(find ${oDIR} -iname "sub-${SID}_ses-*_ccereb.nii.gz" | sort) )
 
+# * Incremental processing
+# Compare the cerebelli that go into the template with the ones
+# that were used to build the existing template (if any). If
+# nothing changed, the template and the warp to SUIT space are
+# kept. If sessions were added or changed, the existing template
+# is used as initial template for the template construction.
+NEWTEMPLATE=1
+WARMSTART=0
+if [ ${INCREMENTAL} -eq 1 ] && [ -f ${oDIRt}/T_template0.nii.gz ]; then
+    if [ "$(cat ${oDIRt}/template_inputs.txt 2>/dev/null)" = "$(md5sum ${CLIST[@]})" ]; then
+        echo "Subject template inputs did not change. Keep existing template."
+        NEWTEMPLATE=0
+    else
+        echo "Subject template inputs changed. Warm-start from existing template."
+        WARMSTART=1
+    fi
+fi
+
 # * If there are more than two time points, create a template.
-if [ ${#CLIST[@]} -gt 1 ]; then
+if [ ${#CLIST[@]} -gt 1 ] && [ ${NEWTEMPLATE} -eq 1 ]; then
 
     # ** Select type of parallel computing
     if [ ${CPUS} -eq 1 ]; then
@@ -367,9 +455,17 @@ if [ ${#CLIST[@]} -gt 1 ]; then
     elif [ ${CPUS} -gt 1 ]; then
         TYPE=2
     fi
+
+    # ** Thread budget
+    # One registration per session runs in parallel. Running more
+    # jobs than sessions does not help, and each job gets an equal
+    # share of the CPUs for its ITK threads, so that the number of
+    # threads does not exceed the number of CPUs.
+    JOBS=$(( ${CPUS} < ${#CLIST[@]} ? ${CPUS} : ${#CLIST[@]} ))
+    JOBTHREADS=$(( ${CPUS} / ${JOBS} ))
     
     # ** Settings for antsMultivariateTemplateConstruction2.sh
-    J=${CPUS}      # Number of CPUs
+    J=${JOBS}      # Number of parallel jobs
     C=${TYPE}      # Type of parallel computing
     I=4            # Iteration limit (default=4)
     Q=25x15x10x5   # Iterations (default=100x100x70x20)
@@ -377,27 +473,99 @@ if [ ${#CLIST[@]} -gt 1 ]; then
     F=6x4x2x1      # Shrink factor (default=6x4x2x1)
     S=3x2x1x0      # Smoothing factor (default=3x2x1x0)
 
+    # ** Initial template
+    # By default, the template is initialized with the rigidly
+    # aligned average of the inputs. When warm-starting, the
+    # template of the previous run is the initial template and
+    # only a couple of iterations are needed to incorporate the
+    # new sessions.
+    INITIAL="-r 1"
+    if [ ${WARMSTART} -eq 1 ]; then
+        cp ${oDIRt}/T_template0.nii.gz ${oDIRt}/T_template0_previous.nii.gz
+        INITIAL="-z ${oDIRt}/T_template0_previous.nii.gz"
+        I=2
+    fi
+
     # ** Goto output folder
     cd ${oDIRt}
 
-    # ** Build template
+    # ** Template construction
     # Input files are all cropped cerebelli of one subject
-    antsMultivariateTemplateConstruction2.sh \
-        -d 3 \
-        -o ${oDIRt}/T_ \
-        -a 1 \
-        -j ${J} \
-        -c ${C} \
-        -i ${I} \
-        -q ${Q} \
-        -g ${G} \
-        -f ${F} \
-        -s ${S} \
-        -n 0 \
-        -r 1 \
-        -m CC \
-        -t Rigid \
-        ${CLIST[@]}
+    # Arguments: number of iterations, initial template option
+    buildTemplate() {
+        ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=${JOBTHREADS} \
+        OMP_NUM_THREADS=${JOBTHREADS} \
+        antsMultivariateTemplateConstruction2.sh \
+            -d 3 \
+            -o ${oDIRt}/T_ \
+            -a 1 \
+            -j ${J} \
+            -c ${C} \
+            -i ${1} \
+            -q ${Q} \
+            -g ${G} \
+            -f ${F} \
+            -s ${S} \
+            -n 0 \
+            ${2} \
+            -m CC \
+            -t Rigid \
+            ${CLIST[@]}
+    }
+
+    # ** Build template
+    if [ $(echo "${CONVERGENCE} > 0" | bc) -eq 0 ]; then
+
+        # *** Run all iterations at once
+        buildTemplate ${I} "${INITIAL}"
+
+    else
+
+        # *** Run one iteration at a time
+        # After each iteration, measure how much the template
+        # changed (1 - normalized cross correlation with the
+        # template of the previous iteration) and stop once this
+        # change is below the convergence threshold.
+        echo "Build template until convergence (threshold: ${CONVERGENCE}, maximum iterations: ${I})"
+        log=${oDIRt}/template_convergence.csv
+        echo "iteration,one_minus_ncc,relative_mad" > ${log}
+        PREVIOUS=""
+        if [ ${WARMSTART} -eq 1 ]; then
+            PREVIOUS=${oDIRt}/T_template0_previous.nii.gz
+        fi
+        for ((it=1; it<=${I}; it++)); do
+
+            # **** Run iteration
+            buildTemplate 1 "${INITIAL}"
+            cp ${oDIRt}/T_template0.nii.gz ${oDIRt}/T_template0_iteration${it}.nii.gz
+
+            # **** Measure change
+            if [ -n "${PREVIOUS}" ]; then
+                change=$(python3 $(dirname $0)/templateChange.py ${PREVIOUS} ${oDIRt}/T_template0.nii.gz)
+                echo "${it},${change}" >> ${log}
+                echo "Template iteration ${it}: 1-NCC,MAD = ${change}"
+                if [ $(echo "$(echo ${change} | cut -d, -f1) < ${CONVERGENCE}" | bc) -eq 1 ]; then
+                    echo "Template converged after ${it} iterations."
+                    break
+                fi
+            fi
+
+            # **** Next iteration starts from this template
+            PREVIOUS=${oDIRt}/T_template0_iteration${it}.nii.gz
+            INITIAL="-z ${PREVIOUS}"
+
+        done
+
+        # *** Release templates of the separate iterations
+        release ${oDIRt}/T_template0_iteration*.nii.gz
+
+    fi
+
+    # ** Store which inputs went into this template
+    md5sum ${CLIST[@]} > ${oDIRt}/template_inputs.txt
+
+    # ** Release the template of the previous run
+    release ${oDIRt}/T_template0_previous.nii.gz
 
 elif [ ${#CLIST[@]} -eq 1 ]; then
     
@@ -408,6 +576,7 @@ fi
 
 
 
+
 # * Warp subject specific cerebellar template to SUIT space
 cat <<EOF
 
@@ -425,7 +594,7 @@ EOF
 cd ${oDIRs}
 
 # * Define SUIT Template and Subject Template
-SUIT_Template=/software/SUIT-templates/SUIT.nii.gz
+SUIT_Template=$(asset /software/SUIT-templates/SUIT.nii.gz)
 Subject_Template=${oDIRt}/T_template0.nii.gz
 
 # If there is only one time point, there is no template.
@@ -435,34 +604,68 @@ if [ ${#CLIST[@]} -eq 1 ]; then
     Subject_Template=${CLIST[0]}
 fi
 
+# * Incremental processing
+# Keep the warp to SUIT space if the image that was warped did
+# not change since the previous run.
+if [ ${INCREMENTAL} -eq 1 ] \
+       && [ -f ${oDIRs}/ants_1Warp.nii.gz ] \
+       && [ "$(cat ${oDIRs}/registration_input.txt 2>/dev/null)" = "$(md5sum ${Subject_Template})" ]; then
+    echo "Subject template did not change and is already warped to SUIT space. Done."
+    exit
+fi
+
+# * Initial transform
+# Start from the center of mass of both images, or, in
+# incremental mode, from the affine transform of the previous
+# run, which is already close to the new solution. Otherwise,
+# with a cohort cache, start from the average affine transform
+# of the subjects of the same protocol or site (see initCache.py).
+INIT="[${SUIT_Template},${Subject_Template},1]"
+if [ ${INCREMENTAL} -eq 1 ] && [ -f ${oDIRs}/ants_0GenericAffine.mat ]; then
+    cp ${oDIRs}/ants_0GenericAffine.mat ${oDIRs}/ants_previous_0GenericAffine.mat
+    INIT="${oDIRs}/ants_previous_0GenericAffine.mat"
+elif [ -n "${INITCACHE}" ]; then
+    python3 $(dirname $0)/initCache.py init \
+            --key "${INITCACHE}" \
+            --fixed ${SUIT_Template} \
+            --moving ${Subject_Template} \
+            --output ${oDIRs}/ants_cohort_init.txt \
+            --minimum ${INITMIN} \
+            --SID ${SID}
+    STATUS=$?
+    # (status 3: fewer than INITMIN subjects in the cache)
+    if [ ${STATUS} -eq 0 ]; then
+        INIT="${oDIRs}/ants_cohort_init.txt"
+    elif [ ${STATUS} -ne 3 ]; then
+        echo "WARNING: The cohort cache of initial transforms failed (exit status ${STATUS})."
+        echo "         Start from the centers of mass instead."
+    fi
+fi
+
 # * Calculate warp
-antsRegistration  \
-    -d 3  \
-    --winsorize-image-intensities [0.005,0.995] \
-   -r [       "${SUIT_Template}" , "${Subject_Template}" ,1]  \
-   -m mattes[ "${SUIT_Template}" , "${Subject_Template}" , 1 , 32, regular, 0.3 ]  \
-      -t translation[ 0.1 ]  \
-      -c [10000x111110x11110,1.e-8,20]  \
-      -s 4x2x1vox  \
-      -f 6x4x2 -l 1  \
-   -m mattes[ "${SUIT_Template}" , "${Subject_Template}" , 1 , 32, regular, 0.3 ]  \
-      -t rigid[ 0.1 ]  \
-      -c [10000x111110x11110,1.e-8,20]  \
-      -s 4x2x1vox  \
-      -f 3x2x1 -l 1  \
-   -m mattes[ "${SUIT_Template}" , "${Subject_Template}" , 1 , 32, regular, 0.3 ]  \
-      -t affine[ 0.1 ]  \
-      -c [10000x111110x11110,1.e-8,20]  \
-      -s 4x2x1vox  \
-      -f 3x2x1 -l 1  \
-   -m mattes[ "${SUIT_Template}" , "${Subject_Template}" , 0.5 , 32 ]  \
-   -m cc[     "${SUIT_Template}" , "${Subject_Template}" , 0.5 , 4 ]  \
-      -t SyN[ .20, 3, 0 ]  \
-      -c [ 100x100x50,-0.01,5 ]  \
-      -s 1x0.5x0vox  \
-      -f 4x2x1 -l 1 -u 1 -z 1  \
-   -o [ants_,ants_warped.nii.gz,ants_inv.nii.gz]  \
-   -v 1
+runRegistration \
+    ${SUIT_Template} \
+    ${Subject_Template} \
+    ${INIT} \
+    [ants_,ants_warped.nii.gz,ants_inv.nii.gz]
+
+# * Store which image was warped to SUIT space
+md5sum ${Subject_Template} > ${oDIRs}/registration_input.txt
+
+# * Add the affine transform to the cohort cache
+if [ -n "${INITCACHE}" ]; then
+    python3 $(dirname $0)/initCache.py update \
+            --key "${INITCACHE}" \
+            --SID ${SID} \
+            --transform ${oDIRs}/ants_0GenericAffine.mat \
+        || echo "WARNING: The affine transform was not added to the cohort cache."
+fi
+
+# * Release files that are not used by later stages
+release \
+    ${oDIRs}/ants_inv.nii.gz \
+    ${oDIRs}/ants_previous_0GenericAffine.mat \
+    ${oDIRs}/ants_cohort_init.txt
    
 exit
 
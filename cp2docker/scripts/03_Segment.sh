@@ -3,7 +3,7 @@
 # This script segments the whole brain into a GM tissue class using SPM12 or ANTs Atropos
 
 # * Input arguments
-while getopts "s:t:n:f:m:i:l:r:" OPTION
+while getopts "s:t:n:f:m:i:l:r:e:p:b:" OPTION
 do
      case $OPTION in
          s)
@@ -30,6 +30,15 @@ do
          r)
              REPORT=$OPTARG
              ;;
+         e)
+             INCREMENTAL=$OPTARG
+             ;;
+         p)
+             PRESET=$OPTARG
+             ;;
+         b)
+             N4DONE=$OPTARG
+             ;;
          ?)
              exit
              ;;
@@ -38,6 +47,17 @@ done
 
 
 
+# * Defaults
+# Incremental processing is off unless requested
+INCREMENTAL=${INCREMENTAL:-0}
+# Registration schedule
+PRESET=${PRESET:-standard}
+# The T1 images are not bias field corrected yet, unless
+# 01_FS.sh did that (--biasfieldcorrection 1)
+N4DONE=${N4DONE:-0}
+
+
+
 # * Logging
 cat <<EOF
 ##############################################################
@@ -56,12 +76,22 @@ pDIR=/software/TissuePriors
 oDIR=/data/out/03_Segment/sub-${SID}/ses-${SES}
 mkdir -p ${oDIR}
 
+# * Release of intermediate files
+source $(dirname $0)/cleanup.sh
+
+# * Registration schedule
+source $(dirname $0)/registration.sh
+setRegistrationPreset ${PRESET}
+
+# * Pre-baked template images
+source $(dirname $0)/assets.sh
+
 # * Set FreeSurfer data location
 if [ ${FSDATA} -eq 0 ]; then
     if [ ${LOCALCOPY} -eq 1 ]; then
         FSDATADIR=/data/tmp/01_FreeSurfer
     elif [ ${LOCALCOPY} -eq 0 ]; then
-        FSDATADIR=/freesurfer
+        FSDATADIR=${CVET_FREESURFER_DIR:-/freesurfer}
     fi
 elif [ ${FSDATA} -eq 1 ]; then
      FSDATADIR=/data/out/01_FreeSurfer
@@ -97,6 +127,22 @@ if [ -z ${FSDIR} ]; then
     exit 1
 fi
 
+# * Incremental processing
+# The segmentation does not depend on the other sessions. Keep
+# the segmentation of a previous run if it was created from the
+# same FreeSurfer folder (by name, see 02_MkTmplt.sh) and with the
+# same method. The registration to FreeSurfer space is needed by
+# 04_ApplyWarp.sh; without '--intermediate_files' it was deleted
+# after the previous run, so the session is segmented again.
+if [ ${INCREMENTAL} -eq 1 ] \
+       && [ -f ${oDIR}/c1sub-${SID}_ses-${SES}_rawavg_N4.nii.gz ] \
+       && [ -f ${oDIR}/register.native.txt ] \
+       && [ "$(cat ${oDIR}/fs_source.txt 2>/dev/null)" = "${FSDATA} ${FSSUBDIR} ${METHOD} ${N4DONE}" ]; then
+    echo "Segmentation of session ${SES} already exists. Skip."
+    exit 0
+fi
+echo "${FSDATA} ${FSSUBDIR} ${METHOD} ${N4DONE}" > ${oDIR}/fs_source.txt
+
 # * Convert native space averaged T1 to nii
 rawavg=$(find ${FSDATADIR} | grep sub-${SID}_ses-${SES} | grep -v long | grep rawavg.mgz)
 mri_convert \
@@ -120,6 +166,7 @@ lta_convert \
     --outitk ${oDIR}/register.native.txt \
     --trg ${orig} \
     --src ${rawavg}
+release ${oDIR}/register.native.dat
 
 # ** Convert the brain mask to nifti
 brainmask=$(find ${FSDATADIR} | grep sub-${SID}_ses-${SES} | grep -v long | grep brainmask.mgz)
@@ -136,46 +183,58 @@ antsApplyTransforms \
     -t [${oDIR}/register.native.txt,1] \
     --float \
     -v
-
-# ** Create the binary dilated brain mask for N4biasfield correction
-fslmaths \
-    ${oDIR}/sub-${SID}_ses-${SES}_brainmask_in_rawavg.nii.gz \
-    -bin \
-    -dilM \
-    -dilM \
-    ${oDIR}/sub-${SID}_ses-${SES}_brainmask_bin_dilM2.nii.gz
+release ${oDIR}/sub-${SID}_ses-${SES}_brainmask.nii.gz
 
 # ** Apply N4 Bias Field Correction
-# Note: adding a mask forces the N4 application within the mask
-# We want to do the estimation within the mask, but the application
-# to the entire image. So we use -w but not -x.
-N4BiasFieldCorrection \
-    -d 3 \
-    -i ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz \
-    -w ${oDIR}/sub-${SID}_ses-${SES}_brainmask_bin_dilM2.nii.gz \
-    -s 2 \
-    -c [125x100x75x50] \
-    -o [${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz,${oDIR}/BF_rawavg.nii.gz] \
-    -v 1
-
-# ** Create image for quality control of bias field correction.
-# For this, we will z-transform both the T1 and the N4_T1 image.
-mean_T1=$(fslstats ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz -m)
-sd_T1=$(fslstats ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz -s)
-fslmaths ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz -sub ${mean_T1} ${oDIR}/T1-mean.nii.gz
-fslmaths ${oDIR}/T1-mean.nii.gz -div ${sd_T1} ${oDIR}/zT1.nii.gz
-
-mean_N4T1=$(fslstats ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz -m)
-sd_N4T1=$(fslstats ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz -s)
-fslmaths ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz -sub ${mean_N4T1} ${oDIR}/N4_T1-mean.nii.gz
-fslmaths ${oDIR}/N4_T1-mean.nii.gz -div ${sd_N4T1} ${oDIR}/zN4_T1.nii.gz
-
-fslmaths ${oDIR}/zT1.nii.gz -sub ${oDIR}/zN4_T1.nii.gz ${oDIR}/N4_effect.nii.gz
-
-rm -f ${oDIR}/T1-mean.nii.gz
-rm -f ${oDIR}/zT1.nii.gz
-rm -f ${oDIR}/N4_T1-mean.nii.gz
-rm -f ${oDIR}/zN4_T1.nii.gz
+# If 01_FS.sh already corrected the T1 images (and created the QC
+# image of the correction there), rawavg is the corrected image.
+# A second correction would hardly change it, so it is only copied
+# to the name used by the following steps.
+if [ ${N4DONE} -eq 1 ]; then
+
+    echo "The T1 images were bias field corrected by 01_FS.sh. Skip N4."
+    cp -v \
+       ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz \
+       ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz
+
+else
+
+    # *** Create the binary dilated brain mask for N4biasfield correction
+    fslmaths \
+        ${oDIR}/sub-${SID}_ses-${SES}_brainmask_in_rawavg.nii.gz \
+        -bin \
+        -dilM \
+        -dilM \
+        ${oDIR}/sub-${SID}_ses-${SES}_brainmask_bin_dilM2.nii.gz
+
+    # *** Correct the bias field
+    # Note: adding a mask forces the N4 application within the mask
+    # We want to do the estimation within the mask, but the application
+    # to the entire image. So we use -w but not -x.
+    N4BiasFieldCorrection \
+        -d 3 \
+        -i ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz \
+        -w ${oDIR}/sub-${SID}_ses-${SES}_brainmask_bin_dilM2.nii.gz \
+        -s 2 \
+        -c [125x100x75x50] \
+        -o [${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz,${oDIR}/BF_rawavg.nii.gz] \
+        -v 1
+    release \
+        ${oDIR}/sub-${SID}_ses-${SES}_brainmask_bin_dilM2.nii.gz \
+        ${oDIR}/BF_rawavg.nii.gz
+
+    # *** Create image for quality control of bias field correction.
+    # This is the difference of the z-transformed T1 and N4_T1 images.
+    # It is an intermediate file, so it is only created if
+    # intermediate files are kept.
+    if [ ${INTERMEDIATE} -eq 1 ]; then
+        python3 $(dirname $0)/n4Effect.py \
+                ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz \
+                ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz \
+                ${oDIR}/N4_effect.nii.gz
+    fi
+
+fi
 
 # * Segmentation
 if [ ${METHOD} = "S" ]; then
@@ -196,6 +255,7 @@ EOF
 	% SPM Segmentation Batch
 	% This script was automatically generated on `date` 
 	%-----------------------------------------------------------------------
+	$([ -n "${CVET_NUM_THREADS}" ] && echo "maxNumCompThreads(${CVET_NUM_THREADS});")
 	matlabbatch{1}.spm.spatial.preproc.channel.vols = {'${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii,1'};
 	matlabbatch{1}.spm.spatial.preproc.channel.biasreg = 0;
 	matlabbatch{1}.spm.spatial.preproc.channel.biasfwhm = Inf;
@@ -255,7 +315,7 @@ EOF
     cd ${oDIR}
     find . -iname "*.nii" | xargs -I {} gzip -9 {}
 
-elif [ "${METHOD}" = "A" ]; then
+elif [ "${METHOD}" = "A" ] || [ "${METHOD}" = "F" ]; then
 
     # ** ANTs Atropos
     cat <<-EOF
@@ -270,75 +330,102 @@ EOF
         -bin \
         ${oDIR}/sub-${SID}_ses-${SES}_bin_brainmask_in_rawavg.nii.gz
 
-    # ** Create Skull Stripped Brain
-    fslmaths \
-        ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz \
-        -mas ${oDIR}/sub-${SID}_ses-${SES}_bin_brainmask_in_rawavg.nii.gz \
-        ${oDIR}/sub-${SID}_ses-${SES}_rawavg_ssN4.nii.gz
-    
-    # ** Calculate warp from Tissue Prior Probability Map space to Native Space
-    T="${pDIR}/MNI152_T1_1mm_brain.nii.gz"
-    M="${oDIR}/sub-${SID}_ses-${SES}_rawavg_ssN4.nii.gz"
-    oDIRa1="${oDIR}/01_Warp"
-    mkdir -p "${oDIRa1}"
-
-    # ** Calculate warp using ANTs with SyN
-    cd ${oDIRa1}
-    antsRegistration \
-        -d 3 \
-        --winsorize-image-intensities [0.005,0.995] \
-        -r [ "${T}" , "${M}" , 1] \
-        -m mattes[ "${T}", "${M}" , 1, 32, regular, 0.3] \
-        -t translation[ 0.1 ] \
-        -c [10000x111110x11110,1.e-8,20]  \
-        -s 4x2x1vox  \
-        -f 6x4x2 -l 1 \
-        -m mattes[ "${T}", "${M}" , 1 , 32, regular, 0.3 ] \
-        -t rigid[ 0.1 ] \
-        -c [10000x111110x11110,1.e-8,20]  \
-        -s 4x2x1vox  \
-        -f 3x2x1 -l 1 \
-        -m mattes[ "${T}", "${M}" , 1 , 32, regular, 0.3 ] \
-        -t affine[ 0.1 ] \
-        -c [10000x111110x11110,1.e-8,20]  \
-        -s 4x2x1vox  \
-        -f 3x2x1 -l 1 \
-        -m mattes[ "${T}" , "${M}" , 0.5 , 32 ] \
-        -m cc[ "${T}" , "${M}" , 0.5 , 4 ] \
-        -t SyN[ .20, 3, 0 ] \
-        -c [ 100x100x50,-0.01,5 ]  \
-        -s 1x0.5x0vox  \
-        -f 4x2x1 -l 1 -u 1 -z 1 \
-        -o [ants_,normalizedImage.nii.gz,inverseWarpField.nii.gz] \
-        -v 1
-
-    # ** Apply Warps to the Tissue Probabily Maps
+    # ** Tissue priors in native space
     oDIRa2="${oDIR}/02_WarpedTPMs"
     mkdir -p "${oDIRa2}"
 
-    for i in {1..6}; do
+    if [ "${METHOD}" = "A" ]; then
 
-        # Apply registration
+        # *** Create Skull Stripped Brain
+        fslmaths \
+            ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz \
+            -mas ${oDIR}/sub-${SID}_ses-${SES}_bin_brainmask_in_rawavg.nii.gz \
+            ${oDIR}/sub-${SID}_ses-${SES}_rawavg_ssN4.nii.gz
+
+        # *** Calculate warp from Tissue Prior Probability Map space to Native Space
+        T=$(asset ${pDIR}/MNI152_T1_1mm_brain.nii.gz)
+        M="${oDIR}/sub-${SID}_ses-${SES}_rawavg_ssN4.nii.gz"
+        oDIRa1="${oDIR}/01_Warp"
+        mkdir -p "${oDIRa1}"
+
+        # *** Calculate warp using ANTs with SyN
+        cd ${oDIRa1}
+        runRegistration \
+            ${T} \
+            ${M} \
+            [${T},${M},1] \
+            [ants_,normalizedImage.nii.gz,inverseWarpField.nii.gz]
+
+        # *** Apply Warps to the Tissue Probabily Maps
+        for i in {1..6}; do
+
+            # Apply registration
+            antsApplyTransforms \
+                -d 3 \
+                -i $(asset ${pDIR}/p${i}.nii.gz) \
+                -r ${M} \
+                -o ${oDIRa2}/wp${i}.nii.gz \
+                -t ${oDIRa1}/ants_1InverseWarp.nii.gz \
+                -t [${oDIRa1}/ants_0GenericAffine.mat,1] \
+                --float \
+                -v 1
+
+        done
+
+        # *** Release the registration and the skull stripped brain
+        release \
+            ${oDIRa1} \
+            ${oDIR}/sub-${SID}_ses-${SES}_rawavg_ssN4.nii.gz
+
+        # *** Create Mask That Includes Tissue Classes
+        # I.e., all voxels.
+        fslmaths \
+            ${oDIR}/sub-${SID}_ses-${SES}_brainmask_in_rawavg.nii.gz \
+            -add 1 \
+            -bin \
+            ${oDIR}/sub-${SID}_ses-${SES}_all_voxel_mask_in_rawavg.nii.gz
+
+        # *** Atropos settings
+        # Six tissue classes (GM, WM, CSF, bone, soft tissue, air) in
+        # the whole image
+        NCLASSES=6
+        ATROPOSMASK=${oDIR}/sub-${SID}_ses-${SES}_all_voxel_mask_in_rawavg.nii.gz
+
+    else
+
+        # *** FreeSurfer segmentation in native space
+        # FreeSurfer's segmentation of this session is brought into
+        # native (rawavg) space with the same registration as the brain
+        # mask. This replaces the registration to MNI space.
+        aseg=$(find ${FSDATADIR} | grep sub-${SID}_ses-${SES} | grep -v long | grep mri/aseg.mgz)
+        mri_convert \
+            ${aseg} \
+            ${oDIR}/sub-${SID}_ses-${SES}_aseg.nii.gz
         antsApplyTransforms \
             -d 3 \
-            -i ${pDIR}/p${i}.nii.gz \
-            -r ${M} \
-            -o ${oDIRa2}/wp${i}.nii.gz \
-            -t ${oDIRa1}/ants_1InverseWarp.nii.gz \
-            -t [${oDIRa1}/ants_0GenericAffine.mat,1] \
-            --float \
-            -v 1
+            -i ${oDIR}/sub-${SID}_ses-${SES}_aseg.nii.gz \
+            -r ${oDIR}/sub-${SID}_ses-${SES}_rawavg.nii.gz \
+            -o ${oDIR}/sub-${SID}_ses-${SES}_aseg_in_rawavg.nii.gz \
+            -t [${oDIR}/register.native.txt,1] \
+            -n GenericLabel \
+            -v
+        release ${oDIR}/sub-${SID}_ses-${SES}_aseg.nii.gz
+
+        # *** Smoothed GM, WM and CSF priors
+        python3 $(dirname $0)/fsPriors.py \
+                ${oDIR}/sub-${SID}_ses-${SES}_aseg_in_rawavg.nii.gz \
+                ${oDIR}/sub-${SID}_ses-${SES}_bin_brainmask_in_rawavg.nii.gz \
+                ${oDIRa2}/wp%d.nii.gz
+        release ${oDIR}/sub-${SID}_ses-${SES}_aseg_in_rawavg.nii.gz
+
+        # *** Atropos settings
+        # Three tissue classes (GM, WM, CSF) in the brain mask, where
+        # the FreeSurfer segmentation is defined
+        NCLASSES=3
+        ATROPOSMASK=${oDIR}/sub-${SID}_ses-${SES}_bin_brainmask_in_rawavg.nii.gz
 
-    done
+    fi
 
-    # ** Create Mask That Includes Tissue Classes
-    # I.e., all voxels.
-    fslmaths \
-        ${oDIR}/sub-${SID}_ses-${SES}_brainmask_in_rawavg.nii.gz \
-        -add 1 \
-        -bin \
-        ${oDIR}/sub-${SID}_ses-${SES}_all_voxel_mask_in_rawavg.nii.gz
-    
     # ** Atropos segmentation
     oDIRa3="${oDIR}/03_Atropos"
     mkdir -p "${oDIRa3}"
@@ -347,13 +434,19 @@ EOF
     antsAtroposN4.sh \
         -d 3 \
         -a ${oDIR}/sub-${SID}_ses-${SES}_rawavg_N4.nii.gz \
-        -c 6 \
-        -x ${oDIR}/sub-${SID}_ses-${SES}_all_voxel_mask_in_rawavg.nii.gz \
+        -c ${NCLASSES} \
+        -x ${ATROPOSMASK} \
         -p ${oDIRa2}/wp%d.nii.gz \
         -o ${oDIRa3}/
+
+    # ** Release the priors
+    release \
+        ${oDIRa2} \
+        ${oDIR}/sub-${SID}_ses-${SES}_bin_brainmask_in_rawavg.nii.gz \
+        ${oDIR}/sub-${SID}_ses-${SES}_all_voxel_mask_in_rawavg.nii.gz
     
     # ** Restrict segmentations to brain mask
-    for i in {1..6}; do
+    for i in $(seq 1 ${NCLASSES}); do
 
         # Mask out
         fslmaths \
@@ -367,27 +460,16 @@ EOF
         ${oDIRa3}/Segmentation.nii.gz \
         -mas ${oDIR}/sub-${SID}_ses-${SES}_brainmask_in_rawavg.nii.gz \
         ${oDIRa3}/labels.nii.gz          
+
+    # ** Release the Atropos output
+    release ${oDIRa3}
   
 fi
 
-# * Clean up if flag to keep intermediate files is not set
-if [ ${INTERMEDIATE} -eq 0 ]; then
-
-    rm -f \
-       ${oDIR}/register.native.dat \
-       ${oDIR}/register.native.txt \
-       ${oDIR}/BF_rawavg.nii.gz \
-       ${oDIR}/N4_effect.nii.gz       
-            
-    if [ "${METHOD}" = "A" ]; then
-        
-        rm -rf ${oDIRa1} ${oDIRa2} ${oDIRa3}
-        rm -f \
-           ${oDIR}/sub-${SID}_ses-${SES}_all_voxel_mask_in_rawavg.nii.gz
-           
-    fi
-    
-fi
+# * Intermediate files
+# Intermediate files are released as soon as they have been used
+# (see above). register.native.txt is also used by 04_ApplyWarp.sh
+# and is released by CVET.py once that stage has finished.
 
 # Exit
 exit
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 # * Input arguments
-while getopts "s:t:n:f:m:i:l:r:" OPTION
+while getopts "s:t:n:f:m:i:l:r:g:v:a:" OPTION
 do
      case $OPTION in
          s)
@@ -28,6 +28,15 @@ do
          r)
              REPORT=$OPTARG
              ;;
+         g)
+             CROPMARGIN=$OPTARG
+             ;;
+         v)
+             VOLUMESPACE=$OPTARG
+             ;;
+         a)
+             ATLASSAMPLING=$OPTARG
+             ;;
          ?)
              exit
              ;;
@@ -36,6 +45,18 @@ done
 
 
 
+# * Defaults
+# Work on the full native grid unless a crop margin is set
+CROPMARGIN=${CROPMARGIN:--1}
+# Extract the lobule volumes in native space (native), SUIT space
+# (suit), or both, to compare them (both)
+VOLUMESPACE=${VOLUMESPACE:-native}
+# Bring the atlas into native space by resampling it onto the working
+# grid (image), or by transforming only the cerebellar voxels (points)
+ATLASSAMPLING=${ATLASSAMPLING:-image}
+
+
+
 # * Logging
 cat <<EOF
 ##############################################################
@@ -57,13 +78,15 @@ iDIR3=/data/out/03_Segment/sub-${SID}/ses-${SES}
 oDIR=/data/out/04_ApplyWarp/sub-${SID}/ses-${SES}
 mkdir -p ${oDIR}
 tDIR="/software/SUIT-templates"
+source $(dirname $0)/cleanup.sh
+source $(dirname $0)/assets.sh
 
 # * Set FreeSurfer data location
 if [ ${FSDATA} -eq 0 ]; then
     if [ ${LOCALCOPY} -eq 1 ]; then
         FSDATADIR=/data/tmp/01_FreeSurfer
     elif [ ${LOCALCOPY} -eq 0 ]; then
-        FSDATADIR=/freesurfer
+        FSDATADIR=${CVET_FREESURFER_DIR:-/freesurfer}
     fi
 elif [ ${FSDATA} -eq 1 ]; then
      FSDATADIR=/data/out/01_FreeSurfer
@@ -139,23 +162,10 @@ fi
 
 
 
-# * Apply the transformations to bring the cerebellar atlas into native (rawavg) space
-antsApplyTransforms \
-    -d 3 \
-    -i ${tDIR}/Cerebellum-SUIT.nii.gz \
-    -r ${iDIR3}/sub-${SID}_ses-${SES}_rawavg.nii.gz \
-    -o ${oDIR}/atlasNativeSpace.nii.gz \
-    ${transform_FS_CS2Long} \
-    ${transform_FS_Long_2_ANTs_template} \
-    -t [${iDIR23}/ants_0GenericAffine.mat,1] \
-    -t ${iDIR23}/ants_1InverseWarp.nii.gz \
-    -n NearestNeighbor \
-    --float \
-    -v
-
 # * Calculate SPM12's / ANTs Atropos' ICV
 if [ ${METHOD} = "A" ]; then BMASK=ANTsBrainMask.nii.gz; BMlabel=ANTsICV; fi
 if [ ${METHOD} = "S" ]; then BMASK=SPMbrainMask.nii.gz;  BMlabel=SPMICV; fi
+if [ ${METHOD} = "F" ]; then BMASK=ANTsBrainMask.nii.gz; BMlabel=ANTsFSICV; fi
 
 fslmaths \
     ${iDIR3}/c1sub-${SID}_ses-${SES}_rawavg_N4.nii.gz \
@@ -227,72 +237,188 @@ elif  [ ${#CLIST[@]} -eq 1 ]; then
 
 fi
 
+# * Working grid
+# By default, all per-session images are on the full native (rawavg)
+# grid. Optionally, crop the grid to the bounding box of the
+# cerebellum mask plus a margin (in voxels). The cerebellum is only a
+# small part of the field of view, so this reduces the voxel work,
+# memory and file sizes of everything below. fslroi keeps the world
+# coordinates of the cropped images, so all results stay in native
+# space; the offsets of the crop are written to crop.txt.
+REFERENCE=${iDIR3}/sub-${SID}_ses-${SES}_rawavg.nii.gz
+GMMAP=${iDIR3}/c1sub-${SID}_ses-${SES}_rawavg_N4.nii.gz
+if [ ${CROPMARGIN} -ge 0 ]; then
+
+    # ** Bounding box of the cerebellum mask, extended by the margin
+    # and clipped to the image dimensions
+    CROP=( $(fslstats ${cerebMask} -w) )
+    DIMS=( $(fslval ${cerebMask} dim1) $(fslval ${cerebMask} dim2) $(fslval ${cerebMask} dim3) )
+    BOX=()
+    for d in 0 1 2; do
+        min=$(( ${CROP[$(( 2 * d ))]} - ${CROPMARGIN} ))
+        max=$(( ${CROP[$(( 2 * d ))]} + ${CROP[$(( 2 * d + 1 ))]} + ${CROPMARGIN} ))
+        if [ ${min} -lt 0 ]; then min=0; fi
+        if [ ${max} -gt ${DIMS[${d}]} ]; then max=${DIMS[${d}]}; fi
+        BOX+=( ${min} $(( max - min )) )
+    done
+    echo "Crop working grid to: ${BOX[@]}"
+
+    # ** Record the crop
+    cat <<-EOF > ${oDIR}/crop.txt
+	# Voxel offsets (x y z) and sizes (x y z) of the cropped working
+	# grid relative to the native (rawavg) grid of ${DIMS[@]} voxels
+	offset ${BOX[0]} ${BOX[2]} ${BOX[4]}
+	size ${BOX[1]} ${BOX[3]} ${BOX[5]}
+EOF
+
+    # ** Crop reference, cerebellum mask and GM map
+    fslroi ${REFERENCE} ${oDIR}/crop_rawavg.nii.gz ${BOX[@]}
+    fslroi ${cerebMask} ${oDIR}/crop_cMask.nii.gz ${BOX[@]}
+    fslroi ${GMMAP} ${oDIR}/crop_c1.nii.gz ${BOX[@]}
+    REFERENCE=${oDIR}/crop_rawavg.nii.gz
+    cerebMask=${oDIR}/crop_cMask.nii.gz
+    GMMAP=${oDIR}/crop_c1.nii.gz
+
+fi
+
 fslmaths \
-    ${iDIR3}/c1sub-${SID}_ses-${SES}_rawavg_N4.nii.gz \
+    ${GMMAP} \
     -mas ${cerebMask} \
     ${oDIR}/cgm.nii.gz
+release ${oDIR}/crop_c1.nii.gz
 
 
-# * Refine atlas by masking with FreeSufer cerebellar mask
-fslmaths \
-    ${oDIR}/atlasNativeSpace.nii.gz \
-    -mas ${cerebMask} \
-    ${oDIR}/c_atlasNativeSpace.nii.gz
-
-
-
-# * Extract volume per lobule for all regions
-echo "Extract volume per lobule for all regions"
-# The following code extracts a list of the mask values
-# of each of the lobules in the atlas.
-listOfLobules=$(fslstats \
-	            -K ${oDIR}/c_atlasNativeSpace.nii.gz \
-	            ${oDIR}/c_atlasNativeSpace.nii.gz \
-	            -M )
-
-# The following code grabs the mean intensity of the
-# gray matter image within the lobbules of the altas.
-# It does this for each lobule separately. It can
-# happen that a lobule mask includes voxels that are
-# not inside the GM segmentation map, and thus have
-# a GM value of zero. This will result in an overall
-# smaller mean GM value for that cluster, but this
-# will be canceled out by the fact that those voxels
-# will also add to the total number of voxels of
-# that lobule (and volume= avg intensity * number
-# of voxels).
-listMeanVal=$(fslstats \
-	          -K ${oDIR}/c_atlasNativeSpace.nii.gz \
-	          ${oDIR}/cgm.nii.gz \
-	          -m)
-
-# * Get the number of voxels per cluster.
-listNumVox=$(fslstats \
-	         -K ${oDIR}/c_atlasNativeSpace.nii.gz \
-	         ${oDIR}/c_atlasNativeSpace.nii.gz \
-	         -V | awk '{ for (i=1;i<=NF;i+=2) print $i }')
-
-# Use the mean intensity, the voxel size, and the number of
-# voxels to calculate the volume of gray matter per lobule.
-lobVols=$(
-    paste \
-        <(echo "${listMeanVal}" | tr " " "\n") \
-        <(echo "${listNumVox}" | tr " " "\n") \
-        | awk -v var=${voxS} '{ printf "%0.5f\n", $1 * $2 * var }' \
-        | head -28 \
-        | tr "\n" "," \
-        | sed 's/,$//g'
-       )
-
-# * Write this info out to a file
-oFile=${oDIR}/sub-${SID}_ses-${SES}_cGM.csv
-
-# * List of lobule names
+# * Transformations from SUIT space to native (rawavg) space
+# Store these, so that other atlases can be brought into native
+# space later without rerunning the registrations (see 06_Extract.py).
+atlasTransforms="${transform_FS_CS2Long} ${transform_FS_Long_2_ANTs_template} -t [${iDIR23}/ants_0GenericAffine.mat,1] -t ${iDIR23}/ants_1InverseWarp.nii.gz"
+echo ${atlasTransforms} > ${oDIR}/atlasTransforms.txt
+
+# * Lobule volume table
+# ** List of lobule names
 lNames="l_I_IV,r_I_IV,l_V,r_V,l_VI,v_VI,r_VI,l_CrusI,v_CrusI,r_CrusI,l_CrusII,v_CrusII,r_CrusII,l_VIIb,v_VIIb,r_VIIb,l_VIIIa,v_VIIIa,r_VIIIa,l_VIIIb,v_VIIIb,r_VIIIb,l_IX,v_IX,r_IX,l_X,v_X,r_X"
 
-# * Write out Header and Data
-echo SUB,SES,${lNames},${BMlabel},eTIV | sed 's/  *//g' > ${oFile}
-echo ${SID},${SES},${lobVols},${BMICV},${eTIV} | sed -e 's/  *//g' -e 's/,$//g' >> ${oFile}
+# ** Define function to write the volume table
+# Usage: writeVolumes <file> <comma separated lobule volumes>
+writeVolumes() {
+    echo SUB,SES,${lNames},${BMlabel},eTIV | sed 's/  *//g' > ${1}
+    echo ${SID},${SES},${2},${BMICV},${eTIV} | sed -e 's/  *//g' -e 's/,$//g' >> ${1}
+}
+
+# * Lobule volumes in native space
+# The SUIT atlas is brought into native space and the GM map is
+# summed per lobule there. This is skipped if the volumes are only
+# extracted in SUIT space (see below).
+if [ ${VOLUMESPACE} != "suit" ]; then
+
+    if [ ${ATLASSAMPLING} = "points" ]; then
+
+        # ** Label the voxels of the cerebellum mask
+        # Only the voxels inside the mask are transformed to SUIT
+        # space (as points) and labeled there, which gives the masked
+        # atlas in native space directly (see atlasPoints.py).
+        # (A stale atlas of an earlier run must not be used if one of
+        # the steps fails.)
+        rm -f ${oDIR}/c_atlasNativeSpace.nii.gz
+        python3 $(dirname $0)/atlasPoints.py points \
+                ${cerebMask} \
+                ${oDIR}/cerebPoints.csv \
+            && antsApplyTransformsToPoints \
+                   -d 3 \
+                   -i ${oDIR}/cerebPoints.csv \
+                   -o ${oDIR}/cerebPoints_SUIT.csv \
+                   ${atlasTransforms} \
+            && python3 $(dirname $0)/atlasPoints.py labels \
+                       ${cerebMask} \
+                       ${oDIR}/cerebPoints_SUIT.csv \
+                       $(asset ${tDIR}/Cerebellum-SUIT.nii.gz) \
+                       ${oDIR}/c_atlasNativeSpace.nii.gz
+        if [ ! -f ${oDIR}/c_atlasNativeSpace.nii.gz ]; then
+            echo "Point based labeling of the cerebellum mask failed. Exit."
+            exit 1
+        fi
+        release ${oDIR}/cerebPoints.csv ${oDIR}/cerebPoints_SUIT.csv
+
+    else
+
+        # ** Apply the transformations to bring the cerebellar atlas into native (rawavg) space
+        # (on the working grid)
+        antsApplyTransforms \
+            -d 3 \
+            -i $(asset ${tDIR}/Cerebellum-SUIT.nii.gz) \
+            -r ${REFERENCE} \
+            -o ${oDIR}/atlasNativeSpace.nii.gz \
+            ${atlasTransforms} \
+            -n NearestNeighbor \
+            --float \
+            -v
+
+
+        # ** Refine atlas by masking with FreeSufer cerebellar mask
+        fslmaths \
+            ${oDIR}/atlasNativeSpace.nii.gz \
+            -mas ${cerebMask} \
+            ${oDIR}/c_atlasNativeSpace.nii.gz
+        release ${oDIR}/atlasNativeSpace.nii.gz
+
+    fi
+
+
+
+    # ** Extract volume per lobule for all regions
+    echo "Extract volume per lobule for all regions"
+    # The following code extracts a list of the mask values
+    # of each of the lobules in the atlas.
+    listOfLobules=$(fslstats \
+    	            -K ${oDIR}/c_atlasNativeSpace.nii.gz \
+    	            ${oDIR}/c_atlasNativeSpace.nii.gz \
+    	            -M )
+
+    # The following code grabs the mean intensity of the
+    # gray matter image within the lobbules of the altas.
+    # It does this for each lobule separately. It can
+    # happen that a lobule mask includes voxels that are
+    # not inside the GM segmentation map, and thus have
+    # a GM value of zero. This will result in an overall
+    # smaller mean GM value for that cluster, but this
+    # will be canceled out by the fact that those voxels
+    # will also add to the total number of voxels of
+    # that lobule (and volume= avg intensity * number
+    # of voxels).
+    listMeanVal=$(fslstats \
+    	          -K ${oDIR}/c_atlasNativeSpace.nii.gz \
+    	          ${oDIR}/cgm.nii.gz \
+    	          -m)
+
+    # ** Get the number of voxels per cluster.
+    listNumVox=$(fslstats \
+    	         -K ${oDIR}/c_atlasNativeSpace.nii.gz \
+    	         ${oDIR}/c_atlasNativeSpace.nii.gz \
+    	         -V | awk '{ for (i=1;i<=NF;i+=2) print $i }')
+
+    # Use the mean intensity, the voxel size, and the number of
+    # voxels to calculate the volume of gray matter per lobule.
+    lobVols=$(
+        paste \
+            <(echo "${listMeanVal}" | tr " " "\n") \
+            <(echo "${listNumVox}" | tr " " "\n") \
+            | awk -v var=${voxS} '{ printf "%0.5f\n", $1 * $2 * var }' \
+            | head -28 \
+            | tr "\n" "," \
+            | sed 's/,$//g'
+           )
+
+    # ** Write this info out to a file
+    writeVolumes ${oDIR}/sub-${SID}_ses-${SES}_cGM.csv ${lobVols}
+
+else
+
+    # ** Remove the native space atlas of an earlier run
+    # It may not match the current registration anymore.
+    rm -f ${oDIR}/c_atlasNativeSpace.nii.gz
+
+fi
+release ${oDIR}/crop_rawavg.nii.gz
 
 
 
@@ -328,7 +454,7 @@ fi
 antsApplyTransforms \
     -d 3 \
     -i ${oDIR}/cgm.nii.gz \
-    -r ${tDIR}/Cerebellum-SUIT.nii.gz \
+    -r $(asset ${tDIR}/Cerebellum-SUIT.nii.gz) \
     -o ${oDIR}/wcgm.nii.gz \
     -t ${iDIR23}/ants_1Warp.nii.gz \
     -t ${iDIR23}/ants_0GenericAffine.mat \
@@ -357,34 +483,72 @@ fslmaths \
     ${oDIR}/wcgm.nii.gz \
     -mul ${oDIR}/Jacobian.nii.gz \
     ${oDIR}/mwcgm.nii.gz
+release ${oDIR}/Jacobian.nii.gz
+
+# * Lobule volumes in SUIT space
+# The native GM volume of a lobule is the sum over its SUIT voxels of
+# the warped GM map times the Jacobian determinant of the full
+# transformation from SUIT to native space. Unlike the Jacobian above,
+# this includes the affine parts, so the volumes are in native space
+# (mm3) like the native space extraction. The voxels of each lobule
+# are indexed once (see assets.py), so this is a gather of the lobule
+# voxels without resampling the atlas.
+if [ ${VOLUMESPACE} != "native" ]; then
+
+    # ** Jacobian determinant of the full transformation
+    # The transformations are combined into one displacement field on
+    # the SUIT grid.
+    antsApplyTransforms \
+        -d 3 \
+        -r $(asset ${tDIR}/Cerebellum-SUIT.nii.gz) \
+        -o [${oDIR}/SUIT_to_native.nii.gz,1] \
+        -t ${iDIR23}/ants_1Warp.nii.gz \
+        -t ${iDIR23}/ants_0GenericAffine.mat \
+        ${transform_FS_Long_2_ANTs_template} \
+        ${transform_FS_CS2Long} \
+        -v
+    CreateJacobianDeterminantImage \
+        3 \
+        ${oDIR}/SUIT_to_native.nii.gz \
+        ${oDIR}/JacobianFull.nii.gz
+    release ${oDIR}/SUIT_to_native.nii.gz
+
+    # ** Volumes
+    if [ ${VOLUMESPACE} = "both" ]; then
+        # Compare with the native space volumes
+        lobVols=$(python3 $(dirname $0)/suitVolumes.py \
+                          --gm ${oDIR}/wcgm.nii.gz \
+                          --jacobian ${oDIR}/JacobianFull.nii.gz \
+                          --native ${oDIR}/sub-${SID}_ses-${SES}_cGM.csv \
+                          --validation ${oDIR}/sub-${SID}_ses-${SES}_volumeValidation.csv)
+        writeVolumes ${oDIR}/sub-${SID}_ses-${SES}_cGM_SUIT.csv ${lobVols}
+    else
+        lobVols=$(python3 $(dirname $0)/suitVolumes.py \
+                          --gm ${oDIR}/wcgm.nii.gz \
+                          --jacobian ${oDIR}/JacobianFull.nii.gz)
+        writeVolumes ${oDIR}/sub-${SID}_ses-${SES}_cGM.csv ${lobVols}
+    fi
+    release ${oDIR}/JacobianFull.nii.gz
+
+fi
+release ${oDIR}/wcgm.nii.gz
 
 # 4mm FWHM smoothing for cerebellum: https://www.haririlab.com/methods/vbm.html
 # Mask (cerebellum) en Smooth de GM map
 # FWMH ~= sigma * 2.35; 4mm FWHM = sigma(4/2.35); sigma= 1.70
 fslmaths \
     ${oDIR}/mwcgm.nii.gz \
-    -mas ${tDIR}/maskSUIT.nii.gz \
+    -mas $(asset ${tDIR}/maskSUIT.nii.gz) \
     -s 1.70 \
     ${oDIR}/s4mwcgm.nii.gz
+release ${oDIR}/mwcgm.nii.gz
 
 
 
-# * Clean up intermediate files
-if [ ${INTERMEDIATE} -eq 0 ]; then
-
-    # ** Announce
-    echo "REMOVING INTERMEDIATE FILES..."
-
-    rm -vf \
-       ${oDIR}/Jacobian.nii.gz \
-       ${oDIR}/atlasNativeSpace.nii.gz \
-       ${oDIR}/mwcgm.nii.gz \
-       ${oDIR}/wcgm.nii.gz
-
-    trans=${oDIR}/sub-${SUB}_ses-${SES}_to_sub-${SUB}_ses-${SES}.long.sub-${SUB}.txt
-    if [ -f ${trans} ]; then rm -vf ${trans}; fi
-    
-fi
+# * Intermediate files
+# Intermediate files are released as soon as they have been used
+# (see above). The converted longitudinal transformation is kept,
+# because it is part of atlasTransforms.txt.
 
 exit
 
@@ -4,6 +4,12 @@
 import argparse
 import os
 import datetime
+import base64
+import functools
+import shutil
+import hashlib
+import io
+import json
 from glob import glob
 from nipype.interfaces import fsl
 from nipype.interfaces.freesurfer import MRIConvert
@@ -15,20 +21,22 @@ import re
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
+from assets import asset
 
 
-# * Input arguments
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='Cerebellar Volume Extraction Tool. Create quality '
-        'control reports. ')
+# * Environment
+tDIR = '/software/SUIT-templates'
 
-    parser.add_argument('--SID',
-                        help='Subject ID',
-                        required=True)
+# * Set number of slices to display per plane
+nX = 7
+nY = 7
+nZ = 7
+planes = ['X', 'Y', 'Z']
 
-args = parser.parse_args()
-SID = args.SID
+# * Report version
+# Part of every fingerprint (see FigureCache). Increase this when the
+# way figures are created changes, so that all figures are recreated.
+reportVersion = 1
 
 
 # * Function to compile two svg images into animations
@@ -136,112 +144,160 @@ def compileSVG(DIR, svg1, svg2, outSVG):
     # ** Clean up
     os.remove(tmpSVG)
 
+# * Figure cache
+class FigureCache:
+    """Keep track of which figures need to be (re)created.
 
-# * Date for logging
-now = datetime.datetime.now()
-now = now.isoformat()
+    Every output (a figure, a prepared image, or an HTML fragment) is
+    stored with a fingerprint of its inputs: the path, size and
+    modification time of the input files and the plotting parameters.
+    On a rerun, an output is only created again if it is missing or if
+    its fingerprint changed. The fingerprints are stored in the report
+    folder of the subject.
+    """
 
-# * Logging
-message = f"""
-##############################################################
-### Cerebellar Volume Extraction Tool (CVET)               ###
-### PART 5: Report for Quality Control                     ###
-### Start date and time: {now}        ###
-### Subject: {SID}                                     ###
-##############################################################
+    def __init__(self, oDIR):
+        self.file = oDIR + '/.cache/fingerprints.json'
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        try:
+            with open(self.file, 'r') as f:
+                self.fingerprints = json.load(f)
+        except (OSError, ValueError):
+            self.fingerprints = {}
+        self.rendered = 0
+        self.reused = 0
+
+    # ** Fingerprint of the inputs and parameters
+    @staticmethod
+    def fingerprint(inputs, params):
+        h = hashlib.sha1(repr((reportVersion, params)).encode())
+        for file in inputs:
+            stat = os.stat(file)
+            h.update(f'{file}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        return h.hexdigest()
+
+    # ** Create outputs only if their inputs changed
+    def make(self, outputs, inputs, params, create):
+        """Call 'create()' unless all 'outputs' exist and were created
+        from the same 'inputs' and 'params' before."""
+
+        key = '|'.join(outputs)
+        fingerprint = self.fingerprint(inputs, params)
+        if self.fingerprints.get(key) == fingerprint and all(os.path.exists(o) for o in outputs):
+            self.reused += 1
+            return False
+        create()
+        self.fingerprints[key] = fingerprint
+        self.save()
+        self.rendered += 1
+        return True
+
+    # ** Create an HTML fragment only if its figures changed
+    def fragment(self, name, figures, create):
+        """Return the HTML fragment 'name', created by 'create()' unless
+        the figures it shows did not change since it was created."""
+
+        oFile = os.path.dirname(self.file) + '/' + name + '.html'
+        self.make([oFile], figures, name, lambda: self._write(oFile, create()))
+        with open(oFile, 'r') as f:
+            return f.read()
+
+    @staticmethod
+    def _write(oFile, text):
+        with open(oFile, 'w') as f:
+            f.write(text)
+
+    # ** Store fingerprints
+    def save(self):
+        with open(self.file, 'w') as f:
+            json.dump(self.fingerprints, f, indent=1)
+
+
+# * Function to convert image coordinates of cut points to mm
+def cutPoints(image):
+    """Return evenly spaced cut coordinates (in mm) per plane."""
 
-"""
-print(message)
+    # ** Calculate the cut points for the screenshots
+    cut_distance_X = image.shape[0] / (nX + 1)
+    cut_distance_Y = image.shape[1] / (nY + 1)
+    cut_distance_Z = image.shape[2] / (nZ + 1)
 
-# * Environment
-iDIR2 = '/data/out/02_Template/sub-' + SID
-iDIR22 = iDIR2 + '/02_SubjectTemplate'
-iDIR23 = iDIR2 + '/03_SUITTemplate'
-iDIR3 = '/data/out/03_Segment/sub-' + SID
-iDIR4 = '/data/out/04_ApplyWarp/sub-' + SID
-oDIR = '/data/out/05_Report/sub-' + SID
-os.makedirs(oDIR, exist_ok=True)
-tDIR = '/software/SUIT-templates'
+    # ** Convert the cut distances to a list of cut points
+    cutpoints_X = [cut_distance_X * x for x in range(1, nX + 1)]
+    cutpoints_Y = [cut_distance_Y * x for x in range(1, nY + 1)]
+    cutpoints_Z = [cut_distance_Z * x for x in range(1, nZ + 1)]
 
+    # ** Convert these image coordinates to mm coordinates
+    return {
+        'X': [nilearn.image.coord_transform(x, 0, 0, image.affine)[0] for x in cutpoints_X],
+        'Y': [nilearn.image.coord_transform(0, x, 0, image.affine)[1] for x in cutpoints_Y],
+        'Z': [nilearn.image.coord_transform(0, 0, x, image.affine)[2] for x in cutpoints_Z]
+    }
 
-# * List of sessions
-SESLIST = sorted(glob(iDIR4 + '/*'))
-SESLIST = [i.split('ses-', 1)[1] for i in SESLIST]
 
+# * Function to add a row of images to the HTML report
+def imgbox(sources, header=None):
+    """Return an HTML image box with one image per source. A fingerprint
+    of each image is added to its URL, so that browsers reload images
+    that were recreated."""
 
-# * Prepare images for display
-message = f"""
-##############################################################
-### Prepare images for display                             ###
-##############################################################
+    html = ''
+    if header:
+        html = html + f"""
+    <h2>{header}</h2>"""
+    html = html + f"""
+    <div class="imgbox">
+    """
+    for src, figure in sources:
+        version = FigureCache.fingerprint([figure], None)[:8]
+        html = html + f"""
+        <img class="img" src="{src}?v={version}">
+        """
+    html = html + f"""
+    </div>
+    """
+    return html
 
-"""
-print(message)
 
-for SES in SESLIST:
+# * Mask the atlas with the GM map and vice versa
+def maskAtlas(oDIRc):
 
-    # ** Set output folder
-    oDIRc = oDIR + '/ses-' + SES
+    # ** Load data
+    gm_image = nb.load(oDIRc + '/gm.nii.gz')
+    gm_data = gm_image.get_fdata()
+    atlas_image = nb.load(oDIRc + '/atlas.nii.gz')
+    atlas_data = atlas_image.get_fdata()
+    # ** Binarize
+    gm_data_bin = (gm_data > 0).astype(np.int_)
+    atlas_data_bin = (atlas_data > 0).astype(np.int_)
+    # ** Mask
+    gm_masked = np.multiply(gm_data, atlas_data_bin)
+    atlas_masked = np.multiply(atlas_data, gm_data_bin)
+    # ** Save
+    gm_array = nb.Nifti1Image(gm_masked, gm_image.affine)
+    nb.save(gm_array, oDIRc + '/gm.nii.gz')
+    atlas_array = nb.Nifti1Image(atlas_masked, atlas_image.affine)
+    nb.save(atlas_array, oDIRc + '/atlas.nii.gz')
+
+
+# * Test if the SUIT atlas was brought into native space
+# 04_ApplyWarp.sh does not do that if the volumes are extracted in
+# SUIT space only ('--volume_space suit'). The atlas figures are left
+# out then.
+def nativeAtlas(SID, SES):
+    return os.path.isfile('/data/out/04_ApplyWarp/sub-' + SID + '/ses-' + SES + '/c_atlasNativeSpace.nii.gz')
+
+
+# * Prepare images of a session for display
+def prepareSession(SID, SES, cache):
+
+    # ** Environment
+    iDIR3 = '/data/out/03_Segment/sub-' + SID
+    iDIR4 = '/data/out/04_ApplyWarp/sub-' + SID
+    oDIRc = '/data/out/05_Report/sub-' + SID + '/ses-' + SES
     os.makedirs(oDIRc, exist_ok=True)
 
-    # ** Reortient cerebellar to standard space
-    print("Reorient cerebellar mask to standard space")
-    iFile = glob(iDIR4 + '/ses-' + SES + '/cMask*.nii.gz')
-    oFile = oDIRc + '/cMask.nii.gz'
-
-    myObject = fsl.Reorient2Std()
-    myObject.inputs.in_file = iFile[0]
-    myObject.inputs.out_file = oFile
-    results = myObject.run()
-
-    # Dilate cerebellar mask twice to make sure the entire
-    # cerebellum will be covered in the screenshots
-    print("Dilate cerebellar mask")
-    iFile = oDIRc + '/cMask.nii.gz'
-    oFile = oDIRc + '/cMask_dilM2.nii.gz'
-
-    myObject = fsl.ImageMaths(
-        in_file=iFile,
-        op_string='-dilM -dilM',
-        out_file=oFile
-    )
-    results = myObject.run()
-
-    # ** Crop the dilated cerebellar mask for display
-    print("Crop cerebellar mask to mask borders")
-
-    iFile = oDIRc + '/cMask_dilM2.nii.gz'
-    oFile = oDIRc + '/ccMask_dilM2.nii.gz'
-
-    myObject = fsl.ImageStats(
-        in_file=iFile,
-        op_string='-w',
-        terminal_output='allatonce'
-    )
-
-    results = myObject.run()
-    # ** Store parameters
-    cropParameters = results.outputs.out_stat
-    # ** Convert to integers
-    cp = [round(x) for x in cropParameters]
-
-    # ** fslroi
-    myObject = fsl.ExtractROI(
-        in_file=iFile,
-        x_min=cp[0],
-        x_size=cp[1],
-        y_min=cp[2],
-        y_size=cp[3],
-        z_min=cp[4],
-        z_size=cp[5],
-        t_min=cp[6],
-        t_size=cp[7],
-        roi_file=oFile
-    )
-
-    results = myObject.run()
-
-    # ** Reslice other images like the cropped image to match its dimensions
+    # ** Input and output images
     Ifiles = [
         iDIR3 + '/ses-' + SES + '/sub-' + SID + '_ses-' + SES + '_rawavg_N4.nii.gz',
         iDIR4 + '/ses-' + SES + '/cgm.nii.gz',
@@ -253,351 +309,306 @@ for SES in SESLIST:
         oDIRc + '/gm.nii.gz',
         oDIRc + '/atlas.nii.gz'
     ]
+    atlas = nativeAtlas(SID, SES)
+    if not atlas:
+        Ifiles = Ifiles[:2]
+        Ofiles = Ofiles[:2]
+
+    maskFile = sorted(glob(iDIR4 + '/ses-' + SES + '/cMask*.nii.gz'))[0]
+
+    def create():
 
-    for file in range(len(Ifiles)):
+        # ** Reortient cerebellar to standard space
+        print("Reorient cerebellar mask to standard space")
+        iFile = maskFile
+        oFile = oDIRc + '/cMask.nii.gz'
 
-        # ** Announce
-        print('Reslice: ' + Ifiles[file])
-        # ** Reslice
-        myObject = MRIConvert()
-        myObject.inputs.in_file = Ifiles[file]
-        myObject.inputs.out_file = Ofiles[file]
-        myObject.inputs.reslice_like = oDIRc + '/ccMask_dilM2.nii.gz'
+        myObject = fsl.Reorient2Std()
+        myObject.inputs.in_file = iFile
+        myObject.inputs.out_file = oFile
         results = myObject.run()
 
-    # Mask the atlas file with the binarized GM image and visa versa
-    # Load data
-    gm_image = nb.load(oDIRc + '/gm.nii.gz')
-    gm_data = gm_image.get_fdata()
-    atlas_image = nb.load(oDIRc + '/atlas.nii.gz')
-    atlas_data = atlas_image.get_fdata()
-    # Binarize
-    gm_data_bin = (gm_data > 0).astype(np.int_)
-    atlas_data_bin = (atlas_data > 0).astype(np.int_)
-    # Mask
-    gm_masked = np.multiply(gm_data, atlas_data_bin)
-    atlas_masked = np.multiply(atlas_data, gm_data_bin)
-    # Save
-    gm_array = nb.Nifti1Image(gm_masked, gm_image.affine)
-    nb.save(gm_array, oDIRc + '/gm.nii.gz')
-    atlas_array = nb.Nifti1Image(atlas_masked, atlas_image.affine)
-    nb.save(atlas_array, oDIRc + '/atlas.nii.gz')
+        # Dilate cerebellar mask twice to make sure the entire
+        # cerebellum will be covered in the screenshots
+        print("Dilate cerebellar mask")
+        iFile = oDIRc + '/cMask.nii.gz'
+        oFile = oDIRc + '/cMask_dilM2.nii.gz'
 
-    # ** Create 4D file from the atlas image for outline display
-    # Split atlas image
-    for i in range(1, 29):
-        izp = str(i).zfill(2)
         myObject = fsl.ImageMaths(
-            in_file=oDIRc + "/atlas.nii.gz",
-            op_string=f''' -thr {i} -uthr {i} ''',
-            out_file=oDIRc + '/lobule_' + izp + '.nii.gz'
+            in_file=iFile,
+            op_string='-dilM -dilM',
+            out_file=oFile
         )
         results = myObject.run()
-    # Merge atlas images
-    lobule_files = sorted(glob(oDIRc + '/lobule*.nii.gz'))
-    myObject = fsl.Merge()
-    myObject.inputs.in_files = lobule_files
-    myObject.inputs.dimension = 't'
-    myObject.inputs.output_type = 'NIFTI_GZ'
-    myObject.inputs.merged_file = (oDIRc + '/atlas_4D.nii.gz')
-    results = myObject.run()
-    # Remove intermediate files
-    for i in range(1, 29):
-        izp = str(i).zfill(2)
-        file = oDIRc + '/lobule_' + izp + '.nii.gz'
-        os.remove(file)
-
-
-# * Create overview of GM map for each subject/session
-message = f"""
-##############################################################
-### Create overview of GM segmentation                     ###
-##############################################################
 
-"""
-print(message)
+        # ** Crop the dilated cerebellar mask for display
+        print("Crop cerebellar mask to mask borders")
 
-# * HTML Header
-html = f"""
-<!DOCTYPE html>
-<html>
-  <head>
-    <style>
-      body, html {{
-          font-family: 'Open Sans', sans-serif;
-          padding: 3px;
-      }}
-      h1 {{
-          font-weight: 400;
-          font-size: 42px;
-          color: #414a52;
-      }}
-      h2 {{
-          margin: 0 0 20px 0;
-          font-weight: 400;
-          font-size: 30px;
-          color: #0871dc;
-      }}
-      .img {{
-          margin: 0px;
-          padding: 0%;
-          padding-bottom: -20px;
-          width: auto;
-          max-width: 100%
-      }}
-      .imgbox {{
-          resize: both;
-          overflow: auto;
-          <!-- margin-bottom: -20px; -->
-      }}
-    </style>
-    <title>CVET {SID}</title>
-  </head>
-  <body>
-    <h1><b>CVET Report for Subject {SID}</b></h1>
-"""
+        iFile = oDIRc + '/cMask_dilM2.nii.gz'
+        oFile = oDIRc + '/ccMask_dilM2.nii.gz'
 
-# * Set number of slices to display per plane
-nX = 7
-nY = 7
-nZ = 7
+        myObject = fsl.ImageStats(
+            in_file=iFile,
+            op_string='-w',
+            terminal_output='allatonce'
+        )
 
-# * Loop over all sessions
-for SES in SESLIST:
+        results = myObject.run()
+        # ** Store parameters
+        cropParameters = results.outputs.out_stat
+        # ** Convert to integers
+        cp = [round(x) for x in cropParameters]
+
+        # ** fslroi
+        myObject = fsl.ExtractROI(
+            in_file=iFile,
+            x_min=cp[0],
+            x_size=cp[1],
+            y_min=cp[2],
+            y_size=cp[3],
+            z_min=cp[4],
+            z_size=cp[5],
+            t_min=cp[6],
+            t_size=cp[7],
+            roi_file=oFile
+        )
 
-    # ** Announce
-    print('------------------- Working on session: ' + SES)
+        results = myObject.run()
+
+        # ** Reslice other images like the cropped image to match its dimensions
+        for file in range(len(Ifiles)):
+
+            # ** Announce
+            print('Reslice: ' + Ifiles[file])
+            # ** Reslice
+            myObject = MRIConvert()
+            myObject.inputs.in_file = Ifiles[file]
+            myObject.inputs.out_file = Ofiles[file]
+            myObject.inputs.reslice_like = oDIRc + '/ccMask_dilM2.nii.gz'
+            results = myObject.run()
+
+        if not atlas:
+            return
+
+        # Mask the atlas file with the binarized GM image and visa versa
+        maskAtlas(oDIRc)
+
+        # ** Create 4D file from the atlas image for outline display
+        # Split atlas image
+        for i in range(1, 29):
+            izp = str(i).zfill(2)
+            myObject = fsl.ImageMaths(
+                in_file=oDIRc + "/atlas.nii.gz",
+                op_string=f''' -thr {i} -uthr {i} ''',
+                out_file=oDIRc + '/lobule_' + izp + '.nii.gz'
+            )
+            results = myObject.run()
+        # Merge atlas images
+        lobule_files = sorted(glob(oDIRc + '/lobule*.nii.gz'))
+        myObject = fsl.Merge()
+        myObject.inputs.in_files = lobule_files
+        myObject.inputs.dimension = 't'
+        myObject.inputs.output_type = 'NIFTI_GZ'
+        myObject.inputs.merged_file = (oDIRc + '/atlas_4D.nii.gz')
+        results = myObject.run()
+        # Remove intermediate files
+        for i in range(1, 29):
+            izp = str(i).zfill(2)
+            file = oDIRc + '/lobule_' + izp + '.nii.gz'
+            os.remove(file)
+
+    # ** Only prepare the images if their input changed
+    outputs = Ofiles + [oDIRc + '/cMask.nii.gz'] + ([oDIRc + '/atlas_4D.nii.gz'] if atlas else [])
+    if not cache.make(outputs, [maskFile] + Ifiles, 'prepare', create):
+        print('Images of session ' + SES + ' did not change')
+
+
+# * Create overview of the GM map of a session
+def sessionFigures(SID, SES, cache):
 
-    # ** Export session name to HTML
-    html = html + f"""
-    <h1>Session: {SES}</h1>
-    """
     # ** Set output folder
+    oDIR = '/data/out/05_Report/sub-' + SID
     oDIRc = oDIR + '/ses-' + SES
 
     # ** Get image dimensions of T1 image
-    T1 = nb.load(oDIRc + '/T1.nii.gz')
+    T1file = oDIRc + '/T1.nii.gz'
+    T1 = nb.load(T1file)
     # Contour fix
     # remove the affine matrix because this currently results in
     # errors with nilearn.
-    T1_noAffine = nb.load(oDIRc + '/T1.nii.gz')
+    T1_noAffine = nb.load(T1file)
     T1_noAffine.set_sform(T1_noAffine.affine * np.identity(4))
 
     # ** Calculate the cut points for the screenshots
-    cut_distance_X = T1.shape[0] / (nX + 1)
-    cut_distance_Y = T1.shape[1] / (nY + 1)
-    cut_distance_Z = T1.shape[2] / (nZ + 1)
-
-    # ** Convert the cut distances to a list of cut points
-    cutpoints_X = [cut_distance_X * x for x in range(1, nX + 1)]
-    cutpoints_Y = [cut_distance_Y * x for x in range(1, nY + 1)]
-    cutpoints_Z = [cut_distance_Z * x for x in range(1, nZ + 1)]
-
-    # ** Convert these image coordinates to mm coordinates
-    cutpoints_X_mm = [nilearn.image.coord_transform(x, 0, 0, T1.affine)[0] for x in cutpoints_X]
-    cutpoints_Y_mm = [nilearn.image.coord_transform(0, x, 0, T1.affine)[1] for x in cutpoints_Y]
-    cutpoints_Z_mm = [nilearn.image.coord_transform(0, 0, x, T1.affine)[2] for x in cutpoints_Z]
+    cuts = cutPoints(T1)
 
     # ** Create screenshots
-    for plane in ['X', 'Y', 'Z']:
+    for plane in planes:
 
         # *** Announce
         print('--------------------------------------- PLANE: ' + plane)
 
         # *** T1 image
-        print('--------------------------------------- T1 image')
-        nilearn.plotting.plot_anat(
-            T1,
-            display_mode=plane.lower(),
-            cut_coords=eval('cutpoints_' + plane + '_mm'),
-            cmap='gray',
-            dim=-1,
-            output_file=oDIRc + '/T1_' + plane + '.svg'
-        )
-
-        # *** FreeSurfer Cerebellum Mask
-        print('--------------------------------------- FreeSurfer Cerebellum Mask outline')
-        CMask = nb.load(oDIRc + '/cMask.nii.gz')
-        display = plotting.plot_anat(T1, display_mode=plane.lower(), dim=-1)
-        display.add_contours(CMask, levels=[0.5], colors='r')
-        output_file = oDIRc + '/Mask_' + plane + '.svg'
-        display.savefig(output_file)
-
-        # *** Gray matter map
-        print('--------------------------------------- Gray Matter map')
-        GMimg = nb.load(oDIRc + '/gm.nii.gz')
-
-        for alpha in [0.0, 1.0]:
-            plotting.plot_stat_map(
-                GMimg,
-                bg_img=T1,
+        def T1figure():
+            print('--------------------------------------- T1 image')
+            nilearn.plotting.plot_anat(
+                T1,
                 display_mode=plane.lower(),
-                cut_coords=eval('cutpoints_' + plane + '_mm'),
-                threshold=0.05,
-                alpha=alpha,
+                cut_coords=cuts[plane],
+                cmap='gray',
                 dim=-1,
-                output_file=oDIRc + '/GM_' + plane + '_' + str(alpha) + '.svg'
+                output_file=oDIRc + '/T1_' + plane + '.svg'
             )
+        cache.make([oDIRc + '/T1_' + plane + '.svg'], [T1file],
+                   ('T1', plane, nX, nY, nZ), T1figure)
 
-        # *** Create GM animation
-        svg1 = oDIRc + '/GM_' + plane + '_0.0.svg'
-        svg2 = oDIRc + '/GM_' + plane + '_1.0.svg'
-        outSVG = oDIRc + '/GM_' + plane + '.svg'
-        compileSVG(oDIR, svg1, svg2, outSVG)
+        # *** FreeSurfer Cerebellum Mask
+        def maskFigure():
+            print('--------------------------------------- FreeSurfer Cerebellum Mask outline')
+            CMask = nb.load(oDIRc + '/cMask.nii.gz')
+            display = plotting.plot_anat(T1, display_mode=plane.lower(), dim=-1)
+            display.add_contours(CMask, levels=[0.5], colors='r')
+            output_file = oDIRc + '/Mask_' + plane + '.svg'
+            display.savefig(output_file)
+        cache.make([oDIRc + '/Mask_' + plane + '.svg'], [T1file, oDIRc + '/cMask.nii.gz'],
+                   ('Mask', plane), maskFigure)
 
-        # *** Clean up
-        os.remove(svg1)
-        os.remove(svg2)
+        # *** Gray matter map
+        def GMfigure():
+            print('--------------------------------------- Gray Matter map')
+            GMimg = nb.load(oDIRc + '/gm.nii.gz')
+
+            for alpha in [0.0, 1.0]:
+                plotting.plot_stat_map(
+                    GMimg,
+                    bg_img=T1,
+                    display_mode=plane.lower(),
+                    cut_coords=cuts[plane],
+                    threshold=0.05,
+                    alpha=alpha,
+                    dim=-1,
+                    output_file=oDIRc + '/GM_' + plane + '_' + str(alpha) + '.svg'
+                )
+
+            # *** Create GM animation
+            svg1 = oDIRc + '/GM_' + plane + '_0.0.svg'
+            svg2 = oDIRc + '/GM_' + plane + '_1.0.svg'
+            outSVG = oDIRc + '/GM_' + plane + '.svg'
+            compileSVG(oDIR, svg1, svg2, outSVG)
+
+            # *** Clean up
+            os.remove(svg1)
+            os.remove(svg2)
+        cache.make([oDIRc + '/GM_' + plane + '.svg'], [T1file, oDIRc + '/gm.nii.gz'],
+                   ('GM', plane, nX, nY, nZ, 0.05), GMfigure)
+
+        if not nativeAtlas(SID, SES):
+            continue
 
         # *** SUIT atlas Animation
-        print('--------------------------------------- SUIT Atlas (animation)')
-        atlas = nb.load(oDIRc + '/atlas.nii.gz')
-
-        for alpha in [0.0, 1.0]:
-            plotting.plot_roi(
-                atlas,
-                bg_img=T1,
-                display_mode=plane.lower(),
-                cut_coords=eval('cutpoints_' + plane + '_mm'),
-                alpha=alpha,
-                dim=-1,
-                output_file=oDIRc + '/SUIT_atlas_' + plane + '_' + str(alpha) + '.svg',
-            )
+        def atlasFigure():
+            print('--------------------------------------- SUIT Atlas (animation)')
+            atlas = nb.load(oDIRc + '/atlas.nii.gz')
+
+            for alpha in [0.0, 1.0]:
+                plotting.plot_roi(
+                    atlas,
+                    bg_img=T1,
+                    display_mode=plane.lower(),
+                    cut_coords=cuts[plane],
+                    alpha=alpha,
+                    dim=-1,
+                    output_file=oDIRc + '/SUIT_atlas_' + plane + '_' + str(alpha) + '.svg',
+                )
+
+            # *** Create SUIT animation
+            svg1 = oDIRc + '/SUIT_atlas_' + plane + '_0.0.svg'
+            svg2 = oDIRc + '/SUIT_atlas_' + plane + '_1.0.svg'
+            outSVG = oDIRc + '/SUIT_atlas_' + plane + '.svg'
+            compileSVG(oDIR, svg1, svg2, outSVG)
+
+            # *** Clean up
+            os.remove(svg1)
+            os.remove(svg2)
+        cache.make([oDIRc + '/SUIT_atlas_' + plane + '.svg'], [T1file, oDIRc + '/atlas.nii.gz'],
+                   ('SUIT_atlas', plane, nX, nY, nZ), atlasFigure)
 
-        # *** Create SUIT animation
-        svg1 = oDIRc + '/SUIT_atlas_' + plane + '_0.0.svg'
-        svg2 = oDIRc + '/SUIT_atlas_' + plane + '_1.0.svg'
-        outSVG = oDIRc + '/SUIT_atlas_' + plane + '.svg'
-        compileSVG(oDIR, svg1, svg2, outSVG)
+        # *** SUIT atlas static contours
+        def contourFigure():
+            print('--------------------------------------- SUIT Atlas (contours)')
+            atlas = nb.load(oDIRc + '/atlas_4D.nii.gz')
+            atlas.set_sform(atlas.affine * np.identity(4))
+            display = plotting.plot_prob_atlas(atlas, bg_img=T1_noAffine, dim=-1, linewidths=0.5, alpha=1, display_mode=plane.lower(),)
+            output_file = oDIRc + '/SUIT_contour_' + plane + '.svg'
+            display.savefig(output_file)
+        cache.make([oDIRc + '/SUIT_contour_' + plane + '.svg'], [T1file, oDIRc + '/atlas_4D.nii.gz'],
+                   ('SUIT_contour', plane), contourFigure)
+
+
+# * HTML for the GM map overview of a session
+def sessionHTML(SID, SES, cache):
+
+    oDIRc = '/data/out/05_Report/sub-' + SID + '/ses-' + SES
+    sections = [
+        ('T1', 'T1 overview'),
+        ('Mask', 'Cerebellum mask'),
+        ('GM', 'GM overlay'),
+        ('SUIT_atlas', 'SUIT atlas parcellation'),
+        ('SUIT_contour', None)
+    ]
+    if not nativeAtlas(SID, SES):
+        sections = sections[:3]
+    figures = [oDIRc + '/' + name + '_' + plane + '.svg' for name, _ in sections for plane in planes]
 
-        # *** Clean up
-        os.remove(svg1)
-        os.remove(svg2)
+    def create():
 
-        # *** SUIT atlas static contours
-        print('--------------------------------------- SUIT Atlas (contours)')
-        atlas = nb.load(oDIRc + '/atlas_4D.nii.gz')
-        atlas.set_sform(atlas.affine * np.identity(4))
-        display = plotting.plot_prob_atlas(atlas, bg_img=T1_noAffine, dim=-1, linewidths=0.5, alpha=1, display_mode=plane.lower(),)
-        output_file = oDIRc + '/SUIT_contour_' + plane + '.svg'
-        display.savefig(output_file)
-
-    # ** Add Screenshots to HTML: T1 images
-    html = html + f"""
-    <h2>T1 overview</h2>
-    <div class="imgbox">
-    """
-    for plane in ['X', 'Y', 'Z']:
-        html = html + f"""
-        <img class="img" src="./ses-{SES}/T1_{plane}.svg">
-        """
-    html = html + f"""
-    </div>
-    """
-    # ** Add Screenshots to HTML: FreeSurfer Cerebellum mask
-    html = html + f"""
-    <h2>Cerebellum mask</h2>
-    <div class="imgbox">
-    """
-    for plane in ['X', 'Y', 'Z']:
-        html = html + f"""
-        <img class="img" src="./ses-{SES}/Mask_{plane}.svg">
-        """
-    html = html + f"""
-    </div>
-    """
-    # ** Add Screenshots to HTML: GM overlay images
-    html = html + f"""
-    <h2>GM overlay</h2>
-    <div class="imgbox">
-    """
-    for plane in ['X', 'Y', 'Z']:
-        html = html + f"""
-        <img class="img" src="./ses-{SES}/GM_{plane}.svg">
-        """
-    html = html + f"""
-    </div>
-    """
-    # ** Add Screenshots to HTML: SUIT atlas overlay images - Animation
-    html = html + f"""
-    <h2>SUIT atlas parcellation</h2>
-    <div class="imgbox">
-    """
-    for plane in ['X', 'Y', 'Z']:
-        html = html + f"""
-        <img class="img" src="./ses-{SES}/SUIT_atlas_{plane}.svg">
-        """
-    html = html + f"""
-    </div>
-    """
-    # ** Add Screenshots to HTML: SUIT atlas overlay images - Contour
-    html = html + f"""
-    <div class="imgbox">
-    """
-    for plane in ['X', 'Y', 'Z']:
-        html = html + f"""
-        <img class="img" src="./ses-{SES}/SUIT_contour_{plane}.svg">
-        """
-    html = html + f"""
-    </div>
+        # ** Export session name to HTML
+        html = f"""
+    <h1>Session: {SES}</h1>
     """
+        # ** Add Screenshots to HTML
+        for name, header in sections:
+            html = html + imgbox(
+                [(f'./ses-{SES}/{name}_{plane}.svg', oDIRc + '/' + name + '_' + plane + '.svg')
+                 for plane in planes],
+                header)
+        return html
 
-# * Create overview of the subject template
-message = f"""
-##############################################################
-### Create overview of the Subject Template                ###
-##############################################################
+    return cache.fragment('session-' + SES, figures, create)
 
-"""
-print(message)
 
-# * Template creation
-# (only if there is more than one time point)
-if len(SESLIST) > 1:
+# * Cut points of the subject template
+def templateCuts(SID, cache):
 
-    # ** Export to HTML
-    html = html + f"""
-    <h1>Subject Template</h1>
-    """
+    # ** Environment
+    iDIR22 = '/data/out/02_Template/sub-' + SID + '/02_SubjectTemplate'
 
     # ** Create output folder
-    oDIRt = oDIR + '/template'
+    oDIRt = '/data/out/05_Report/sub-' + SID + '/template'
     os.makedirs(oDIRt, exist_ok=True)
 
     # ** Reorient template image to standard space
-    reorient = fsl.Reorient2Std()
-    reorient.inputs.in_file = iDIR22 + '/T_template0.nii.gz'
-    reorient.inputs.out_file = oDIRt + '/ro_T_template0.nii.gz'
-    ro = reorient.run()
+    def reorientTemplate():
+        reorient = fsl.Reorient2Std()
+        reorient.inputs.in_file = iDIR22 + '/T_template0.nii.gz'
+        reorient.inputs.out_file = oDIRt + '/ro_T_template0.nii.gz'
+        reorient.run()
+    cache.make([oDIRt + '/ro_T_template0.nii.gz'], [iDIR22 + '/T_template0.nii.gz'],
+               'reorient', reorientTemplate)
 
     # ** Get image dimensions of Subject Template image
     ST = nb.load(oDIRt + '/ro_T_template0.nii.gz')
 
     # ** Calculate the cut points for the screenshots
-    cut_distance_X = ST.shape[0] / (nX + 1)
-    cut_distance_Y = ST.shape[1] / (nY + 1)
-    cut_distance_Z = ST.shape[2] / (nZ + 1)
-    print(cut_distance_X)
-    print(cut_distance_Y)
-    print(cut_distance_Z)
+    cuts = cutPoints(ST)
+    print(cuts)
+    return cuts
 
-    # ** Convert the cut distances to a list of cut points
-    cutpoints_X = [cut_distance_X * x for x in range(1, nX + 1)]
-    cutpoints_Y = [cut_distance_Y * x for x in range(1, nY + 1)]
-    cutpoints_Z = [cut_distance_Z * x for x in range(1, nZ + 1)]
-    print(cutpoints_X)
-    print(cutpoints_Y)
-    print(cutpoints_Z)
 
-    # ** Convert these image coordinates to mm coordinates
-    cutpoints_X_mm = [nilearn.image.coord_transform(x, 0, 0, ST.affine)[0] for x in cutpoints_X]
-    cutpoints_Y_mm = [nilearn.image.coord_transform(0, x, 0, ST.affine)[1] for x in cutpoints_Y]
-    cutpoints_Z_mm = [nilearn.image.coord_transform(0, 0, x, ST.affine)[2] for x in cutpoints_Z]
-    print(cutpoints_X_mm)
-    print(cutpoints_Y_mm)
-    print(cutpoints_Z_mm)
+# * Create list of the subject template and all time point images
+def templateImages(SID, SESLIST):
 
-    # ** Create list of ST image and all time point images
+    iDIR22 = '/data/out/02_Template/sub-' + SID + '/02_SubjectTemplate'
     myList = [iDIR22 + '/T_template0.nii.gz']
     myFname = ['Template']
     for SES in SESLIST:
@@ -605,6 +616,21 @@ if len(SESLIST) > 1:
         myFname.append(SES)
 
     print(myList)
+    return myList, myFname
+
+
+# * Create overview of the subject template
+def templateFigures(SID, SESLIST, cache):
+
+    # ** Environment
+    oDIR = '/data/out/05_Report/sub-' + SID
+    oDIRt = oDIR + '/template'
+
+    # ** Calculate the cut points for the screenshots
+    cuts = templateCuts(SID, cache)
+
+    # ** Create list of ST image and all time point images
+    myList, myFname = templateImages(SID, SESLIST)
 
     # ** Loop over images in list
     for i in range(len(myList)):
@@ -612,229 +638,655 @@ if len(SESLIST) > 1:
         # *** Announce
         print('--------------------------------------- Template: ' + str(myFname[i]))
 
-        # *** Export to HTML
-        TP = str(myFname[i])
-        if i > 0:
-            html = html + f"""
-            <h2>Session {TP} to Subject Template</h2>
-            <div class="imgbox">
-            """
-
         # *** Create screenshots
-        for plane in ['X', 'Y', 'Z']:
+        for plane in planes:
 
-            # **** Announce
-            print('--------------------------------------- PLANE: ' + plane)
-            fileToPlot = nb.load(str(myList[i]))
+            # **** Plot image
+            def templateFigure():
+                print('--------------------------------------- PLANE: ' + plane)
+                fileToPlot = nb.load(str(myList[i]))
 
-            print(oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg')
+                print(oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg')
 
-            # **** Plot image
-            nilearn.plotting.plot_img(
-                fileToPlot,
-                display_mode=plane.lower(),
-                cut_coords=eval('cutpoints_' + plane + '_mm'),
-                cmap='gray',
-                output_file=oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg',
-                title='Session: ' + myFname[i] + '                '
-            )
+                nilearn.plotting.plot_img(
+                    fileToPlot,
+                    display_mode=plane.lower(),
+                    cut_coords=cuts[plane],
+                    cmap='gray',
+                    output_file=oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg',
+                    title='Session: ' + myFname[i] + '                '
+                )
 
-            # **** Create animations
-            if i > 0:
-
-                # ***** Combine images
-                svg1 = oDIRt + '/T_Template_' + plane + '.svg'
-                svg2 = oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg'
-                outSVG = oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg'
-                compileSVG(oDIR, svg1, svg2, outSVG)
-
-                # ***** Clean up
-                # os.remove(svg2)
-
-        # *** Export to HTML
-        if i > 0:
-            for plane in ['X', 'Y', 'Z']:
-                html = html + f"""
-                <img class="img" src="./template/T_{TP}_{plane}.svg">
-                """
-            html = html + f"""
-            </div>
-            """
-else:
-    print("Single session, no subject template was created")
+                # **** Create animations
+                if i > 0:
 
+                    # ***** Combine images
+                    svg1 = oDIRt + '/T_Template_' + plane + '.svg'
+                    svg2 = oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg'
+                    outSVG = oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg'
+                    compileSVG(oDIR, svg1, svg2, outSVG)
 
-# * Normalization from subject template to SUIT
-message = f"""
-##############################################################
-### Create overview of template normalization to SUIT      ###
-##############################################################
+            # The animations include the template figure
+            inputs = [myList[0], myList[i], oDIRt + '/ro_T_template0.nii.gz']
+            cache.make([oDIRt + '/T_' + str(myFname[i]) + '_' + plane + '.svg'], inputs,
+                       ('template', plane, myFname[i], nX, nY, nZ), templateFigure)
 
-"""
-print(message)
 
-# * Export to HTML
-html = html + f"""
-<h1>Normalization from Subject Session Space via Subject Template Space to SUIT Space</h1>
-"""
+# * HTML for the subject template overview
+def templateHTML(SID, SESLIST, cache):
 
-# * Loop over all sessions
-for SES in SESLIST:
+    oDIRt = '/data/out/05_Report/sub-' + SID + '/template'
+    figures = [oDIRt + '/T_' + SES + '_' + plane + '.svg' for SES in SESLIST for plane in planes]
 
-    # ** Announce
-    print('------------------- Working on session: ' + SES)
+    def create():
 
-    # ** Export to HTML
-    html = html + f"""
-    <h2>Session: {SES}</h2>
-    <div class="imgbox">
+        # ** Export to HTML
+        html = f"""
+    <h1>Subject Template</h1>
     """
+        for TP in SESLIST:
+            html = html + imgbox(
+                [(f'./template/T_{TP}_{plane}.svg', oDIRt + '/T_' + TP + '_' + plane + '.svg')
+                 for plane in planes],
+                f'Session {TP} to Subject Template')
+        return html
 
-    # ** Set output folder
-    oDIRc = oDIR + '/ses-' + SES
-
-    # ** Get image dimensions of T1 image
-    SUIT = nb.load(tDIR + '/SUIT.nii.gz')
+    return cache.fragment('template', figures, create)
 
-    # ** Calculate the cut points for the screenshots
-    cut_distance_X = SUIT.shape[0] / (nX + 1)
-    cut_distance_Y = SUIT.shape[1] / (nY + 1)
-    cut_distance_Z = SUIT.shape[2] / (nZ + 1)
 
-    # ** Convert the cut distances to a list of cut points
-    cutpoints_X = [cut_distance_X * x for x in range(1, nX + 1)]
-    cutpoints_Y = [cut_distance_Y * x for x in range(1, nY + 1)]
-    cutpoints_Z = [cut_distance_Z * x for x in range(1, nZ + 1)]
+# * SUIT template and its figures
+# These are the same for all subjects. They are created once per
+# process, and CVET.py creates all reports of a run in one process.
+@functools.lru_cache(maxsize=None)
+def suitTemplate():
+    SUIT = nb.load(asset(tDIR + '/SUIT.nii.gz'))
+    return SUIT, cutPoints(SUIT)
 
-    # ** Convert these image coordinates to mm coordinates
-    cutpoints_X_mm = [nilearn.image.coord_transform(x, 0, 0, SUIT.affine)[0] for x in cutpoints_X]
-    cutpoints_Y_mm = [nilearn.image.coord_transform(0, x, 0, SUIT.affine)[1] for x in cutpoints_Y]
-    cutpoints_Z_mm = [nilearn.image.coord_transform(0, 0, x, SUIT.affine)[2] for x in cutpoints_Z]
 
-    # ** Create screenshots
-    for plane in ['X', 'Y', 'Z']:
+@functools.lru_cache(maxsize=None)
+def suitFigure(plane, dpi=None, imageFormat='svg'):
+    """Return the file with the figure of the SUIT template for
+    'plane' ('XYZ' for a montage of all planes in the lite report)."""
 
-        # *** Announce
-        print('--------------------------------------- PLANE: ' + plane)
+    SUIT, cuts = suitTemplate()
+    oDIRs = '/data/out/05_Report/.cache'
+    os.makedirs(oDIRs, exist_ok=True)
+    oFile = oDIRs + '/SUIT_' + plane + '.' + imageFormat
 
-        # *** SUIT Template
-        print('--------------------------------------- T1 SUIT Template')
+    print('--------------------------------------- T1 SUIT Template')
+    if plane in planes:
         nilearn.plotting.plot_img(
             SUIT,
             display_mode=plane.lower(),
-            cut_coords=eval('cutpoints_' + plane + '_mm'),
+            cut_coords=cuts[plane],
             cmap='gray',
-            output_file=oDIRc + '/SUIT_' + plane + '.svg',
+            output_file=oFile,
             title='SUIT Template'
         )
+    else:
+        montage(oFile, lambda plane, figure, axes: plotting.plot_img(
+            SUIT, display_mode=plane.lower(), cut_coords=cuts[plane], cmap='gray',
+            figure=figure, axes=axes), dpi)
+    return oFile
 
-        # *** Subject Template normalized to SUIT space
-        print('--------------------------------------- Subject Template to SUIT Template')
-        SUB2SUIT = nb.load(iDIR23 + '/ants_warped.nii.gz')
 
-        nilearn.plotting.plot_img(
-            SUB2SUIT,
-            display_mode=plane.lower(),
-            cut_coords=eval('cutpoints_' + plane + '_mm'),
-            cmap='gray',
-            output_file=oDIRc + '/Sub2SUIT_' + plane + '.svg',
-            title='Subject warped to SUIT Template'
-        )
+# * Create overview of the normalization to SUIT of a session
+def normalizationFigures(SID, SES, cache):
 
-        # *** Create animations
-        svg1 = oDIRc + '/SUIT_' + plane + '.svg'
-        svg2 = oDIRc + '/Sub2SUIT_' + plane + '.svg'
-        outSVG = oDIRc + '/Sub2SUIT_' + plane + '_a.svg'
-        compileSVG(oDIR, svg1, svg2, outSVG)
+    # ** Environment
+    oDIR = '/data/out/05_Report/sub-' + SID
+    oDIRc = oDIR + '/ses-' + SES
+    iDIR23 = '/data/out/02_Template/sub-' + SID + '/03_SUITTemplate'
 
-        # *** Clean up
-        os.remove(svg1)
-        os.remove(svg2)
+    # ** Calculate the cut points for the screenshots
+    cuts = suitTemplate()[1]
 
-    # ** Export to HTML
-    for plane in ['X', 'Y', 'Z']:
-        html = html + f"""
-        <img class="img" src="./ses-{SES}/Sub2SUIT_{plane}_a.svg">
-        """
-    html = html + f"""
+    # ** Create screenshots
+    for plane in planes:
+
+        def normalizationFigure():
+
+            # *** Announce
+            print('--------------------------------------- PLANE: ' + plane)
+
+            # *** SUIT Template
+            shutil.copyfile(suitFigure(plane), oDIRc + '/SUIT_' + plane + '.svg')
+
+            # *** Subject Template normalized to SUIT space
+            print('--------------------------------------- Subject Template to SUIT Template')
+            SUB2SUIT = nb.load(iDIR23 + '/ants_warped.nii.gz')
+
+            nilearn.plotting.plot_img(
+                SUB2SUIT,
+                display_mode=plane.lower(),
+                cut_coords=cuts[plane],
+                cmap='gray',
+                output_file=oDIRc + '/Sub2SUIT_' + plane + '.svg',
+                title='Subject warped to SUIT Template'
+            )
+
+            # *** Create animations
+            svg1 = oDIRc + '/SUIT_' + plane + '.svg'
+            svg2 = oDIRc + '/Sub2SUIT_' + plane + '.svg'
+            outSVG = oDIRc + '/Sub2SUIT_' + plane + '_a.svg'
+            compileSVG(oDIR, svg1, svg2, outSVG)
+
+            # *** Clean up
+            os.remove(svg1)
+            os.remove(svg2)
+
+        cache.make([oDIRc + '/Sub2SUIT_' + plane + '_a.svg'],
+                   [asset(tDIR + '/SUIT.nii.gz'), iDIR23 + '/ants_warped.nii.gz'],
+                   ('Sub2SUIT', plane, nX, nY, nZ), normalizationFigure)
+
+
+# * HTML for the normalization overview of a session
+def normalizationHTML(SID, SES, cache):
+
+    oDIRc = '/data/out/05_Report/sub-' + SID + '/ses-' + SES
+    figures = [oDIRc + '/Sub2SUIT_' + plane + '_a.svg' for plane in planes]
+
+    def create():
+        return imgbox(
+            [(f'./ses-{SES}/Sub2SUIT_{plane}_a.svg', oDIRc + '/Sub2SUIT_' + plane + '_a.svg')
+             for plane in planes],
+            f'Session: {SES}')
+
+    return cache.fragment('normalization-' + SES, figures, create)
+
+
+# * Create Spaghetti Plot for ROI volumes
+def spaghettiPlot(SID, cache, oPlot, dpi=None):
+
+    # ** Environment
+    iDIR4 = '/data/out/04_ApplyWarp/sub-' + SID
+
+    # ** List all data files
+    # (the volume tables only, not the SUIT space volumes and their
+    # validation, see 04_ApplyWarp.sh)
+    searchPattern = iDIR4 + '/ses-*/sub-' + SID + '_ses-*_cGM.csv'
+    list = sorted(glob(searchPattern))
+
+    def create():
+
+        # ** Combine all data
+        data = pd.concat([pd.read_csv(f) for f in list])
+
+        # ** Initialize the figure
+        plt.style.use('seaborn-darkgrid')
+        plt.figure(figsize=(12, 12))
+
+        # ** Font size
+        plt.rcParams.update({'font.size': 9})
+
+        # ** Create a color palette
+        palette = plt.get_cmap('viridis', 33)
+
+        # ** Multiple line plot
+        num = 0
+        for column in data.drop(['SUB', 'SES'], axis=1):
+            num += 1
+
+            # *** Find the right spot on the plot
+            plt.subplot(5, 6, num)
+
+            # *** Plot the lineplot
+            plt.plot(data['SES'], data[column], marker='', color=palette(num), linewidth=1.9, alpha=0.9, label=column)
+
+            # *** Add title
+            plt.title(column, loc='left', fontsize=9, fontweight=0, color=palette(num))
+
+        # ** Improve spacing
+        plt.tight_layout()
+
+        # ** Write out graph
+        saveFigure(plt.gcf(), oPlot, dpi=dpi)
+        plt.close()
+
+    cache.make([oPlot], list, ('spaghetti', 5, 6, dpi), create)
+    return oPlot
+
+
+# * Lite report
+# Compact raster version of the report: one montage (one row per plane)
+# per figure instead of one SVG per plane, two-frame toggles instead of
+# animations, and images that are only loaded once scrolled into view.
+
+# ** Function to check if WebP images can be written
+# matplotlib only writes WebP from version 3.6 on, so WebP images are
+# rendered as PNG and converted with Pillow, which needs libwebp.
+def webpSupported():
+    try:
+        from PIL import features
+        return bool(features.check('webp'))
+    except ImportError:
+        return False
+
+
+# ** Function to save a figure
+# The format follows the file extension.
+def saveFigure(figure, oFile, **kwargs):
+    if oFile.endswith('.webp'):
+        from PIL import Image
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png', **kwargs)
+        buffer.seek(0)
+        with Image.open(buffer) as image:
+            image.save(oFile, 'WEBP', quality=90)
+    else:
+        figure.savefig(oFile, **kwargs)
+
+
+# ** Function to render a montage of all planes into one image
+def montage(oFile, plot, dpi):
+    """Render 'plot(plane, figure, axes)' for each plane into one row of
+    a single raster image. The format follows the file extension."""
+
+    figure = plt.figure(figsize=(12, 2 * len(planes)), facecolor='black')
+    for row, plane in enumerate(planes):
+        axes = [0, 1 - (row + 1) / len(planes), 1, 1 / len(planes)]
+        plot(plane, figure, axes)
+    saveFigure(figure, oFile, dpi=dpi, facecolor='black')
+    plt.close(figure)
+
+
+# ** Function to reference an image in the lite report
+def liteSource(oDIR, image, embed):
+    """Return the URL of 'image': relative to the report folder, or the
+    image itself as a data URI for a self-contained report."""
+
+    if embed:
+        with open(image, 'rb') as f:
+            data = base64.b64encode(f.read()).decode()
+        return f'data:image/{os.path.splitext(image)[1][1:]};base64,{data}'
+    version = FigureCache.fingerprint([image], None)[:8]
+    return f'./{os.path.relpath(image, oDIR)}?v={version}'
+
+
+# ** Function to add a (two-frame) image to the lite report
+def litebox(oDIR, frames, header, embed):
+    """Return an HTML box with a lazy-loaded image. With two frames,
+    clicking the image toggles between them."""
+
+    html = f"""
+    <h2>{header}</h2>"""
+    images = ''.join(f"""
+        <img class="img" loading="lazy" src="{liteSource(oDIR, frame, embed)}">"""
+                     for frame in frames)
+    if len(frames) > 1:
+        return html + f"""
+    <div class="imgbox toggle" title="Click to toggle" onclick="this.classList.toggle('on')">{images}
+    </div>
+    """
+    return html + f"""
+    <div class="imgbox">{images}
     </div>
     """
 
 
-# * Create Spaghetti Plot for ROI volumes
-message = f"""
+# ** Create the lite report of a subject
+def liteReport(SID, SESLIST, cache, dpi, imageFormat, embed):
+
+    # *** Environment
+    oDIR = '/data/out/05_Report/sub-' + SID
+    oDIRl = oDIR + '/lite'
+    os.makedirs(oDIRl, exist_ok=True)
+    iDIR23 = '/data/out/02_Template/sub-' + SID + '/03_SUITTemplate'
+    html = ''
+
+    # *** Session figures
+    for SES in SESLIST:
+
+        # **** Announce
+        print('------------------- Working on session: ' + SES)
+        html = html + f"""
+    <h1>Session: {SES}</h1>
+    """
+        oDIRc = oDIR + '/ses-' + SES
+        T1file = oDIRc + '/T1.nii.gz'
+        T1 = nb.load(T1file)
+        T1_noAffine = nb.load(T1file)
+        T1_noAffine.set_sform(T1_noAffine.affine * np.identity(4))
+        cuts = cutPoints(T1)
+        oFile = oDIRl + '/ses-' + SES + '_{}.' + imageFormat
+        params = (nX, nY, nZ, dpi)
+
+        # **** T1 image (also the first frame of the overlays)
+        cache.make([oFile.format('T1')], [T1file], ('T1', params), lambda: montage(
+            oFile.format('T1'),
+            lambda plane, figure, axes: plotting.plot_anat(
+                T1, display_mode=plane.lower(), cut_coords=cuts[plane], cmap='gray', dim=-1,
+                figure=figure, axes=axes),
+            dpi))
+
+        # **** FreeSurfer Cerebellum Mask
+        def maskPlot(plane, figure, axes):
+            display = plotting.plot_anat(
+                T1, display_mode=plane.lower(), cut_coords=cuts[plane], dim=-1,
+                figure=figure, axes=axes)
+            display.add_contours(nb.load(oDIRc + '/cMask.nii.gz'), levels=[0.5], colors='r')
+        cache.make([oFile.format('Mask')], [T1file, oDIRc + '/cMask.nii.gz'], ('Mask', params),
+                   lambda: montage(oFile.format('Mask'), maskPlot, dpi))
+
+        # **** Gray matter map
+        cache.make([oFile.format('GM')], [T1file, oDIRc + '/gm.nii.gz'], ('GM', params, 0.05), lambda: montage(
+            oFile.format('GM'),
+            lambda plane, figure, axes: plotting.plot_stat_map(
+                oDIRc + '/gm.nii.gz', bg_img=T1, display_mode=plane.lower(), cut_coords=cuts[plane],
+                threshold=0.05, dim=-1, colorbar=False, figure=figure, axes=axes),
+            dpi))
+
+        # **** HTML
+        html = html + litebox(oDIR, [oFile.format('T1')], 'T1 overview', embed)
+        html = html + litebox(oDIR, [oFile.format('Mask')], 'Cerebellum mask', embed)
+        html = html + litebox(oDIR, [oFile.format('T1'), oFile.format('GM')], 'GM overlay', embed)
+        if not nativeAtlas(SID, SES):
+            continue
+
+        # **** SUIT atlas
+        cache.make([oFile.format('SUIT_atlas')], [T1file, oDIRc + '/atlas.nii.gz'], ('SUIT_atlas', params),
+                   lambda: montage(
+                       oFile.format('SUIT_atlas'),
+                       lambda plane, figure, axes: plotting.plot_roi(
+                           oDIRc + '/atlas.nii.gz', bg_img=T1, display_mode=plane.lower(),
+                           cut_coords=cuts[plane], dim=-1, figure=figure, axes=axes),
+                       dpi))
+
+        # **** SUIT atlas contours
+        def contourPlot(plane, figure, axes):
+            atlas = nb.load(oDIRc + '/atlas_4D.nii.gz')
+            atlas.set_sform(atlas.affine * np.identity(4))
+            plotting.plot_prob_atlas(atlas, bg_img=T1_noAffine, dim=-1, linewidths=0.5, alpha=1,
+                                     display_mode=plane.lower(), figure=figure, axes=axes)
+        cache.make([oFile.format('SUIT_contour')], [T1file, oDIRc + '/atlas_4D.nii.gz'],
+                   ('SUIT_contour', params), lambda: montage(oFile.format('SUIT_contour'), contourPlot, dpi))
+
+        html = html + litebox(oDIR, [oFile.format('T1'), oFile.format('SUIT_atlas')],
+                              'SUIT atlas parcellation', embed)
+        html = html + litebox(oDIR, [oFile.format('SUIT_contour')], 'SUIT atlas contours', embed)
+
+    # *** Subject template
+    # (only if there is more than one time point)
+    if len(SESLIST) > 1:
+        html = html + f"""
+    <h1>Subject Template</h1>
+    """
+        cuts = templateCuts(SID, cache)
+        myList, myFname = templateImages(SID, SESLIST)
+        frames = []
+        for image, name in zip(myList, myFname):
+            frames.append(oDIRl + '/T_' + name + '.' + imageFormat)
+            cache.make([frames[-1]], [image, oDIR + '/template/ro_T_template0.nii.gz'],
+                       ('template', nX, nY, nZ, dpi), lambda: montage(
+                           frames[-1],
+                           lambda plane, figure, axes: plotting.plot_img(
+                               image, display_mode=plane.lower(), cut_coords=cuts[plane], cmap='gray',
+                               figure=figure, axes=axes),
+                           dpi))
+        for i in range(1, len(myList)):
+            html = html + litebox(oDIR, [frames[0], frames[i]],
+                                  f'Session {myFname[i]} to Subject Template', embed)
+
+    # *** Normalization to SUIT
+    # The subject template is normalized once, so this is shown once
+    # rather than for every session.
+    cuts = suitTemplate()[1]
+    frames = [oDIRl + '/SUIT.' + imageFormat, oDIRl + '/ants_warped.' + imageFormat]
+    cache.make([frames[0]], [asset(tDIR + '/SUIT.nii.gz')], ('SUIT', nX, nY, nZ, dpi), lambda: shutil.copyfile(
+        suitFigure(''.join(planes), dpi, imageFormat), frames[0]))
+    cache.make([frames[1]], [iDIR23 + '/ants_warped.nii.gz'], ('Sub2SUIT', nX, nY, nZ, dpi), lambda: montage(
+        frames[1],
+        lambda plane, figure, axes: plotting.plot_img(
+            iDIR23 + '/ants_warped.nii.gz', display_mode=plane.lower(), cut_coords=cuts[plane],
+            cmap='gray', figure=figure, axes=axes),
+        dpi))
+    html = html + f"""
+<h1>Normalization from Subject Template Space to SUIT Space</h1>
+"""
+    html = html + litebox(oDIR, frames, 'SUIT Template and Subject warped to SUIT Template', embed)
+
+    # *** Spaghetti plot
+    # (only if there is more than one time point)
+    if len(SESLIST) > 1:
+        oPlot = spaghettiPlot(SID, cache, oDIRl + '/ROIs_over_time.' + imageFormat, dpi)
+        html = html + f"""
+    <h1>Cerebellar Lobule Volume Changes Over Time</h1>
+    """ + litebox(oDIR, [oPlot], 'Lobule volumes per session', embed)
+
+    return html
+
+
+# * HTML Header
+def htmlHeader(SID):
+    return f"""
+<!DOCTYPE html>
+<html>
+  <head>
+    <style>
+      body, html {{
+          font-family: 'Open Sans', sans-serif;
+          padding: 3px;
+      }}
+      h1 {{
+          font-weight: 400;
+          font-size: 42px;
+          color: #414a52;
+      }}
+      h2 {{
+          margin: 0 0 20px 0;
+          font-weight: 400;
+          font-size: 30px;
+          color: #0871dc;
+      }}
+      .img {{
+          margin: 0px;
+          padding: 0%;
+          padding-bottom: -20px;
+          width: auto;
+          max-width: 100%
+      }}
+      .imgbox {{
+          resize: both;
+          overflow: auto;
+          <!-- margin-bottom: -20px; -->
+      }}
+      .toggle {{
+          cursor: pointer;
+      }}
+      .toggle .img + .img, .toggle.on .img {{
+          display: none;
+      }}
+      .toggle.on .img + .img {{
+          display: inline;
+      }}
+    </style>
+    <title>CVET {SID}</title>
+  </head>
+  <body>
+    <h1><b>CVET Report for Subject {SID}</b></h1>
+"""
+
+
+# * Create the full report of a subject
+def fullReport(SID, SESLIST, cache):
+
+    oDIR = '/data/out/05_Report/sub-' + SID
+
+    # ** Create overview of GM map for each subject/session
+    message = f"""
 ##############################################################
-### Create Spaghetti Plot for ROI volumes                  ###
+### Create overview of GM segmentation                     ###
+##############################################################
+
+"""
+    print(message)
+
+    html = ''
+
+    for SES in SESLIST:
+
+        # *** Announce
+        print('------------------- Working on session: ' + SES)
+        sessionFigures(SID, SES, cache)
+        html = html + sessionHTML(SID, SES, cache)
+
+    # ** Create overview of the subject template
+    message = f"""
+##############################################################
+### Create overview of the Subject Template                ###
 ##############################################################
 
 """
-print(message)
+    print(message)
+
+    # ** Template creation
+    # (only if there is more than one time point)
+    if len(SESLIST) > 1:
+        templateFigures(SID, SESLIST, cache)
+        html = html + templateHTML(SID, SESLIST, cache)
+    else:
+        print("Single session, no subject template was created")
+
+    # ** Normalization from subject template to SUIT
+    message = f"""
+##############################################################
+### Create overview of template normalization to SUIT      ###
+##############################################################
 
-# * Spaghetti plot
-# (only if there is more than one time point)
-if len(SESLIST) > 1:
+"""
+    print(message)
 
-    # ** Export to HTML
+    # *** Export to HTML
     html = html + f"""
+<h1>Normalization from Subject Session Space via Subject Template Space to SUIT Space</h1>
+"""
+
+    # *** Loop over all sessions
+    for SES in SESLIST:
+
+        # **** Announce
+        print('------------------- Working on session: ' + SES)
+        normalizationFigures(SID, SES, cache)
+        html = html + normalizationHTML(SID, SES, cache)
+
+    # ** Create Spaghetti Plot for ROI volumes
+    message = f"""
+##############################################################
+### Create Spaghetti Plot for ROI volumes                  ###
+##############################################################
+
+"""
+    print(message)
+
+    # *** Spaghetti plot
+    # (only if there is more than one time point)
+    if len(SESLIST) > 1:
+        oPlot = spaghettiPlot(SID, cache, oDIR + '/ROIs_over_time.svg')
+        html = html + cache.fragment('spaghetti', [oPlot], lambda: f"""
     <h1>Cerebellar Lobule Volume Changes Over Time</h1>
-    """
+    """ + imgbox([('./ROIs_over_time.svg', oPlot)]))
 
-    # ** List all data files
-    searchPattern = iDIR4 + '/**/*csv*'
-    list = sorted(glob(searchPattern))
+    return html
 
-    # ** Append all data
-    data = pd.read_csv(list[0])
-    for i in range(1, len(list)):
 
-        dataTmp = data.append(pd.read_csv(list[i]))
-        data = dataTmp
+# * Create the report of a subject
+def report(SID, mode='full', dpi=100, imageFormat='png', embed=False):
+    """Create the QC report of a subject. 'mode' is 'full' (SVG figures
+    with animations) or 'lite' (raster montages at 'dpi' in
+    'imageFormat'; 'embed' writes a single self-contained file)."""
 
-    # ** Initialize the figure
-    plt.style.use('seaborn-darkgrid')
-    plt.figure(figsize=(12, 12))
+    # ** Date for logging
+    now = datetime.datetime.now()
+    now = now.isoformat()
 
-    # ** Font size
-    plt.rcParams.update({'font.size': 9})
+    # ** Logging
+    message = f"""
+##############################################################
+### Cerebellar Volume Extraction Tool (CVET)               ###
+### PART 5: Report for Quality Control                     ###
+### Start date and time: {now}        ###
+### Subject: {SID}                                     ###
+##############################################################
 
-    # ** Create a color palette
-    palette = plt.get_cmap('viridis', 33)
+"""
+    print(message)
 
-    # ** Multiple line plot
-    num = 0
-    for column in data.drop(['SUB', 'SES'], axis=1):
-        num += 1
+    # ** Environment
+    iDIR4 = '/data/out/04_ApplyWarp/sub-' + SID
+    oDIR = '/data/out/05_Report/sub-' + SID
+    os.makedirs(oDIR, exist_ok=True)
+    cache = FigureCache(oDIR)
 
-        # *** Find the right spot on the plot
-        plt.subplot(5, 6, num)
+    # ** List of sessions
+    SESLIST = sorted(glob(iDIR4 + '/*'))
+    SESLIST = [i.split('ses-', 1)[1] for i in SESLIST]
 
-        # *** Plot the lineplot
-        plt.plot(data['SES'], data[column], marker='', color=palette(num), linewidth=1.9, alpha=0.9, label=column)
+    # ** Prepare images for display
+    message = f"""
+##############################################################
+### Prepare images for display                             ###
+##############################################################
 
-        # *** Add title
-        plt.title(column, loc='left', fontsize=9, fontweight=0, color=palette(num))
+"""
+    print(message)
 
-    # ** Improve spacing
-    plt.tight_layout()
+    for SES in SESLIST:
+        prepareSession(SID, SES, cache)
 
-    # ** Write out graph
-    oPlot = oDIR + "/ROIs_over_time.svg"
-    plt.savefig(oPlot)
+    # ** Create figures
+    if mode == 'lite':
+        html = htmlHeader(SID) + liteReport(SID, SESLIST, cache, dpi, imageFormat, embed)
+    else:
+        html = htmlHeader(SID) + fullReport(SID, SESLIST, cache)
 
-    # ** Add to html
+    # ** Close html
     html = html + f"""
-    <div class="imgbox">
-    <img class="img" src="./ROIs_over_time.svg">
-    </div>
-    """
-
-# * Close html
-html = html + f"""
   </body>
 </html>
 """
 
-# * Write out html
-webpage = open(oDIR + "/CVET_sub-" + SID + ".html", "w")
-webpage.write("%s" % html)
-webpage.close()
+    # ** Write out html
+    webpage = open(oDIR + "/CVET_sub-" + SID + ".html", "w")
+    webpage.write("%s" % html)
+    webpage.close()
+
+    # ** Summary
+    print(f'Figures created: {cache.rendered}, reused: {cache.reused}')
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Create quality '
+        'control reports. Figures are only recreated if their input '
+        'images or plotting parameters changed since the previous run. ')
+
+    parser.add_argument('--SID',
+                        help='Subject ID',
+                        required=True)
+    parser.add_argument('--mode',
+                        help='"full" creates SVG figures with animated overlays. '
+                        '"lite" creates compact raster montages (one per figure, '
+                        'all planes), shows overlays as a two-frame toggle (click '
+                        'the image), and lazy-loads images.',
+                        choices=['full', 'lite'],
+                        default='full')
+    parser.add_argument('--dpi',
+                        help='Resolution of the images of the lite report.',
+                        default=100,
+                        type=int)
+    parser.add_argument('--format',
+                        help='Image format of the lite report.',
+                        choices=['png', 'webp'],
+                        default='png')
+    parser.add_argument('--embed',
+                        help='Embed all images of the lite report in the HTML '
+                        'file, for a single self-contained file (0=no, 1=yes).',
+                        choices=[0, 1],
+                        default=0,
+                        type=int)
+
+    args = parser.parse_args()
+    if args.mode == 'lite' and args.format == 'webp' and not webpSupported():
+        parser.error('WebP images cannot be written (Pillow without WebP support). Use "--format png".')
+    report(args.SID, args.mode, args.dpi, args.format, args.embed == 1)
@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import os
+import sys
+import datetime
+import subprocess
+from glob import glob
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from volumes import readLabels, labelVolumes
+from atlasPoints import maskPoints, writePoints, readPoints, sampleLabels
+
+
+# * Environment
+iDIR2 = '/data/out/02_Template'
+iDIR4 = '/data/out/04_ApplyWarp'
+oDIR = '/data/out/06_Extract'
+
+
+# * Function to get the transformations from SUIT to native space
+def atlasTransforms(SID, SES):
+    """Return the antsApplyTransforms '-t' arguments that bring an image
+    from SUIT space into the native space of a session.
+
+    These are written to atlasTransforms.txt by 04_ApplyWarp.sh. For
+    sessions that were processed before this file existed, the
+    transformations are reconstructed the same way 04_ApplyWarp.sh does.
+    """
+
+    # ** Stored transformations
+    iFile = iDIR4 + '/sub-' + SID + '/ses-' + SES + '/atlasTransforms.txt'
+    if os.path.isfile(iFile):
+        with open(iFile, 'r') as f:
+            return f.read().split()
+
+    # ** Reconstruct
+    iDIR22 = iDIR2 + '/sub-' + SID + '/02_SubjectTemplate'
+    iDIR23 = iDIR2 + '/sub-' + SID + '/03_SUITTemplate'
+    CLIST = glob(iDIR2 + '/sub-' + SID + '/01_CerebellumMask/ses-*/sub-' + SID + '_ses-*_ccereb.nii.gz')
+    transforms = []
+    if len(CLIST) > 1:
+        FS2Long = (iDIR4 + '/sub-' + SID + '/ses-' + SES + '/sub-' + SID + '_ses-' + SES +
+                   '_to_sub-' + SID + '_ses-' + SES + '.long.sub-' + SID + '.txt')
+        Long2Template = glob(iDIR22 + '/T_sub-' + SID + '_ses-' + SES + '_ccereb*GenericAffine.mat')
+        if not os.path.isfile(FS2Long) or len(Long2Template) == 0:
+            raise FileNotFoundError('Longitudinal transformations for subject ' + SID +
+                                    ', session ' + SES + ' not found. Rerun 04_ApplyWarp.sh.')
+        transforms += ['-t', '[' + FS2Long + ',1]', '-t', '[' + Long2Template[0] + ',1]']
+    if not (os.path.isfile(iDIR23 + '/ants_0GenericAffine.mat')
+            and os.path.isfile(iDIR23 + '/ants_1InverseWarp.nii.gz')):
+        raise FileNotFoundError('Transformations to SUIT space for subject ' + SID +
+                                ' not found in ' + iDIR23 + '.')
+    transforms += ['-t', '[' + iDIR23 + '/ants_0GenericAffine.mat,1]',
+                   '-t', iDIR23 + '/ants_1InverseWarp.nii.gz']
+    return transforms
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Extract volumes '
+        'for one or more (new) atlases in SUIT space from already processed '
+        'data. The voxels of the cerebellar GM map (cgm.nii.gz) of '
+        '04_ApplyWarp.sh are moved to SUIT space once per session with the '
+        'existing transformations (as points), and the volumes of all '
+        'atlases are extracted from a single read of the GM map by looking '
+        'up the labels of these points. No registrations are rerun.')
+
+    parser.add_argument('--SID',
+                        help='Subject ID(s)',
+                        nargs='+',
+                        required=True)
+    parser.add_argument('--atlas',
+                        help='Atlas image(s) in SUIT space',
+                        nargs='+',
+                        required=True)
+    parser.add_argument('--labels',
+                        help='Label table(s), one per atlas, with an "index name" '
+                        'pair per line',
+                        nargs='+',
+                        required=True)
+
+    args = parser.parse_args()
+
+    if len(args.atlas) != len(args.labels):
+        print('Specify one label table for each atlas.')
+        sys.exit(1)
+
+
+# * Date for logging
+now = datetime.datetime.now()
+now = now.isoformat()
+
+# * Logging
+message = f"""
+##############################################################
+### Cerebellar Volume Extraction Tool (CVET)               ###
+### PART 6: Extract Volumes for Additional Atlases         ###
+### Start date and time: {now}        ###
+### Number of atlases: {len(args.atlas)}                                   ###
+##############################################################
+
+"""
+print(message)
+
+# * Atlases
+atlasNames = [os.path.basename(a).replace('.nii.gz', '').replace('.nii', '') for a in args.atlas]
+atlasLabels = [readLabels(lf) for lf in args.labels]
+# The atlases are read once, for all sessions
+atlasImages = []
+for atlas in args.atlas:
+    image = nb.load(atlas)
+    atlasImages.append(nb.Nifti1Image(np.rint(image.get_fdata(dtype=np.float32)).astype(np.int32),
+                                      image.affine))
+rows = {name: [] for name in atlasNames}
+
+# * Loop over subjects and sessions
+for SID in args.SID:
+
+    SESLIST = sorted(glob(iDIR4 + '/sub-' + SID + '/ses-*'))
+    SESLIST = [i.split('ses-', 1)[1] for i in SESLIST]
+
+    for SES in SESLIST:
+
+        # ** Announce
+        print('Working on: Subject ' + SID + ', Session ' + SES)
+
+        # ** GM map
+        gmFile = iDIR4 + '/sub-' + SID + '/ses-' + SES + '/cgm.nii.gz'
+        if not os.path.isfile(gmFile):
+            print('No cerebellar GM map found for subject ' + SID + ', session ' + SES + '. Skip.')
+            continue
+        gmImage = nb.load(gmFile)
+        gmData = gmImage.get_fdata(dtype=np.float32)
+        voxelVolume = float(np.prod(gmImage.header.get_zooms()[:3]))
+
+        # ** Transformations
+        # A session without (reconstructable) transformations is
+        # skipped, the other sessions are still extracted.
+        try:
+            transforms = atlasTransforms(SID, SES)
+        except FileNotFoundError as err:
+            print(str(err) + ' Skip subject ' + SID + ', session ' + SES + '.')
+            continue
+
+        # ** Output folder
+        oDIRs = oDIR + '/sub-' + SID + '/ses-' + SES
+        os.makedirs(oDIRs, exist_ok=True)
+
+        # ** Move the GM voxels to SUIT space
+        # Only voxels with GM contribute to the volumes. They are
+        # transformed once (as points) for all atlases, see
+        # atlasPoints.py.
+        gmVoxels, gmPoints = maskPoints(gmImage)
+        gmValues = gmData[tuple(gmVoxels.T)]
+        writePoints(oDIRs + '/gmPoints.csv', gmPoints)
+        subprocess.run(['antsApplyTransformsToPoints',
+                        '-d', '3',
+                        '-i', oDIRs + '/gmPoints.csv',
+                        '-o', oDIRs + '/gmPoints_SUIT.csv']
+                       + transforms,
+                       check=True)
+        suitPoints = readPoints(oDIRs + '/gmPoints_SUIT.csv')
+        os.remove(oDIRs + '/gmPoints.csv')
+        os.remove(oDIRs + '/gmPoints_SUIT.csv')
+
+        # ** Loop over atlases
+        for atlasImage, name, labels in zip(atlasImages, atlasNames, atlasLabels):
+
+            # *** Labels of the GM voxels
+            gmLabels = sampleLabels(atlasImage, suitPoints)
+
+            # *** Atlas in native space (on the GM voxels)
+            atlasData = np.zeros(gmData.shape[:3], dtype=np.int32)
+            atlasData[tuple(gmVoxels.T)] = gmLabels
+            nb.save(nb.Nifti1Image(atlasData, gmImage.affine),
+                    oDIRs + '/' + name + 'NativeSpace.nii.gz')
+
+            # *** Volumes
+            volumes = labelVolumes(gmLabels, gmValues, voxelVolume, [i for i, _ in labels])
+            rows[name].append([SID, SES] + ['%0.5f' % v for v in volumes])
+
+
+# * Write out one file per atlas
+# Rows of subjects that were processed again replace earlier rows.
+for name, labels in zip(atlasNames, atlasLabels):
+
+    oFile = oDIR + '/' + name + '.csv'
+    data = pd.DataFrame(rows[name], columns=['SUB', 'SES'] + [n for _, n in labels], dtype=str)
+    if os.path.isfile(oFile):
+        previous = pd.read_csv(oFile, dtype=str)
+        previous = previous[~previous['SUB'].isin(data['SUB'])]
+        data = pd.concat([previous, data])
+    data.sort_values(['SUB', 'SES']).to_csv(oFile, index=False)
+    print('Volumes written to: ' + oFile)
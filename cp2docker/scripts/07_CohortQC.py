@@ -0,0 +1,276 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import os
+import sys
+import datetime
+import fnmatch
+import html
+import io
+import json
+from glob import glob
+import h5py
+import numpy as np
+import pandas as pd
+import bundle
+
+
+# * Environment
+iDIR4 = '/data/out/04_ApplyWarp'
+oDIR = '/data/out/07_CohortQC'
+
+# * Columns of the volume tables that are not lobules
+ICVcolumns = ['ANTsICV', 'SPMICV', 'ANTsFSICV']
+otherColumns = ['SUB', 'SES', 'eTIV'] + ICVcolumns
+
+
+# * Function to load the volume tables of all sessions
+def loadVolumes(SUBLIST=None):
+    """Return one data frame with the volume table (cGM.csv) of every
+    session of the subjects in 'SUBLIST' (all subjects if None),
+    sorted by subject and session. The tables of subjects whose output
+    was packed (see bundle.py) are read from their bundle."""
+
+    def selected(file):
+        return SUBLIST is None or os.path.basename(file).split('.')[0][4:] in SUBLIST
+
+    files = [f for f in sorted(glob(iDIR4 + '/sub-*')) if selected(f)]
+    tables = [pd.read_csv(f, dtype={'SUB': str, 'SES': str})
+              for d in files for f in sorted(glob(d + '/ses-*/sub-*_ses-*_cGM.csv'))]
+    unpacked = [os.path.basename(d) for d in files]
+    for b in sorted(glob(bundle.BUNDLES + '/sub-*.h5')):
+        if not selected(b) or os.path.basename(b)[:-3] in unpacked:
+            continue
+        with h5py.File(b, 'r') as h5:
+            for entry in json.loads(h5['manifest'][()]):
+                if fnmatch.fnmatch(entry['path'], '04_ApplyWarp/sub-*/ses-*/sub-*_ses-*_cGM.csv'):
+                    tables.append(pd.read_csv(io.BytesIO(h5[entry['path']][()].tobytes()),
+                                              dtype={'SUB': str, 'SES': str}))
+    if not tables:
+        return pd.DataFrame(columns=['SUB', 'SES'])
+    data = pd.concat(tables, ignore_index=True)
+    return data.sort_values(['SUB', 'SES']).reset_index(drop=True)
+
+
+# * Function to calculate the QC measures
+def measures(data):
+    """Return three data frames (volumes, ICV ratios, longitudinal
+    changes) with one row per session.
+
+    Volumes are the lobules and their total. The ICV ratios are the
+    total cerebellar GM and the ICV of the segmentation (ANTs or SPM)
+    relative to FreeSurfer's eTIV. Changes are relative to the previous
+    session of the same subject (NaN for the first session)."""
+
+    lobules = [c for c in data.columns if c not in otherColumns]
+    volumes = data[lobules].astype(float)
+    volumes['Total'] = volumes.sum(axis=1)
+
+    ratios = pd.DataFrame(index=data.index)
+    eTIV = data['eTIV'].astype(float) if 'eTIV' in data else pd.Series(np.nan, index=data.index)
+    ratios['Total/eTIV'] = volumes['Total'] / eTIV
+    ICV = pd.Series(np.nan, index=data.index)
+    for column in ICVcolumns:
+        if column in data:
+            ICV = ICV.fillna(data[column].astype(float))
+    ratios['ICV/eTIV'] = ICV / eTIV
+
+    previous = volumes.groupby(data['SUB']).shift()
+    changes = volumes / previous - 1
+    changes.columns = ['Change ' + c for c in changes.columns]
+
+    return volumes, ratios, changes
+
+
+# * Function to calculate robust z-scores
+def robustZ(values):
+    """Return the robust z-scores of each column: the distance to the
+    median in units of the scaled median absolute deviation (which
+    equals the standard deviation for normally distributed data).
+    Columns without spread get NaN."""
+
+    median = values.median()
+    mad = (values - median).abs().median() * 1.4826
+    return (values - median) / mad.where(mad > 0)
+
+
+# * Function to summarise the flags of each session
+def summary(data, z, threshold):
+    """Return one row per session with the number of flagged measures
+    (|z| > threshold), the largest |z| and the measures with the
+    largest |z|, sorted by the largest |z|."""
+
+    absZ = z.abs()
+    flags = absZ > threshold
+    table = data[['SUB', 'SES']].copy()
+    table['Flags'] = flags.sum(axis=1)
+    table['Max |z|'] = absZ.max(axis=1)
+    # The three measures with the largest |z| of each session
+    order = np.argsort(-absZ.fillna(0).to_numpy(), axis=1)[:, :3]
+    names = np.asarray(z.columns)[order]
+    values = np.take_along_axis(z.to_numpy(), order, axis=1)
+    table['Worst'] = ['; '.join(f'{n} ({v:+.1f})' for n, v in zip(rowNames, rowValues) if np.isfinite(v))
+                      for rowNames, rowValues in zip(names, values)]
+    for column in ['Total', 'Total/eTIV', 'ICV/eTIV', 'Change Total']:
+        table['z ' + column] = z[column]
+    return table.sort_values('Max |z|', ascending=False, na_position='last')
+
+
+# * Function to create the dashboard
+def dashboard(table, threshold, nSessions):
+    """Return the HTML of a sortable table of all sessions that links
+    to the report of each subject."""
+
+    def cell(value):
+        if isinstance(value, float):
+            if not np.isfinite(value):
+                return '<td data-v="">-</td>'
+            flag = ' class="flag"' if value > threshold or value < -threshold else ''
+            return f'<td data-v="{value:.6g}"{flag}>{value:.2f}</td>'
+        return f'<td data-v="{html.escape(str(value))}">{html.escape(str(value))}</td>'
+
+    header = ''.join(f'<th onclick="sortTable({n})">{html.escape(c)}</th>'
+                     for n, c in enumerate(['Report'] + list(table.columns)))
+    rows = []
+    for row in table.itertuples(index=False):
+        SID = row.SUB
+        link = f'../05_Report/sub-{html.escape(SID)}/CVET_sub-{html.escape(SID)}.html'
+        flagged = ' class="flagged"' if row.Flags > 0 else ''
+        rows.append(f'<tr{flagged}><td data-v="{html.escape(SID)}"><a href="{link}">open</a></td>'
+                    + ''.join(cell(float(v) if isinstance(v, (float, np.floating)) else v) for v in row)
+                    + '</tr>')
+
+    nFlagged = int((table['Flags'] > 0).sum())
+    return f"""
+<!DOCTYPE html>
+<html>
+  <head>
+    <style>
+      body, html {{
+          font-family: 'Open Sans', sans-serif;
+          padding: 3px;
+      }}
+      h1 {{
+          font-weight: 400;
+          font-size: 42px;
+          color: #414a52;
+      }}
+      table {{
+          border-collapse: collapse;
+          font-size: 13px;
+      }}
+      th {{
+          cursor: pointer;
+          position: sticky;
+          top: 0;
+          background: #0871dc;
+          color: white;
+          padding: 4px 8px;
+      }}
+      td {{
+          padding: 2px 8px;
+          border-bottom: 1px solid #dddddd;
+      }}
+      td.flag {{
+          background: #f6c4c4;
+      }}
+      .hide tbody tr:not(.flagged) {{
+          display: none;
+      }}
+    </style>
+    <script>
+      function sortTable(n) {{
+          var body = document.getElementById('sessions').tBodies[0];
+          var rows = Array.from(body.rows);
+          var descending = body.dataset.column == n && body.dataset.order != 'desc';
+          rows.sort(function(a, b) {{
+              var x = a.cells[n].dataset.v, y = b.cells[n].dataset.v;
+              if (x === '') return 1;
+              if (y === '') return -1;
+              var d = (isNaN(x) || isNaN(y)) ? x.localeCompare(y) : x - y;
+              return descending ? -d : d;
+          }});
+          rows.forEach(function(row) {{ body.appendChild(row); }});
+          body.dataset.column = n;
+          body.dataset.order = descending ? 'desc' : 'asc';
+      }}
+    </script>
+    <title>CVET Cohort QC</title>
+  </head>
+  <body>
+    <h1><b>CVET Cohort Quality Control</b></h1>
+    <p>{nSessions} sessions, {nFlagged} with at least one robust z-score beyond &plusmn;{threshold}
+      (volumes per lobule, ICV ratios, and changes since the previous session).
+      Click a column to sort. All z-scores are in CVET_cohortQC.csv. The reports of
+      subjects whose output was packed are restored with
+      <code>bundle.py extract bundles/sub-&lt;label&gt;.h5 --include '05_Report/*'</code>.</p>
+    <p><label><input type="checkbox" onclick="document.getElementById('sessions').classList.toggle('hide', this.checked)">
+      Only show flagged sessions</label></p>
+    <table id="sessions">
+      <thead><tr>{header}</tr></thead>
+      <tbody>
+{chr(10).join(rows)}
+      </tbody>
+    </table>
+  </body>
+</html>
+"""
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Cohort quality '
+        'control: robust z-scores of the lobule volumes, the ICV ratios and '
+        'the longitudinal changes of all sessions, written to a table and '
+        'a sortable dashboard that links to the report of each subject.')
+
+    parser.add_argument('--SID',
+                        help='Subject ID(s). All processed subjects by default.',
+                        nargs='+')
+    parser.add_argument('--threshold',
+                        help='Flag sessions with an absolute robust z-score above '
+                        'this value.',
+                        default=3.5,
+                        type=float)
+
+    args = parser.parse_args()
+
+    # * Date for logging
+    now = datetime.datetime.now()
+    now = now.isoformat()
+
+    # * Logging
+    message = f"""
+##############################################################
+### Cerebellar Volume Extraction Tool (CVET)               ###
+### PART 7: Cohort Quality Control                         ###
+### Start date and time: {now}        ###
+##############################################################
+
+"""
+    print(message)
+
+    # * Load all volume tables
+    data = loadVolumes(args.SID)
+    if data.empty:
+        print('No volume tables found in ' + iDIR4 + '. Run the participant level first.')
+        sys.exit(1)
+    print(f'Loaded {len(data)} sessions of {data["SUB"].nunique()} subjects')
+
+    # * Robust z-scores
+    volumes, ratios, changes = measures(data)
+    z = robustZ(pd.concat([volumes, ratios, changes], axis=1))
+
+    # * Write out
+    os.makedirs(oDIR, exist_ok=True)
+    oFile = oDIR + '/CVET_cohortQC.csv'
+    pd.concat([data[['SUB', 'SES']], z.add_prefix('z ')], axis=1).to_csv(oFile, index=False, float_format='%0.4f')
+    print('Robust z-scores written to: ' + oFile)
+
+    table = summary(data, z, args.threshold)
+    oHTML = oDIR + '/CVET_cohort.html'
+    with open(oHTML, 'w') as f:
+        f.write(dashboard(table, args.threshold, len(data)))
+    print(f'{int((table["Flags"] > 0).sum())} flagged sessions. Dashboard written to: ' + oHTML)
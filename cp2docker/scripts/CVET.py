@@ -4,9 +4,58 @@
 import sys
 import argparse
 import os
+import queue
+import contextlib
+import csv
+import concurrent.futures
+import importlib.util
+import multiprocessing
+import traceback
+import shutil
 import subprocess
+import threading
+import time
 from glob import glob
 
+# * Report worker
+# Creates the QC reports of the subjects it receives over 'queue' (see
+# '* Report worker' below). It is defined at module level, so that it
+# can be started in a new (spawned) process; everything it needs is
+# passed explicitly. 'cpus' is the CPU affinity (None to keep it),
+# 'env' the thread budget and 'options' the arguments of report().
+def report_worker(queue, scriptsDir, cpus, env, options, pack):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    os.environ.update(env)
+    sys.path.insert(0, scriptsDir)
+    spec = importlib.util.spec_from_file_location('report', scriptsDir + '/05_Report.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    failed = []
+    for SID, log in iter(queue.get, None):
+        with open(log, 'w') as reportoutput, \
+             contextlib.redirect_stdout(reportoutput), \
+             contextlib.redirect_stderr(reportoutput):
+            try:
+                module.report(SID, *options)
+            except Exception:
+                traceback.print_exc()
+                failed.append(SID)
+        # The output is packed once the report, its last reader,
+        # is done (the report log is packed as well).
+        if pack:
+            try:
+                import bundle
+                print('Bundle written to: ' + bundle.pack(SID, remove=True))
+            except Exception:
+                traceback.print_exc()
+                failed.append(SID)
+    for SID in failed:
+        print('Quality control report failed for subject ' + SID + '. See: '
+              '/data/out/05_Report/sub-' + SID + '/sub-' + SID + '_log-05-QC_Report.txt')
+    sys.exit(1 if failed else 0)
+
+
 # * Gather arguments
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -24,10 +73,14 @@ if __name__ == "__main__":
     parser.add_argument('out_dir',
                         help='Results are put into {out_dir}/CVET.')
     parser.add_argument('analysis_level',
-                        help='Processing stage to be run, '
-                        'only "participant" in the case of the Cerebellar '
-                        ' Volume Extraction Tool (see BIDS-Apps specification). ',
-                        choices=['participant'])
+                        help='Processing stage to be run: "participant" runs the '
+                        'Cerebellar Volume Extraction Tool (see BIDS-Apps specification). '
+                        '"extract" extracts volumes for additional atlases (see "--atlas") '
+                        'from data that was already processed at the participant level, '
+                        'without rerunning any registration. "group" creates a '
+                        'quality control dashboard of the whole cohort (see '
+                        '"--qc_threshold") from the participant level output.',
+                        choices=['participant', 'extract', 'group'])
 
     parser.add_argument('--participant_label',
                         help='The label of the participant that should be analyzed. The label '
@@ -54,8 +107,11 @@ if __name__ == "__main__":
                         type=int)
     parser.add_argument('--segment',
                         help="Select which algorithm to use for tissue class segmentation: "
-                        "ANTs Atropos (default), or SPM12.",
-                        choices=['A', 'S'],
+                        "ANTs Atropos (default), SPM12, or ANTs Atropos with tissue priors "
+                        "from FreeSurfer's segmentation (F). F does not need the "
+                        "registration of the tissue priors from MNI space, the most "
+                        "time-consuming step of the segmentation.",
+                        choices=['A', 'S', 'F'],
                         default='A')
     parser.add_argument('--suitmask',
                         help="Use SUIT instead of FreeSurfer (default) to create the "
@@ -75,19 +131,184 @@ if __name__ == "__main__":
                         default=0,
                         type=int)
     parser.add_argument('--n_cpus',
-                        help='Number of CPUs/cores available to use.',
-                        default=1,
+                        help='Number of CPUs/cores available to use. By default, '
+                        'the CPUs this process may run on (CPU affinity) are used, '
+                        'limited by the CPU quota of the container (cgroup), if any. '
+                        'All tools (ITK/ANTs, FreeSurfer/OpenMP, FSL, MKL/OpenBLAS, '
+                        'MATLAB) use this number of threads.',
+                        type=int)
+    parser.add_argument('--pin_cpus',
+                        help='Pin the processing stages and the quality control '
+                        'report, which runs concurrently with the next subject, to '
+                        'disjoint sets of CPUs. Without "--n_cpus", one CPU is kept '
+                        'for the report.',
+                        choices=[0, 1],
+                        default=0,
                         type=int)
     parser.add_argument('--intermediate_files',
                         help='How to handle intermediate files (0=delete, 1=keep)',
                         choices=[0, 1],
                         default=1,
                         type=int)
+    parser.add_argument('--scratch_budget',
+                        help='Disk space (in GB) that may be used on the file system '
+                        'of /data. Before a subject is started, CVET waits until the '
+                        'current usage plus the peak usage of a subject (measured on '
+                        'earlier subjects) fits within this budget. The default (0) '
+                        'does not limit disk usage.',
+                        default=0,
+                        type=float)
+    parser.add_argument('--preflight',
+                        help='Before any processing starts, check that all input files '
+                        'the stages need (given the chosen options) exist and have '
+                        'readable image headers, for all subjects and sessions. The '
+                        'result is written to /data/out/CVET_preflight.csv. "fail" '
+                        '(default) stops if any subject has a problem, "skip" only '
+                        'processes the subjects without problems, "off" does not check.',
+                        choices=['fail', 'skip', 'off'],
+                        default='fail')
+    parser.add_argument('--prefetch',
+                        help='Number of subjects for which the input data (BIDS T1w '
+                        'images, or the FreeSurfer files used by CVET with '
+                        '"--freesurfer 1") is copied to /data/tmp ahead of time, in '
+                        'the background while the current subject is processed. Use '
+                        'this when the input lives on a slow (network) file system. '
+                        'The default (0) reads the input directly. Not used with '
+                        '"--freesurfer 1 --makelocalcopy 1", which copies the '
+                        'FreeSurfer subjects itself.',
+                        default=0,
+                        type=int)
     parser.add_argument('--report',
-                        help='Generate a report for quality control of the data processing')
+                        help='Type of report for quality control of the data processing. '
+                        '"full" (default) shows SVG figures with animated overlays. "lite" '
+                        'shows compact raster montages with overlays as a two-frame '
+                        'toggle, and loads images only once they are scrolled into view. '
+                        'This is much faster to open over a slow connection.',
+                        choices=['full', 'lite'],
+                        default='full')
+    parser.add_argument('--report_dpi',
+                        help='Resolution of the images of the lite report.',
+                        default=100,
+                        type=int)
+    parser.add_argument('--report_format',
+                        help='Image format of the lite report. "webp" needs Pillow '
+                        'with WebP support.',
+                        choices=['png', 'webp'],
+                        default='png')
+    parser.add_argument('--report_embed',
+                        help='Embed all images of the lite report in its HTML file, '
+                        'to create a single self-contained file per subject.',
+                        choices=[0, 1],
+                        default=0,
+                        type=int)
     parser.add_argument('--biasfieldcorrection',
                         help='Perform N4 non-uniformity correction of the T1 image '
-                        'as an initial procesing step.',
+                        'as an initial procesing step. The segmentation then uses '
+                        'the corrected image without a second correction.',
+                        choices=[0, 1],
+                        default=0,
+                        type=int)
+    parser.add_argument('--registration_preset',
+                        help='Multi-resolution schedule of the ANTs SyN registrations '
+                        '(subject template to SUIT, MNI to session). "fast" uses coarser '
+                        'pyramids and fewer iterations, trading some precision for '
+                        'speed, and is meant for pilot runs '
+                        'and large screening cohorts; "accurate" adds an extra coarse '
+                        'SyN level, more SyN iterations with a tighter convergence, and '
+                        'a denser metric sampling. The schedules are '
+                        'defined in registration.sh; benchmarkRegistration.py measures '
+                        'their runtime and Dice overlap on your own data.',
+                        choices=['fast', 'standard', 'accurate'],
+                        default='standard')
+    parser.add_argument('--init_cache',
+                        help='Start the registration of each subject template to SUIT '
+                        'from the average affine transform of the subjects that '
+                        'already completed with the same protocol or site, instead of '
+                        'from the centers of mass. "protocol" groups subjects by the '
+                        'scanner fields of the JSON sidecar of their first T1-weighted '
+                        'image (Manufacturer, ManufacturersModelName, '
+                        'MagneticFieldStrength, SeriesDescription); any other value is '
+                        'a column of participants.tsv (e.g., "site"). The cache is '
+                        'stored in initCache and updated as subjects complete.',
+                        default='off')
+    parser.add_argument('--init_cache_min',
+                        help='Number of subjects in the cache of a protocol or site '
+                        'before "--init_cache" is used.',
+                        default=3,
+                        type=int)
+    parser.add_argument('--template_convergence',
+                        help='Stop building the subject template once it changes less '
+                        'than this threshold between two iterations, measured as '
+                        '1 - normalized cross correlation between successive templates '
+                        '(e.g., 0.001). The change per iteration is logged to '
+                        'template_convergence.csv. The default (0) runs all iterations.',
+                        default=0,
+                        type=float)
+    parser.add_argument('--crop_margin',
+                        help='Run the per-session steps after segmentation (atlas '
+                        'warp, masking, volume extraction) on a grid that is cropped '
+                        'to the bounding box of the cerebellum mask plus this margin '
+                        '(in voxels). Results stay in native space. The default (-1) '
+                        'uses the full native image grid.',
+                        default=-1,
+                        type=int)
+    parser.add_argument('--volume_space',
+                        help='Where to extract the lobule volumes. "native" (default) '
+                        'brings the SUIT atlas into the native space of each session. '
+                        '"suit" sums the GM map in SUIT space, weighted by the Jacobian '
+                        'determinant of the full (affine and non-linear) transformation, '
+                        'over the voxels of each lobule; the atlas is not resampled, and '
+                        'the report does not show the atlas in native space. "both" '
+                        'writes the SUIT space volumes to *_cGM_SUIT.csv and a comparison '
+                        'with the native space volumes to *_volumeValidation.csv.',
+                        choices=['native', 'suit', 'both'],
+                        default='native')
+    parser.add_argument('--atlas_sampling',
+                        help='How the SUIT atlas is brought into native space. "image" '
+                        '(default) resamples the atlas onto the whole native grid and '
+                        'masks it with the cerebellum mask. "points" only transforms '
+                        'the voxels inside the cerebellum mask to SUIT space (with '
+                        'antsApplyTransformsToPoints) and looks up their labels, so '
+                        'the work scales with the size of the cerebellum rather than '
+                        'the field of view.',
+                        choices=['image', 'points'],
+                        default='image')
+    parser.add_argument('--atlas',
+                        help='Atlas image(s) in SUIT space for the "extract" analysis '
+                        'level. Volumes of all atlases are extracted in a single pass '
+                        'and written to one file per atlas in 06_Extract.',
+                        nargs='+')
+    parser.add_argument('--labels',
+                        help='Label table(s) for the atlases of "--atlas" (same order), '
+                        'with an "index name" pair per line.',
+                        nargs='+')
+    parser.add_argument('--qc_threshold',
+                        help='For the "group" analysis level: flag sessions with a '
+                        'robust z-score (median and median absolute deviation of '
+                        'the cohort) of a lobule volume, an ICV ratio, or the change '
+                        'since the previous session above this value.',
+                        default=3.5,
+                        type=float)
+    parser.add_argument('--incremental',
+                        help='Only process what changed since a previous run into the '
+                        'same output folder, e.g., when a new session was added for a '
+                        'subject. Sessions that were already processed by FreeSurfer '
+                        'are kept (new sessions are added to the existing FreeSurfer '
+                        'base), existing segmentations are kept, and the subject '
+                        'template and warp to SUIT space are warm-started from the '
+                        'previous results.',
+                        choices=[0, 1],
+                        default=0,
+                        type=int)
+    parser.add_argument('--bundle',
+                        help='Pack the output of each subject (02_Template, 03_Segment, '
+                        '04_ApplyWarp, 05_Report) into one HDF5 file, '
+                        'bundles/sub-<label>.h5, once its report is done, and remove '
+                        'the packed folders. This saves hundreds of files per subject '
+                        'on parallel file systems. Images can be read from a bundle '
+                        'directly, and "bundle.py extract" restores the original '
+                        'layout. Bundles are unpacked when needed ("--incremental", '
+                        '"extract" analysis level).',
                         choices=[0, 1],
                         default=0,
                         type=int)
@@ -95,6 +316,19 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # * Parse arguments
+    # Report format
+    # WebP images are converted with Pillow (see 05_Report.py), which
+    # needs to be built with WebP support.
+    if args.report == 'lite' and args.report_format == 'webp':
+        try:
+            from PIL import features
+            webp = features.check('webp')
+        except ImportError:
+            webp = False
+        if not webp:
+            parser.error('WebP images cannot be written (Pillow without WebP support). '
+                         'Use "--report_format png".')
+
     # FreeSurfer
     # If '--freesurfer' has been set to 1 (previously processed data),
     # check if there is any data in the specified folder.
@@ -116,6 +350,65 @@ if __name__ == "__main__":
     if args.freesurfer == 0:
         FSOPT = 1
 
+    # CPUs
+    # Usable CPUs are those in the CPU affinity mask of this process,
+    # limited by the CPU quota of the container (cgroup v2 cpu.max or
+    # cgroup v1 cpu.cfs_quota_us). A fractional quota is rounded down
+    # to avoid throttling.
+    def usable_cpus():
+        cpus = len(os.sched_getaffinity(0))
+        for quotaFile, periodFile in [('/sys/fs/cgroup/cpu.max', None),
+                                      ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us',
+                                       '/sys/fs/cgroup/cpu/cpu.cfs_period_us')]:
+            try:
+                with open(quotaFile, 'r') as f:
+                    quota = f.read().split()
+                if periodFile:
+                    with open(periodFile, 'r') as f:
+                        quota.append(f.read().strip())
+                if quota[0] not in ['max', '-1']:
+                    cpus = min(cpus, max(1, int(quota[0]) // int(quota[1])))
+                break
+            except (OSError, ValueError, IndexError):
+                continue
+        return cpus
+
+    CPUSET = sorted(os.sched_getaffinity(0))
+    if args.n_cpus is None:
+        args.n_cpus = usable_cpus()
+        if args.pin_cpus == 1 and args.n_cpus > 1:
+            args.n_cpus -= 1
+        print('Number of CPUs: ' + str(args.n_cpus))
+
+    # Pinning
+    # The stages run on the first '--n_cpus' CPUs, the report on the
+    # remaining ones (or on the same CPUs if there are none left).
+    # Without pinning, the report shares the CPUs of the stages of the
+    # next subject, so it only gets a quarter of the thread budget.
+    REPORTCPUS = max(1, args.n_cpus // 4)
+    if args.pin_cpus == 1:
+        stageCPUs = CPUSET[:args.n_cpus]
+        reportCPUs = CPUSET[args.n_cpus:] or stageCPUs
+        os.sched_setaffinity(0, stageCPUs)
+        REPORTCPUS = len(reportCPUs)
+
+    # * Thread budget
+    # Every tool family gets the same number of threads, so that none
+    # of them starts one thread per core of the node. CVET_NUM_THREADS
+    # is used for MATLAB's maxNumCompThreads in the SPM batches.
+    def thread_env(n):
+        return {name: str(n) for name in [
+            'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+            'OMP_NUM_THREADS',
+            'MKL_NUM_THREADS',
+            'OPENBLAS_NUM_THREADS',
+            'CVET_NUM_THREADS'
+        ]}
+
+    # Incremental
+    # Output folders of a previous run are reused in incremental mode
+    INCREMENTAL = args.incremental == 1
+
     # * Environment
     inputFolder = '/data/in'
     scriptsDir = '/software/scripts'
@@ -130,26 +423,93 @@ if __name__ == "__main__":
         except subprocess.CalledProcessError as err:
             raise Exception(err)
 
-    # * List of Subjects
-    # Create a list of subjects that need to be processed
-    # If the participant_label has not been specified,
-    # process all subjects
-    if not args.participant_label:
-        # List all the subject folders in the input folder
-        SUBLIST = [os.path.basename(x) for x in glob(inputFolder + '/sub-*')]
-        # Strip the 'sub-' part
-        SUBLIST = ([s.replace('sub-', '') for s in SUBLIST])
-    else:
-        # If a single or list of subjects has been specified
-        # as argument to participant_label, then forward
-        # these subjects to the loop
-        SUBLIST = args.participant_label
+    # * Pre-baked template assets
+    # The template images are converted into uncompressed files that can
+    # be memory-mapped when the image is built (see assets.py). Convert
+    # them again if they are missing or out of date (e.g., when other
+    # templates were mounted). This quick check only compares sizes and
+    # modification times; 'assets.py --check full' compares checksums.
+    # If /software is read-only, they are stored on the scratch disk
+    # instead.
+    if subprocess.run([scriptsDir + '/assets.py', '--check']).returncode != 0:
+        os.environ['CVET_ASSETS'] = '/data/tmp/assets'
+        subprocess.run([scriptsDir + '/assets.py', '--check'], check=True)
 
-    # * Loop over subjects
-    for SID in SUBLIST:
+    # * Intermediate files that are used by more than one stage
+    # For each stage, the files (glob patterns) of which this stage is
+    # the last consumer. With '--intermediate_files 0', these are
+    # deleted as soon as the stage has finished for a subject.
+    # Intermediate files that are only used within a stage are
+    # released by the stage itself (see cleanup.sh).
+    INTERMEDIATES = {
+        '04': [
+            # Registration from native to FreeSurfer space (03 -> 04)
+            '/data/out/03_Segment/sub-{SID}/ses-*/register.native.txt',
+            # Local copy of already processed FreeSurfer data (01 -> 02, 03, 04)
+            '/data/tmp/01_FreeSurfer/sub-{SID}',
+            '/data/tmp/01_FreeSurfer/sub-{SID}_*'
+        ]
+    }
 
-        # ** Announce
-        print('Working on: Subject ' + SID)
+    # * Define function to release intermediate files after a stage
+    def release(stage, SID):
+        if args.intermediate_files == 1:
+            return
+        for pattern in INTERMEDIATES.get(stage, []):
+            for path in glob(pattern.format(SID=SID)):
+                print('               +----------> Release ' + path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+    # * Scratch disk budget
+    # Disk usage is measured on the file system of /data, so that other
+    # jobs that share the same scratch disk are taken into account.
+    scratch = {'budget': args.scratch_budget * 1024**3, 'estimate': 0, 'peak': 0}
+
+    def disk_used():
+        return shutil.disk_usage('/data').used
+
+    # ** Define function to record the peak disk usage while a subject runs
+    def monitor_disk(stop):
+        while not stop.wait(10):
+            scratch['peak'] = max(scratch['peak'], disk_used())
+
+    # ** Define function to hold back a subject until it fits the budget
+    # If the disk usage does not go down for 30 minutes, no other job is
+    # going to free up space, and the subject is started anyway.
+    def wait_for_scratch():
+        waited = 0
+        lowest = disk_used()
+        while disk_used() + scratch['estimate'] > scratch['budget']:
+            if waited == 0:
+                print('               +----------> Waiting for scratch space '
+                      '(used: %.1f GB, needed per subject: %.1f GB, budget: %.1f GB)'
+                      % (disk_used() / 1024**3, scratch['estimate'] / 1024**3, args.scratch_budget))
+            time.sleep(60)
+            waited += 1
+            if disk_used() < lowest:
+                lowest = disk_used()
+                waited = 1
+            elif waited > 30:
+                print('               +----------> Disk usage did not go down. Continue '
+                      'without waiting for scratch space.')
+                return
+
+    # * Report worker
+    # The QC reports are created by a single process that is started
+    # when the first report is needed and that receives subjects over a
+    # queue. This way, the plotting libraries (nipype, nilearn,
+    # matplotlib, pandas, svgutils) and the SUIT template figures are
+    # only loaded once per run.
+    # The worker is started with 'spawn' rather than 'fork': the
+    # prefetch and disk monitor threads may hold locks (stdout,
+    # logging, imports) that a forked child would inherit locked.
+    reports = {'queue': multiprocessing.get_context('spawn').Queue(), 'worker': None}
+
+    # * Define function to list the sessions of a subject
+    def list_sessions(SID):
 
         # ** Subject DIR
         SUBDIR = inputFolder + '/sub-' + SID
@@ -179,138 +539,488 @@ if __name__ == "__main__":
             if len(T1LIST) > 0:
                 SESLIST.append(ASES)
 
-        # ** Count the sessions
-        SESN = len(SESLIST)
+        return SESLIST
+
+    # * Pre-flight validation
+    # All files the stages read from the input are checked before any
+    # processing starts, so that missing or broken input shows up in
+    # seconds rather than hours into a run.
+
+    # ** Define function to list the input files a subject needs
+    # Returns (session, stage, file, is image) tuples. The file names
+    # follow what the stages look for. 'is image' is None if no file
+    # matches the name a stage looks for.
+    def required_files(SID, SESLIST):
+        files = []
+        if FSOPT == 1:
+            # *** T1-weighted images for FreeSurfer (01)
+            for SES in SESLIST:
+                T1list = sorted(glob(inputFolder + '/sub-' + SID + '/ses-' + SES + '/anat/sub-' + SID
+                                     + '_ses-' + SES + '*T1w.nii')
+                                + glob(inputFolder + '/sub-' + SID + '/ses-' + SES + '/anat/sub-' + SID
+                                       + '_ses-' + SES + '*T1w.nii.gz'))
+                if not T1list:
+                    files.append((SES, '01', inputFolder + '/sub-' + SID + '/ses-' + SES + '/anat/sub-'
+                                  + SID + '_ses-' + SES + '*T1w.nii[.gz]', None))
+                for T1 in T1list[:None if args.average == 1 else 1]:
+                    files.append((SES, '01', T1, True))
+        else:
+            # *** Already processed FreeSurfer data (02, 03, 04)
+            for SES in SESLIST:
+                cross = '/freesurfer/sub-' + SID + '_ses-' + SES
+                FSDIR = cross + '.long.sub-' + SID if len(SESLIST) > 1 else cross
+                for image in ['rawavg', 'orig', 'brainmask'] + (['aseg'] if args.segment == 'F' else []):
+                    files.append((SES, '03', cross + '/mri/' + image + '.mgz', True))
+                for image in ['aseg', 'T1']:
+                    files.append((SES, '02', FSDIR + '/mri/' + image + '.mgz', True))
+                files.append((SES, '04', FSDIR + '/stats/aseg.stats', False))
+                if len(SESLIST) > 1:
+                    files.append((SES, '04', FSDIR + '/mri/transforms/sub-' + SID + '_ses-' + SES
+                                  + '_to_sub-' + SID + '_ses-' + SES + '.long.sub-' + SID + '.lta', False))
+        return files
+
+    # ** Define function to check a file
+    # Images need a readable header with a sensible size, voxel size
+    # and orientation. Returns the problem, or '' if there is none.
+    # (nibabel is only imported here, so that the other analysis levels
+    # and '--help' do not load it.)
+    def check_file(file, image):
+        import nibabel as nb
+        import numpy as np
+        if image is None:
+            return 'no file with this name (check the BIDS naming, e.g., ses- and run- labels)'
+        if not os.path.isfile(file):
+            return 'missing'
+        if not os.access(file, os.R_OK):
+            return 'not readable'
+        if not image:
+            return ''
+        try:
+            img = nb.load(file)
+        except Exception as err:
+            return 'unreadable header (' + str(err) + ')'
+        shape = img.shape[:3]
+        zooms = img.header.get_zooms()[:3]
+        if len(shape) < 3 or min(shape) < 2:
+            return 'not a 3D image (dimensions: ' + 'x'.join(str(d) for d in img.shape) + ')'
+        if not all(np.isfinite(z) and z > 0 for z in zooms):
+            return 'invalid voxel size (' + 'x'.join(str(z) for z in zooms) + ')'
+        if None in nb.aff2axcodes(img.affine):
+            return 'invalid orientation (affine: ' + str(img.affine.tolist()) + ')'
+        return ''
+
+    # ** Define function to check all subjects
+    # Returns the subjects with problems. Files are checked in parallel,
+    # because the input often lives on a network file system.
+    def preflight(SUBLIST):
+        rows = []
+        checks = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+            for SID in SUBLIST:
+                SESLIST = list_sessions(SID)
+                if not SESLIST:
+                    rows.append([SID, '', '', inputFolder + '/sub-' + SID, 'no session with a T1-weighted image'])
+                for SES, stage, file, image in required_files(SID, SESLIST):
+                    checks.append(([SID, SES, stage, file], pool.submit(check_file, file, image)))
+            rows += [row + [check.result()] for row, check in checks]
+        with open('/data/out/CVET_preflight.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['SUB', 'SES', 'STAGE', 'FILE', 'PROBLEM'])
+            writer.writerows(rows)
+        bad = []
+        for SID, SES, stage, file, problem in rows:
+            if problem:
+                print('Pre-flight: sub-' + SID + (' ses-' + SES if SES else '')
+                      + (' (stage ' + stage + ')' if stage else '') + ': ' + file + ': ' + problem)
+                if SID not in bad:
+                    bad.append(SID)
+        return bad
+
+    # * Define function to unpack the output bundle of a subject
+    # Later runs that build on the output of a subject need the files.
+    def unbundle(SID):
+        import bundle
+        if os.path.isfile(bundle.bundlePath(SID)):
+            print('               +----------> Unpack ' + bundle.bundlePath(SID))
+            bundle.extract(bundle.bundlePath(SID))
+            os.remove(bundle.bundlePath(SID))
+
+    # * Define function to get the protocol (or site) of a subject
+    # Key of the cohort cache of initial transforms (initCache.py).
+    # Returns '' if '--init_cache' is off.
+    def protocol_key(SID, SESLIST):
+        import json
+        if args.init_cache == 'off':
+            return ''
+        if args.init_cache == 'protocol':
+            fields = ['Manufacturer', 'ManufacturersModelName', 'MagneticFieldStrength', 'SeriesDescription']
+            sidecars = sorted(glob(inputFolder + '/sub-' + SID + '/ses-' + (SESLIST[0] if SESLIST else '*')
+                                   + '/anat/*T1w.json'))
+            meta = {}
+            if sidecars:
+                with open(sidecars[0], 'r') as f:
+                    meta = json.load(f)
+            return '_'.join(str(meta.get(field, 'NA')) for field in fields)
+        try:
+            with open(inputFolder + '/participants.tsv', 'r') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    if row.get('participant_id') in ('sub-' + SID, SID):
+                        return args.init_cache + '-' + (row.get(args.init_cache) or 'NA')
+        except OSError:
+            pass
+        return args.init_cache + '-NA'
+
+    # * List of Subjects
+    # Create a list of subjects that need to be processed
+    # If the participant_label has not been specified,
+    # process all subjects
+    if not args.participant_label:
+        # List all the subject folders in the input folder
+        SUBLIST = [os.path.basename(x) for x in glob(inputFolder + '/sub-*')]
+        # Strip the 'sub-' part
+        SUBLIST = ([s.replace('sub-', '') for s in SUBLIST])
+    else:
+        # If a single or list of subjects has been specified
+        # as argument to participant_label, then forward
+        # these subjects to the loop
+        SUBLIST = args.participant_label
+
+    # * Extract volumes for additional atlases
+    # This only needs the output of the participant level.
+    if args.analysis_level == 'extract':
+
+        # ** Check arguments
+        if not args.atlas or not args.labels or len(args.atlas) != len(args.labels):
+            print('The "extract" analysis level requires one or more atlases '
+                  '("--atlas") and a label table for each atlas ("--labels").')
+            sys.exit(1)
+
+        # ** Announce
+        print('Extract volumes for: ' + ' '.join(args.atlas))
+
+        # ** Define log file
+        logFolder = '/data/out/06_Extract'
+        os.makedirs(logFolder, exist_ok=True)
+        log = logFolder + '/log-06-Extract.txt'
+
+        # ** Arguments
+        script = scriptsDir + '/06_Extract.py'
+        arguments = [script, '--SID'] + SUBLIST + ['--atlas'] + args.atlas + ['--labels'] + args.labels
 
-        # ** RUN SCRIPTS
+        # ** Start script
+        # (on the unpacked output, which is packed again afterwards)
+        for SID in SUBLIST:
+            unbundle(SID)
+        run_cmd(arguments, log, thread_env(args.n_cpus))
+        if args.bundle == 1:
+            import bundle
+            for SID in SUBLIST:
+                bundle.pack(SID, remove=True)
+        sys.exit(0)
+
+    # * Cohort quality control
+    # This only needs the output of the participant level. Without
+    # '--participant_label', all processed subjects are included.
+    if args.analysis_level == 'group':
+
+        # ** Announce
+        print('Cohort quality control')
+
+        # ** Define log file
+        logFolder = '/data/out/07_CohortQC'
+        os.makedirs(logFolder, exist_ok=True)
+        log = logFolder + '/log-07-CohortQC.txt'
+
+        # ** Arguments
+        script = scriptsDir + '/07_CohortQC.py'
+        arguments = [script, '--threshold', str(args.qc_threshold)]
+        if args.participant_label:
+            arguments += ['--SID'] + SUBLIST
+
+        # ** Start script
+        run_cmd(arguments, log, thread_env(args.n_cpus))
+        sys.exit(0)
+
+    # * Check the input of all subjects
+    if args.preflight != 'off':
+        print('Pre-flight check of the input of ' + str(len(SUBLIST)) + ' subject(s)')
+        os.makedirs('/data/out', exist_ok=True)
+        bad = preflight(SUBLIST)
+        if bad and args.preflight == 'fail':
+            print('Pre-flight check failed for ' + str(len(bad)) + ' subject(s). See '
+                  '/data/out/CVET_preflight.csv. Use "--preflight skip" to process '
+                  'the other subjects.')
+            sys.exit(1)
+        if bad:
+            print('Skip ' + str(len(bad)) + ' subject(s): ' + ' '.join(bad))
+            SUBLIST = [SID for SID in SUBLIST if SID not in bad]
+
+    # * Prefetch of input data
+    # The input of the next subjects is copied to the scratch disk by a
+    # background thread while the current subject is processed, so that
+    # reading from a slow file system overlaps with computation. At
+    # most '--prefetch' subjects beyond the current one are copied
+    # ahead. The stages read the copies through CVET_INPUT_DIR and
+    # CVET_FREESURFER_DIR, and the copies are removed once the last
+    # stage that reads them (04) has finished.
+    prefetchFolder = '/data/tmp/prefetch'
+    if FSOPT == 1:
+        PREFETCH = {
+            inputFolder: ['sub-{SID}/ses-*/anat/*T1w.*']
+        }
+    elif args.makelocalcopy == 1:
+        # The local copy of 01_FS.sh already copies the FreeSurfer
+        # subjects (completely) before the other stages read them.
+        PREFETCH = {}
+    else:
+        PREFETCH = {
+            '/freesurfer': ['sub-{SID}_*/mri/' + f for f in
+                            ['aseg.mgz', 'T1.mgz', 'rawavg.mgz', 'orig.mgz', 'brainmask.mgz']]
+            + ['sub-{SID}_*/mri/transforms/*.lta', 'sub-{SID}_*/stats/aseg.stats']
+        }
+    prefetched = {SID: queue.Queue(maxsize=1) for SID in SUBLIST}
+    window = threading.Semaphore(args.prefetch + 1)
+
+    # ** Define function to copy a file with sequential read-ahead
+    def fetch(source, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(source, 'rb') as src, open(target + '.part', 'wb') as dst:
+            os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            shutil.copyfileobj(src, dst, 16 * 1024**2)
+        shutil.copystat(source, target + '.part')
+        os.replace(target + '.part', target)
+
+    # ** Define function to prefetch the input of all subjects in order
+    # For each subject, True (copied) or False (copy failed; the stages
+    # then read the original input) is put on its queue.
+    def prefetch_worker():
+        for SID in SUBLIST:
+            window.acquire()
+            try:
+                for folder, patterns in PREFETCH.items():
+                    for pattern in patterns:
+                        for source in glob(folder + '/' + pattern.format(SID=SID)):
+                            target = os.path.join(prefetchFolder, os.path.relpath(source, os.path.dirname(folder)))
+                            fetch(source, target)
+                prefetched[SID].put(True)
+            except Exception as err:
+                # Any failure must still put a value on the queue, or
+                # the main loop waits for this subject forever.
+                print('               +----------> Prefetch of subject ' + SID + ' failed: ' + str(err))
+                prefetched[SID].put(False)
+
+    # ** Define function to remove the copies of a subject
+    def release_prefetch(SID):
+        for folder in PREFETCH:
+            copies = prefetchFolder + '/' + os.path.basename(folder) + '/sub-' + SID
+            for path in glob(copies) + glob(copies + '_*'):
+                shutil.rmtree(path)
+        window.release()
+
+    if not PREFETCH:
+        args.prefetch = 0
+    if args.prefetch > 0:
+        threading.Thread(target=prefetch_worker, daemon=True).start()
+
+    # * Loop over subjects
+    # The remaining reports are always waited for, so that the reports
+    # of the subjects that were handed over are written even if a later
+    # subject fails.
+    try:
+        for SID in SUBLIST:
 
-        # ** 01 FreeSurfer
-        # Only run FreeSurfer if no FreeSurfer folder was mounted
-        # or if there was a FreeSurfer folder mounted, but
-        # '--makelocalcopy' was set.
-        if FSOPT == 1 or (FSOPT == 0 and args.makelocalcopy == 1):
+            # ** Announce
+            print('Working on: Subject ' + SID)
 
+            # ** Point the stages at the prefetched input
+            # (the environment is passed on to the stages by run_cmd)
+            os.environ.pop('CVET_INPUT_DIR', None)
+            os.environ.pop('CVET_FREESURFER_DIR', None)
+            if args.prefetch > 0 and prefetched[SID].get():
+                os.environ['CVET_INPUT_DIR'] = prefetchFolder + '/' + os.path.basename(inputFolder)
+                os.environ['CVET_FREESURFER_DIR'] = prefetchFolder + '/freesurfer'
+
+            # ** Scratch disk budget
+            if scratch['budget'] > 0:
+                wait_for_scratch()
+                scratch['start'] = scratch['peak'] = disk_used()
+                stopMonitor = threading.Event()
+                threading.Thread(target=monitor_disk, args=(stopMonitor,), daemon=True).start()
+
+            # ** Unpack the output of a previous run
+            if INCREMENTAL:
+                unbundle(SID)
+
+            # ** List of sessions
+            SESLIST = list_sessions(SID)
+
+            # ** Count the sessions
+            SESN = len(SESLIST)
+
+            # ** RUN SCRIPTS
+
+            # ** 01 FreeSurfer
+            # Only run FreeSurfer if no FreeSurfer folder was mounted
+            # or if there was a FreeSurfer folder mounted, but
+            # '--makelocalcopy' was set.
+            if FSOPT == 1 or (FSOPT == 0 and args.makelocalcopy == 1):
+
+                # *** Announce
+                print('               +----------> Run FreeSurfer')
+
+                # *** Define log file
+                logFolder = '/data/out/01_FreeSurfer'
+                os.makedirs(logFolder, exist_ok=True)
+                log = logFolder + '/sub-' + SID + '_log-01-FS.txt'
+
+                # *** Arguments
+                script = scriptsDir + '/01_FS.sh'
+                arguments = [
+                    script,
+                    '-s', SID,
+                    '-a', str(args.average),
+                    '-c', str(args.n_cpus),
+                    '-i', str(args.intermediate_files),
+                    '-n', str(args.biasfieldcorrection),
+                    '-l', str(args.makelocalcopy),
+                    '-e', str(args.incremental)
+                ]
+
+                # *** Start script
+                run_cmd(arguments, log, thread_env(args.n_cpus))
+
+            # ** 02 Subject Template Creation and Normalization to SUIT Space
             # *** Announce
-            print('               +----------> Run FreeSurfer')
+            print('               +----------> Build Subject Template and Normalize to SUIT')
 
             # *** Define log file
-            logFolder = '/data/out/01_FreeSurfer'
-            os.makedirs(logFolder, exist_ok=True)
-            log = logFolder + '/sub-' + SID + '_log-01-FS.txt'
+            logFolder = '/data/out/02_Template/sub-' + SID
+            os.makedirs(logFolder, exist_ok=INCREMENTAL)
+            log = logFolder + '/sub-' + SID + '_log-02-Template.txt'
 
             # *** Arguments
-            script = scriptsDir + '/01_FS.sh'
+            script = scriptsDir + '/02_MkTmplt.sh'
             arguments = [
                 script,
                 '-s', SID,
-                '-a', str(args.average),
+                '-n', str(SESN),
+                '-f', str(FSOPT),
+                '-u', str(args.suitmask),
                 '-c', str(args.n_cpus),
                 '-i', str(args.intermediate_files),
-                '-n', str(args.biasfieldcorrection),
-                '-l', str(args.makelocalcopy)
+                '-l', str(args.makelocalcopy),
+                '-e', str(args.incremental),
+                '-k', format(args.template_convergence, 'f'),
+                '-p', args.registration_preset,
+                '-j', protocol_key(SID, SESLIST),
+                '-q', str(args.init_cache_min)
             ]
 
             # *** Start script
-            run_cmd(arguments, log, {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(args.n_cpus)})
-
-        # ** 02 Subject Template Creation and Normalization to SUIT Space
-        # *** Announce
-        print('               +----------> Build Subject Template and Normalize to SUIT')
-
-        # *** Define log file
-        logFolder = '/data/out/02_Template/sub-' + SID
-        os.makedirs(logFolder)
-        log = logFolder + '/sub-' + SID + '_log-02-Template.txt'
-
-        # *** Arguments
-        script = scriptsDir + '/02_MkTmplt.sh'
-        arguments = [
-            script,
-            '-s', SID,
-            '-n', str(SESN),
-            '-f', str(FSOPT),
-            '-u', str(args.suitmask),
-            '-c', str(args.n_cpus),
-            '-i', str(args.intermediate_files),
-            '-l', str(args.makelocalcopy)
-        ]
+            run_cmd(arguments, log, thread_env(args.n_cpus))
 
-        # *** Start script
-        run_cmd(arguments, log, {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(args.n_cpus)})
+            # ** 03 Segment the whole brain images using SPM12 or ANTs Atropos
+            # *** Loop over sessions
+            for SES in SESLIST:
 
-        # ** 03 Segment the whole brain images using SPM12 or ANTs Atropos
-        # *** Loop over sessions
-        for SES in SESLIST:
+                # **** Announce
+                print('               +----------> Tissue Segmentation   -- Session ' + SES)
 
-            # **** Announce
-            print('               +----------> Tissue Segmentation   -- Session ' + SES)
+                # **** Define log file
+                logFolder = '/data/out/03_Segment/sub-' + SID + '/ses-' + SES
+                os.makedirs(logFolder, exist_ok=INCREMENTAL)
+                log = logFolder + '/sub-' + SID + '_ses-' + SES + '_log-03-Segment.txt'
 
-            # **** Define log file
-            logFolder = '/data/out/03_Segment/sub-' + SID + '/ses-' + SES
-            os.makedirs(logFolder)
-            log = logFolder + '/sub-' + SID + '_ses-' + SES + '_log-03-Segment.txt'
+                # **** Arguments
+                script = scriptsDir + '/03_Segment.sh'
+                arguments = [
+                    script,
+                    '-s', SID,
+                    '-t', SES,
+                    '-n', str(SESN),
+                    '-f', str(FSOPT),
+                    '-m', str(args.segment),
+                    '-i', str(args.intermediate_files),
+                    '-l', str(args.makelocalcopy),
+                    '-e', str(args.incremental),
+                    '-p', args.registration_preset,
+                    # The T1 images were already bias field corrected if
+                    # 01_FS.sh ran FreeSurfer with --biasfieldcorrection 1
+                    '-b', str(int(FSOPT == 1 and args.biasfieldcorrection == 1))
+                ]
 
-            # **** Arguments
-            script = scriptsDir + '/03_Segment.sh'
-            arguments = [
-                script,
-                '-s', SID,
-                '-t', SES,
-                '-n', str(SESN),
-                '-f', str(FSOPT),
-                '-m', str(args.segment),
-                '-i', str(args.intermediate_files),
-                '-l', str(args.makelocalcopy)
-            ]
+                # **** Start script
+                run_cmd(arguments, log, thread_env(args.n_cpus))
 
-            # **** Start script
-            run_cmd(arguments, log, {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(args.n_cpus)})
+            # ** 04 Extract volumes and create modulated warped GM maps
+            # *** Loop over sessions
+            for SES in SESLIST:
 
-        # ** 04 Extract volumes and create modulated warped GM maps
-        # *** Loop over sessions
-        for SES in SESLIST:
+                # **** Announce
+                print('               +----------> Volume Extraction     -- Session ' + SES)
 
-            # **** Announce
-            print('               +----------> Volume Extraction     -- Session ' + SES)
+                # **** Define log file
+                logFolder = '/data/out/04_ApplyWarp/sub-' + SID + '/ses-' + SES
+                os.makedirs(logFolder, exist_ok=INCREMENTAL)
+                log = logFolder + '/sub-' + SID + '_ses-' + SES + '_log-04-ApplyWarp.txt'
 
-            # **** Define log file
-            logFolder = '/data/out/04_ApplyWarp/sub-' + SID + '/ses-' + SES
-            os.makedirs(logFolder)
-            log = logFolder + '/sub-' + SID + '_ses-' + SES + '_log-04-ApplyWarp.txt'
+                # **** Arguments
+                script = scriptsDir + '/04_ApplyWarp.sh'
+                arguments = [
+                    script,
+                    '-s', SID,
+                    '-t', SES,
+                    '-n', str(SESN),
+                    '-f', str(FSOPT),
+                    '-m', str(args.segment),
+                    '-i', str(args.intermediate_files),
+                    '-l', str(args.makelocalcopy),
+                    '-g', str(args.crop_margin),
+                    '-v', args.volume_space,
+                    '-a', args.atlas_sampling
+                ]
 
-            # **** Arguments
-            script = scriptsDir + '/04_ApplyWarp.sh'
-            arguments = [
-                script,
-                '-s', SID,
-                '-t', SES,
-                '-n', str(SESN),
-                '-f', str(FSOPT),
-                '-m', str(args.segment),
-                '-i', str(args.intermediate_files),
-                '-l', str(args.makelocalcopy)
-            ]
+                # **** Start script
+                run_cmd(arguments, log, thread_env(args.n_cpus))
 
-            # **** Start script
-            run_cmd(arguments, log, {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(args.n_cpus)})
+            # *** Release intermediate files
+            release('04', SID)
+            if args.prefetch > 0:
+                release_prefetch(SID)
 
-        # ** 05 Create quality control HTML report
-        # *** Loop over sessions
+            # ** 05 Create quality control HTML report
+            # *** Loop over sessions
 
-        # *** Announce
-        print('               +----------> Quality Control HTML Report')
+            # *** Announce
+            print('               +----------> Quality Control HTML Report')
+
+            # *** Define log file
+            logFolder = '/data/out/05_Report/sub-' + SID
+            os.makedirs(logFolder, exist_ok=INCREMENTAL)
+            log = logFolder + '/sub-' + SID + '_log-05-QC_Report.txt'
 
-        # *** Define log file
-        logFolder = '/data/out/05_Report/sub-' + SID
-        os.makedirs(logFolder)
-        log = logFolder + '/sub-' + SID + '_log-05-QC_Report.txt'
+            # *** Hand the subject over to the report worker
+            # The report is created while the next subject is processed.
+            if not reports['worker']:
+                reports['worker'] = multiprocessing.get_context('spawn').Process(
+                    target=report_worker,
+                    args=(reports['queue'], scriptsDir,
+                          reportCPUs if args.pin_cpus == 1 else None, thread_env(REPORTCPUS),
+                          (args.report, args.report_dpi, args.report_format, args.report_embed == 1),
+                          args.bundle == 1))
+                reports['worker'].start()
+            reports['queue'].put((SID, log))
 
-        # *** Arguments
-        script = scriptsDir + '/05_Report.py'
-        arguments = [
-            script,
-            '--SID', SID
-        ]
+            # ** Update the peak disk usage per subject
+            if scratch['budget'] > 0:
+                stopMonitor.set()
+                scratch['peak'] = max(scratch['peak'], disk_used())
+                scratch['estimate'] = max(scratch['estimate'], scratch['peak'] - scratch['start'])
 
-        # *** Start script
-        run_cmd(arguments, log, {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(args.n_cpus)})
+    finally:
+        # ** Wait for the remaining reports
+        if reports['worker']:
+            reports['queue'].put(None)
+            reports['worker'].join()
+    if reports['worker'] and reports['worker'].exitcode != 0:
+        sys.exit(1)
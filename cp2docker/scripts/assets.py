@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+
+# * Pre-baked template assets
+# The reference images in /software (SUIT templates, tissue priors and
+# FSL templates) are stored gzipped. Every stage of every subject used
+# to decompress them again. Here they are converted once (at image
+# build, or at the start of a run if they are missing or out of date)
+# into uncompressed NIfTI files without intensity scaling, so that
+# they can be memory-mapped and concurrent jobs share one copy in the
+# page cache. The shell scripts find them with assets.sh. For the
+# atlases in LABELS, the voxels of each label are indexed as well
+# (see volumes.labelIndex).
+
+# * Libraries
+import argparse
+import hashlib
+import os
+import sys
+from glob import glob
+import nibabel as nb
+import numpy as np
+from volumes import labelIndex
+
+
+# * Environment
+SOURCES = ['/software/SUIT-templates', '/software/TissuePriors', '/software/FSL-templates']
+ASSETS = os.environ.get('CVET_ASSETS', '/software/assets')
+CHECKSUMS = 'checksums.sha256'
+# Size and modification time of each file of the checksum file, for the
+# quick check at the start of every run
+STATS = 'stats.txt'
+# Atlases to index, and their labels
+LABELS = {'/software/SUIT-templates/Cerebellum-SUIT.nii.gz': list(range(1, 29))}
+
+
+# * Function to find the pre-baked version of an asset
+def asset(source):
+    """Return the pre-baked file of 'source' (e.g.,
+    /software/SUIT-templates/SUIT.nii.gz), or 'source' itself if there
+    is no pre-baked file."""
+
+    baked = bakedPath(source)
+    return baked if os.path.isfile(baked) else source
+
+
+def bakedPath(source):
+    folder = os.path.basename(os.path.dirname(source))
+    return os.path.join(ASSETS, folder, os.path.basename(source).replace('.nii.gz', '.nii'))
+
+
+def indexPath(source):
+    return bakedPath(source).replace('.nii', '_index.npz')
+
+
+# * Function to load the label index of an atlas
+def loadIndex(source):
+    """Return the label index (indices, voxels, offsets, shape) of the
+    atlas 'source', from its pre-baked file if that exists, and
+    otherwise computed from the atlas."""
+
+    if os.path.isfile(indexPath(source)):
+        with np.load(indexPath(source)) as index:
+            return (list(index['indices']), index['voxels'], index['offsets'],
+                    tuple(index['shape']))
+    image = nb.load(asset(source))
+    atlas = np.rint(image.get_fdata(dtype=np.float32)).astype(np.int32)
+    indices = LABELS.get(source, sorted(int(i) for i in np.unique(atlas) if i > 0))
+    voxels, offsets = labelIndex(atlas, indices)
+    return indices, voxels, offsets, atlas.shape
+
+
+# * Function to calculate a checksum
+def sha256(file):
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# * Function to get the size and modification time of a file
+def fileStat(file):
+    stat = os.stat(file)
+    return str(stat.st_size) + ' ' + str(stat.st_mtime_ns)
+
+
+# * Function to choose the data type of an asset
+def assetType(data):
+    """Integer valued images (labels, masks) get the smallest integer
+    type that holds them, all other images float32."""
+
+    if not np.all(data == np.rint(data)):
+        return np.float32
+    for dtype in [np.uint8, np.int16, np.int32]:
+        if data.min() >= np.iinfo(dtype).min and data.max() <= np.iinfo(dtype).max:
+            return dtype
+    return np.float32
+
+
+# * Function to convert the assets
+def prebake():
+    """Write an uncompressed, unscaled copy of each source image, a
+    checksum file (sha256sum format) of the sources and the copies, and
+    their sizes and modification times."""
+
+    os.makedirs(ASSETS, exist_ok=True)
+    lines = []
+    for source in sorted(s for d in SOURCES for s in glob(d + '/*.nii.gz')):
+        baked = bakedPath(source)
+        os.makedirs(os.path.dirname(baked), exist_ok=True)
+        image = nb.load(source)
+        data = image.get_fdata()
+        dtype = assetType(data)
+        header = image.header.copy()
+        header.set_data_dtype(dtype)
+        header.set_slope_inter(1, 0)
+        # Write to a temporary file first, so that concurrent jobs never
+        # read a partially written file.
+        tmp = baked.replace('.nii', '_' + str(os.getpid()) + '.nii')
+        nb.save(nb.Nifti1Image(data.astype(dtype), image.affine, header), tmp)
+        os.replace(tmp, baked)
+        print(source + ' -> ' + baked + ' (' + dtype.__name__ + ')')
+        lines += [sha256(source) + '  ' + source, sha256(baked) + '  ' + baked]
+
+        # ** Label index
+        if source in LABELS:
+            index = indexPath(source)
+            voxels, offsets = labelIndex(np.rint(data).astype(np.int32), LABELS[source])
+            tmp = index.replace('.npz', '_' + str(os.getpid()) + '.npz')
+            np.savez(tmp, indices=LABELS[source], voxels=voxels, offsets=offsets, shape=data.shape)
+            os.replace(tmp, index)
+            print(source + ' -> ' + index + ' (' + str(len(voxels)) + ' voxels)')
+            lines += [sha256(index) + '  ' + index]
+
+    tmp = os.path.join(ASSETS, CHECKSUMS + '_' + str(os.getpid()))
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, os.path.join(ASSETS, CHECKSUMS))
+
+    files = [line.split('  ', 1)[1] for line in lines]
+    tmp = os.path.join(ASSETS, STATS + '_' + str(os.getpid()))
+    with open(tmp, 'w') as f:
+        f.write(''.join(fileStat(file) + ' ' + file + '\n' for file in files))
+    os.replace(tmp, os.path.join(ASSETS, STATS))
+
+
+# * Function to verify the assets
+def verify(full=False):
+    """Return True if the checksum file exists and all sources and
+    pre-baked files match it (and no source was added).
+
+    By default, the files are compared by size and modification time
+    with what prebake() recorded, so that the check at the start of a
+    run does not read the assets. With 'full', their checksums are
+    calculated.
+    """
+
+    try:
+        with open(os.path.join(ASSETS, CHECKSUMS), 'r') as f:
+            checksums = {file: checksum for checksum, file in
+                         (line.split('  ', 1) for line in f.read().splitlines())}
+    except OSError:
+        return False
+    sources = [s for d in SOURCES for s in glob(d + '/*.nii.gz')]
+    if any(s not in checksums for s in sources):
+        return False
+    if any(os.path.isfile(s) and indexPath(s) not in checksums for s in LABELS):
+        return False
+    if full:
+        return all(os.path.isfile(f) and sha256(f) == checksum for f, checksum in checksums.items())
+    try:
+        with open(os.path.join(ASSETS, STATS), 'r') as f:
+            stats = {file: size + ' ' + mtime for size, mtime, file in
+                     (line.split(' ', 2) for line in f.read().splitlines())}
+    except (OSError, ValueError):
+        return False
+    return all(os.path.isfile(f) and stats.get(f) == fileStat(f) for f in checksums)
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Convert the template '
+        'images in ' + ', '.join(SOURCES) + ' into uncompressed, unscaled '
+        'NIfTI files that can be memory-mapped, with checksums. The output '
+        'folder is ' + ASSETS + ' (set CVET_ASSETS to change it).')
+
+    parser.add_argument('--check',
+                        help='Only convert the images if the pre-baked files are '
+                        'missing or out of date. "quick" (the default if no value '
+                        'is given) compares the sizes and modification times of the '
+                        'files, "full" their checksums.',
+                        nargs='?',
+                        const='quick',
+                        choices=['quick', 'full'])
+
+    args = parser.parse_args()
+
+    if args.check and verify(args.check == 'full'):
+        print('Pre-baked assets in ' + ASSETS + ' are up to date')
+        sys.exit(0)
+    try:
+        prebake()
+    except OSError as err:
+        print('Could not write pre-baked assets to ' + ASSETS + ': ' + str(err))
+        sys.exit(1)
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# * Pre-baked template assets
+# This file is sourced by the processing scripts. The template images
+# in /software are converted into uncompressed, unscaled NIfTI files by
+# assets.py (at image build, and checked by CVET.py at the start of a
+# run). These can be memory-mapped, so that concurrent jobs share one
+# copy in the page cache instead of each decompressing the templates.
+#
+# Usage: asset <template image>
+# Prints the pre-baked file of the template image (e.g.,
+# /software/SUIT-templates/SUIT.nii.gz), or the template image itself
+# if there is no pre-baked file.
+ASSETS=${CVET_ASSETS:-/software/assets}
+
+asset() {
+
+    local baked=${ASSETS}/$(basename $(dirname ${1}))/$(basename ${1} .gz)
+    if [ -f ${baked} ]; then
+        echo ${baked}
+    else
+        echo ${1}
+    fi
+
+}
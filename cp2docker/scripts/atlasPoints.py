@@ -0,0 +1,135 @@
+#! /usr/bin/env python3
+
+# * Point based atlas labeling
+# To label the cerebellum in native space, the SUIT atlas can be
+# resampled onto the whole native grid and then masked with the
+# cerebellum mask. The cerebellum is only a small part of the field
+# of view, so instead, only the voxels inside the mask are taken as
+# points, moved to SUIT space by antsApplyTransformsToPoints (with the
+# same transformations as antsApplyTransforms uses for the atlas),
+# and labeled by the nearest atlas voxel:
+# 1) atlasPoints.py points <mask> <points.csv>
+# 2) antsApplyTransformsToPoints -d 3 -i <points.csv> -o <suit.csv> <transformations>
+# 3) atlasPoints.py labels <mask> <suit.csv> <atlas> <output>
+# The output is the masked atlas in native space, on the grid of the
+# mask, the same as resampling with -n NearestNeighbor and masking.
+
+# * Libraries
+import argparse
+import sys
+import tempfile
+import nibabel as nb
+import numpy as np
+
+
+# * Conversion between RAS (NIfTI) and LPS (ITK) coordinates
+LPS = np.array([-1, -1, 1])
+
+
+# * Function to list the points of a mask
+def maskPoints(mask):
+    """Return the voxel indices (n x 3) of the voxels inside 'mask' (a
+    nibabel image) and their physical LPS coordinates."""
+
+    voxels = np.argwhere(np.asanyarray(mask.dataobj) > 0)
+    return voxels, nb.affines.apply_affine(mask.affine, voxels) * LPS
+
+
+# * Functions to read and write point tables
+# antsApplyTransformsToPoints reads and writes CSV tables with the
+# columns x, y, z and t.
+def writePoints(file, points):
+    table = np.column_stack([points, np.zeros(len(points))])
+    np.savetxt(file, table, fmt='%.6f', delimiter=',', header='x,y,z,t', comments='')
+
+
+def readPoints(file):
+    return np.loadtxt(file, delimiter=',', skiprows=1, usecols=(0, 1, 2), ndmin=2)
+
+
+# * Function to look up the atlas labels of points
+def sampleLabels(atlas, points):
+    """Return the labels of 'atlas' (a nibabel image) at the physical
+    LPS coordinates 'points' (n x 3): nearest neighbor, and zero
+    outside of the atlas."""
+
+    data = np.asanyarray(atlas.dataobj)
+    index = np.floor(nb.affines.apply_affine(np.linalg.inv(atlas.affine), points * LPS) + 0.5).astype(np.int64)
+    inside = np.all((index >= 0) & (index < np.array(data.shape[:3])), axis=1)
+    labels = np.zeros(len(points), dtype=data.dtype)
+    labels[inside] = data[tuple(index[inside].T)]
+    return labels
+
+
+# * Function to check the labeling
+def check():
+    """Label a synthetic mask with a synthetic atlas on the same
+    (oblique, flipped) grid, through a point table as written by
+    'points', with the identity transformation. Raises an
+    AssertionError if the labels differ from the masked atlas."""
+
+    affine = np.array([[-1.0, 0.1, 0, 20], [0, 1.2, 0, -10], [0, 0, 0.9, 5], [0, 0, 0, 1]])
+    atlas = np.arange(12 * 13 * 14, dtype=np.int16).reshape(12, 13, 14) % 29
+    mask = np.zeros(atlas.shape, dtype=np.uint8)
+    mask[3:9, 2:10, 4:11] = 1
+    voxels, points = maskPoints(nb.Nifti1Image(mask, affine))
+    with tempfile.TemporaryDirectory() as folder:
+        writePoints(folder + '/points.csv', points)
+        labels = sampleLabels(nb.Nifti1Image(atlas, affine), readPoints(folder + '/points.csv'))
+    assert len(labels) == mask.sum()
+    assert np.array_equal(labels, atlas[tuple(voxels.T)])
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Label the voxels of a '
+        'native space mask with a SUIT space atlas by transforming only the '
+        'voxels inside the mask (as points) to SUIT space.')
+    commands = parser.add_subparsers(dest='command')
+    # (not add_subparsers(required=True), which needs Python 3.7)
+    commands.required = True
+
+    pointsParser = commands.add_parser('points', help='Write the points of a mask')
+    pointsParser.add_argument('mask', help='Mask in native space')
+    pointsParser.add_argument('output', help='Point table for antsApplyTransformsToPoints')
+
+    labelsParser = commands.add_parser('labels', help='Write the labels of the transformed points')
+    labelsParser.add_argument('mask', help='Mask in native space (as for "points")')
+    labelsParser.add_argument('points', help='Points transformed to SUIT space')
+    labelsParser.add_argument('atlas', help='Atlas in SUIT space')
+    labelsParser.add_argument('output', help='Masked atlas in native space')
+
+    commands.add_parser('check', help='Check the labeling of a synthetic mask')
+
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        check()
+        print('Point based labeling OK')
+        sys.exit(0)
+
+    # * Load the mask
+    maskImage = nb.load(args.mask)
+    voxels, points = maskPoints(maskImage)
+
+    if args.command == 'points':
+        writePoints(args.output, points)
+        print(str(len(points)) + ' points written to: ' + args.output)
+
+    elif args.command == 'labels':
+        suit = readPoints(args.points)
+        if len(suit) != len(voxels):
+            print('Point table ' + args.points + ' does not match the mask ' + args.mask + '.',
+                  file=sys.stderr)
+            sys.exit(1)
+        atlasImage = nb.load(args.atlas)
+        labels = sampleLabels(atlasImage, suit)
+
+        # ** Write the labels on the grid of the mask
+        data = np.zeros(maskImage.shape[:3], dtype=labels.dtype)
+        data[tuple(voxels.T)] = labels
+        header = maskImage.header.copy()
+        header.set_data_dtype(labels.dtype)
+        header.set_slope_inter(1, 0)
+        nb.save(nb.Nifti1Image(data, maskImage.affine, header), args.output)
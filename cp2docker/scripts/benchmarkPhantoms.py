@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import importlib.util
+from glob import glob
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from volumes import labelVolumes
+
+
+# * Environment
+scriptsDir = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+# * SUIT lobules
+# Same order and indices (1-28) as Cerebellum-SUIT.nii.gz and the
+# output of 04_ApplyWarp.sh.
+lNames = ['l_I_IV', 'r_I_IV', 'l_V', 'r_V', 'l_VI', 'v_VI', 'r_VI', 'l_CrusI', 'v_CrusI',
+          'r_CrusI', 'l_CrusII', 'v_CrusII', 'r_CrusII', 'l_VIIb', 'v_VIIb', 'r_VIIb',
+          'l_VIIIa', 'v_VIIIa', 'r_VIIIa', 'l_VIIIb', 'v_VIIIb', 'r_VIIIb', 'l_IX', 'v_IX',
+          'r_IX', 'l_X', 'v_X', 'r_X']
+
+
+# * Function to load 05_Report.py
+def loadReport():
+    spec = importlib.util.spec_from_file_location('report', scriptsDir + '/05_Report.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# * Function to lay out the lobules of a phantom
+def layout(size):
+    """Return the box (x, y, z slices) of each lobule in a cube of 'size'
+    voxels per side.
+
+    The lobules are stacked from anterior (I-IV) to posterior (X) like
+    in the SUIT atlas. I-IV and V are split into a left and right half,
+    the other lobules into left hemisphere, vermis and right hemisphere.
+    The cube has an empty border of 1/8 of its size.
+    """
+
+    border = size // 8
+    inner = size - 2 * border
+    depth = inner // 10
+    boxes = []
+    for row in range(10):
+        y = slice(border + row * depth, border + (row + 1) * depth)
+        parts = 2 if row < 2 else 3
+        width = inner // parts
+        for part in range(parts):
+            x = slice(border + part * width, border + (part + 1) * width)
+            boxes.append((x, y, slice(border, border + inner)))
+    return boxes
+
+
+# * Function to create a phantom
+def makePhantom(size, nSessions, oDIR):
+    """Write a synthetic subject with 'nSessions' sessions to 'oDIR' and
+    return the true GM volume of each lobule per session.
+
+    Each session has a label image (c_atlasNativeSpace.nii.gz), a GM
+    probability map (cgm.nii.gz) and a T1 image. The GM probability of
+    a lobule decreases by 1% per session (atrophy), and the voxel size
+    increases by 2% per session (a known scaling transform; the first
+    session has an identity transform). The true volume of a lobule is
+    its box size times its GM probability times the voxel volume, which
+    does not depend on the image data.
+    """
+
+    boxes = layout(size)
+    atlas = np.zeros((size, size, size), dtype=np.int16)
+    for label, box in enumerate(boxes, start=1):
+        atlas[box] = label
+    baseline = np.float32(0.5) + np.arange(len(boxes) + 1, dtype=np.float32) * np.float32(0.4 / len(boxes))
+    baseline[0] = 0
+
+    truth = []
+    for session in range(nSessions):
+
+        # ** Output folder
+        SES = str(session + 1).zfill(2)
+        oDIRs = oDIR + '/ses-' + SES
+        os.makedirs(oDIRs, exist_ok=True)
+
+        # ** Known transform
+        scale = 1 + 0.02 * session
+        affine = np.diag([scale, scale, scale, 1.0])
+        affine[:3, 3] = -scale * size / 2
+
+        # ** Images
+        probability = baseline * np.float32(1 - 0.01 * session)
+        gm = probability[atlas]
+        T1 = np.where(atlas > 0, 60 + 40 * gm, 0).astype(np.float32)
+        nb.save(nb.Nifti1Image(atlas, affine), oDIRs + '/c_atlasNativeSpace.nii.gz')
+        nb.save(nb.Nifti1Image(gm, affine), oDIRs + '/cgm.nii.gz')
+        nb.save(nb.Nifti1Image(T1, affine), oDIRs + '/T1.nii.gz')
+
+        # ** Ground truth
+        volumes = [np.prod([b.stop - b.start for b in box]) * float(probability[label]) * scale**3
+                   for label, box in enumerate(boxes, start=1)]
+        truth.append(['phantom', SES] + volumes)
+
+    return pd.DataFrame(truth, columns=['SUB', 'SES'] + lNames)
+
+
+# * Function to measure a stage
+def measure(function, repeat):
+    """Return the result, the fastest runtime (in seconds) of 'repeat'
+    runs, and the peak Python memory use (in MB) of 'function()'.
+    Memory is traced in a separate run, so that tracing does not slow
+    down the timed runs."""
+
+    seconds = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(seconds), peak / 1024**2
+
+
+# * Stages
+# ** Volume extraction (04_ApplyWarp.sh, 06_Extract.py)
+def extractVolumes(oDIR, SESLIST):
+    rows = []
+    for SES in SESLIST:
+        gmImage = nb.load(oDIR + '/ses-' + SES + '/cgm.nii.gz')
+        gmData = gmImage.get_fdata(dtype=np.float32)
+        atlas = np.asarray(nb.load(oDIR + '/ses-' + SES + '/c_atlasNativeSpace.nii.gz').dataobj)
+        voxelVolume = float(np.prod(gmImage.header.get_zooms()[:3]))
+        rows.append(['phantom', SES] + labelVolumes(atlas, gmData, voxelVolume, range(1, len(lNames) + 1)))
+    return pd.DataFrame(rows, columns=['SUB', 'SES'] + lNames)
+
+
+# ** Report preparation (05_Report.py)
+def prepareReport(report, oDIR, SESLIST):
+    for SES in SESLIST:
+        oDIRs = oDIR + '/ses-' + SES
+        nb.save(nb.load(oDIRs + '/cgm.nii.gz'), oDIRs + '/gm.nii.gz')
+        nb.save(nb.load(oDIRs + '/c_atlasNativeSpace.nii.gz'), oDIRs + '/atlas.nii.gz')
+        report.maskAtlas(oDIRs)
+
+
+# ** Figure rendering (05_Report.py)
+def renderFigures(report, oDIR, SESLIST, dpi):
+    for SES in SESLIST:
+        oDIRs = oDIR + '/ses-' + SES
+        T1 = nb.load(oDIRs + '/T1.nii.gz')
+        cuts = report.cutPoints(T1)
+        report.montage(
+            oDIRs + '/SUIT_atlas.png',
+            lambda plane, figure, axes: report.plotting.plot_roi(
+                oDIRs + '/atlas.nii.gz', bg_img=T1, display_mode=plane.lower(),
+                cut_coords=cuts[plane], dim=-1, figure=figure, axes=axes),
+            dpi)
+        for alpha in [0.0, 1.0]:
+            report.plotting.plot_stat_map(
+                oDIRs + '/gm.nii.gz',
+                bg_img=T1,
+                display_mode='z',
+                cut_coords=cuts['Z'],
+                threshold=0.05,
+                alpha=alpha,
+                dim=-1,
+                output_file=oDIRs + '/GM_Z_' + str(alpha) + '.svg'
+            )
+
+
+# ** SVG compositing (05_Report.py)
+def compositeSVG(report, oDIR, SESLIST):
+    for SES in SESLIST:
+        oDIRs = oDIR + '/ses-' + SES
+        report.compileSVG(oDIR, oDIRs + '/GM_Z_0.0.svg', oDIRs + '/GM_Z_1.0.svg', oDIRs + '/GM_Z.svg')
+
+
+# ** CSV aggregation (05_Report.py, 06_Extract.py)
+def aggregateCSV(oDIR, volumes):
+    for n, SES in enumerate(volumes['SES']):
+        volumes.iloc[[n]].to_csv(oDIR + '/ses-' + SES + '/volumes.csv', index=False, float_format='%0.5f')
+    files = sorted(glob(oDIR + '/ses-*/volumes.csv'))
+    return pd.concat([pd.read_csv(f, dtype={'SES': str}) for f in files], ignore_index=True)
+
+
+# * Function to compare volumes with the ground truth
+def maxError(volumes, truth):
+    """Return the largest relative difference between two tables of
+    lobule volumes."""
+
+    measured = volumes[lNames].to_numpy(dtype=np.float64)
+    expected = truth[lNames].to_numpy(dtype=np.float64)
+    return float(np.max(np.abs(measured - expected) / expected))
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Benchmark the Python '
+        'stages of the pipeline (volume extraction, report preparation, figure '
+        'rendering, SVG compositing and CSV aggregation) on synthetic phantoms, '
+        'without FreeSurfer, ANTs or MATLAB. The runtime, throughput and peak '
+        'memory of each stage are written to benchmarkPhantoms.csv, and the '
+        'extracted volumes are checked against the analytic ground truth of '
+        'the phantom. Exits with status 1 if a volume is off by more than the '
+        'tolerance.')
+
+    parser.add_argument('--out_dir',
+                        help='Output folder',
+                        default='/data/out/benchmarkPhantoms')
+    parser.add_argument('--sizes',
+                        help='Phantom sizes (voxels per side)',
+                        default=[64, 128],
+                        type=int,
+                        nargs='+')
+    parser.add_argument('--sessions',
+                        help='Numbers of sessions per phantom',
+                        default=[1, 3],
+                        type=int,
+                        nargs='+')
+    parser.add_argument('--stages',
+                        help='Stages to benchmark',
+                        choices=['volumes', 'prepare', 'render', 'composite', 'csv'],
+                        default=['volumes', 'prepare', 'render', 'composite', 'csv'],
+                        nargs='+')
+    parser.add_argument('--repeat',
+                        help='Number of timed runs per stage (the fastest counts)',
+                        default=3,
+                        type=int)
+    parser.add_argument('--dpi',
+                        help='Resolution of the rendered raster figures',
+                        default=100,
+                        type=int)
+    parser.add_argument('--tolerance',
+                        help='Largest allowed relative volume error',
+                        default=1e-5,
+                        type=float)
+    parser.add_argument('--baseline',
+                        help='benchmarkPhantoms.csv of an earlier run to compare '
+                        'the runtimes with')
+
+    args = parser.parse_args()
+
+    # * Stages to run
+    # Rendering and compositing need the output of the stages before them.
+    needed = set(args.stages)
+    if 'composite' in needed:
+        needed.add('render')
+    if 'render' in needed:
+        needed.add('prepare')
+
+    # * Report functions
+    # Only loaded (with the plotting libraries) if a report stage is run.
+    if 'prepare' in needed:
+        report = loadReport()
+
+    # * Loop over phantoms
+    results = []
+    failed = False
+    for size in args.sizes:
+        for nSessions in args.sessions:
+
+            # ** Phantom
+            oDIR = args.out_dir + '/size-' + str(size) + '_sessions-' + str(nSessions)
+            print(f'Phantom: {size}^3 voxels, {nSessions} session(s)')
+            truth = makePhantom(size, nSessions, oDIR)
+            SESLIST = list(truth['SES'])
+            stages = {
+                'volumes': lambda: extractVolumes(oDIR, SESLIST),
+                'prepare': lambda: prepareReport(report, oDIR, SESLIST),
+                'render': lambda: renderFigures(report, oDIR, SESLIST, args.dpi),
+                'composite': lambda: compositeSVG(report, oDIR, SESLIST),
+                'csv': lambda: aggregateCSV(oDIR, output.get('volumes', truth).copy())
+            }
+            output = {}
+
+            # ** Run stages
+            for stage in ['volumes', 'prepare', 'render', 'composite', 'csv']:
+                if stage not in needed:
+                    continue
+                result, seconds, peak = measure(stages[stage], args.repeat)
+                output[stage] = result
+                error = maxError(result, truth) if stage in ['volumes', 'csv'] else np.nan
+                failed = failed or error > args.tolerance
+                results.append({
+                    'stage': stage,
+                    'size': size,
+                    'sessions': nSessions,
+                    'seconds': seconds,
+                    'sessions_per_s': nSessions / seconds,
+                    'mvoxels_per_s': nSessions * size**3 / seconds / 1e6,
+                    'peak_memory_MB': peak,
+                    'max_rel_error': error
+                })
+                print(f'    {stage:<10} {seconds:8.3f} s {peak:9.1f} MB'
+                      + ('' if np.isnan(error) else f'   max. relative volume error: {error:.2e}'))
+
+    # * Summary
+    data = pd.DataFrame(results)
+    data.to_csv(args.out_dir + '/benchmarkPhantoms.csv', index=False)
+    if args.baseline:
+        keys = ['stage', 'size', 'sessions']
+        baseline = pd.read_csv(args.baseline)[keys + ['seconds']]
+        data = data.merge(baseline, on=keys, how='left', suffixes=('', '_baseline'))
+        data['speedup'] = data['seconds_baseline'] / data['seconds']
+    print()
+    # (the relative errors are ~1e-7 and printed in scientific notation,
+    # only the other columns are rounded)
+    print(data.round({c: 4 for c in data.columns if c != 'max_rel_error'})
+          .to_string(index=False, formatters={'max_rel_error': '{:.2e}'.format}))
+
+    if failed:
+        print('Extracted volumes differ from the ground truth by more than ' + str(args.tolerance))
+        sys.exit(1)
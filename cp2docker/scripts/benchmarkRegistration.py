@@ -0,0 +1,138 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import os
+import subprocess
+import time
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from assets import asset
+
+
+# * Environment
+scriptsDir = os.path.dirname(os.path.abspath(__file__))
+tDIR = '/software/SUIT-templates'
+PRESETS = ['fast', 'standard', 'accurate']
+
+
+# * Function to register an image to SUIT space with a preset
+def register(preset, moving, oDIR, n_cpus):
+    """Run the subject -> SUIT registration of 02_MkTmplt.sh with a preset
+    and return the runtime in seconds."""
+
+    SUIT = asset(tDIR + '/SUIT.nii.gz')
+    prefix = oDIR + '/' + preset + '_'
+    cmd = f"""
+    source {scriptsDir}/registration.sh
+    setRegistrationPreset {preset}
+    runRegistration {SUIT} {moving} [{SUIT},{moving},1] [{prefix},{prefix}warped.nii.gz]
+    """
+    env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(n_cpus))
+    start = time.time()
+    with open(prefix + 'log.txt', 'w') as log:
+        subprocess.run(['bash', '-c', cmd], stdout=log, stderr=log, check=True, env=env)
+    return time.time() - start
+
+
+# * Function to bring the SUIT atlas into subject space
+def warpAtlas(preset, moving, oDIR):
+    """Apply the inverse registration to the SUIT lobule atlas, as is
+    done in 04_ApplyWarp.sh, and return the path of the warped atlas."""
+
+    prefix = oDIR + '/' + preset + '_'
+    oFile = prefix + 'atlas.nii.gz'
+    subprocess.run([
+        'antsApplyTransforms',
+        '-d', '3',
+        '-i', asset(tDIR + '/Cerebellum-SUIT.nii.gz'),
+        '-r', moving,
+        '-o', oFile,
+        '-t', '[' + prefix + '0GenericAffine.mat,1]',
+        '-t', prefix + '1InverseWarp.nii.gz',
+        '-n', 'NearestNeighbor',
+        '--float'
+    ], stdout=subprocess.DEVNULL, check=True)
+    return oFile
+
+
+# * Function to calculate the Dice overlap per lobule
+def dice(atlas1, atlas2):
+    """Return the Dice coefficient of each label that is present in
+    either labeled image."""
+
+    a = np.rint(nb.load(atlas1).get_fdata()).astype(np.int32).ravel()
+    b = np.rint(nb.load(atlas2).get_fdata()).astype(np.int32).ravel()
+    n = max(a.max(), b.max()) + 1
+    sizeA = np.bincount(a, minlength=n)
+    sizeB = np.bincount(b, minlength=n)
+    overlap = np.bincount(a[a == b], minlength=n)
+    labels = [i for i in range(1, n) if sizeA[i] + sizeB[i] > 0]
+    return {i: 2 * overlap[i] / (sizeA[i] + sizeB[i]) for i in labels}
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Benchmark the '
+        'registration presets (see registration.sh). Each sample image '
+        '(e.g., a subject template T_template0.nii.gz or a cropped '
+        'cerebellum *_ccereb.nii.gz) is registered to SUIT space with each '
+        'preset. The runtime is reported together with the Dice overlap '
+        'of the SUIT lobules warped into the sample space, relative to '
+        'the "standard" preset.')
+
+    parser.add_argument('images',
+                        help='Sample images to register to SUIT space',
+                        nargs='+')
+    parser.add_argument('--out_dir',
+                        help='Output folder',
+                        default='/data/out/benchmarkRegistration')
+    parser.add_argument('--presets',
+                        help='Presets to benchmark (standard is always included '
+                        'because it is the reference)',
+                        choices=PRESETS,
+                        default=PRESETS,
+                        nargs='+')
+    parser.add_argument('--n_cpus',
+                        help='Number of CPUs/cores available to use.',
+                        default=1,
+                        type=int)
+
+    args = parser.parse_args()
+    presets = ['standard'] + [p for p in args.presets if p != 'standard']
+
+    # * Loop over sample images
+    results = []
+    for n, image in enumerate(args.images):
+
+        # ** Output folder
+        oDIR = args.out_dir + '/sample-' + str(n + 1)
+        os.makedirs(oDIR, exist_ok=True)
+        print('Sample ' + str(n + 1) + ': ' + image)
+
+        # ** Register with each preset
+        for preset in presets:
+            runtime = register(preset, image, oDIR, args.n_cpus)
+            warpAtlas(preset, image, oDIR)
+            overlap = dice(oDIR + '/standard_atlas.nii.gz', oDIR + '/' + preset + '_atlas.nii.gz')
+            results.append({
+                'sample': image,
+                'preset': preset,
+                'runtime_s': round(runtime, 1),
+                'mean_dice': np.mean(list(overlap.values())),
+                'min_dice': np.min(list(overlap.values()))
+            })
+            print(f'    {preset:<10} {runtime:8.1f} s   mean Dice vs standard: '
+                  f'{results[-1]["mean_dice"]:.3f}')
+
+    # * Summary
+    data = pd.DataFrame(results)
+    reference = data[data['preset'] == 'standard'].set_index('sample')['runtime_s']
+    data['speedup'] = [reference[s] / t for s, t in zip(data['sample'], data['runtime_s'])]
+    data.to_csv(args.out_dir + '/benchmarkRegistration.csv', index=False)
+
+    summary = data.groupby('preset', sort=False)[['runtime_s', 'speedup', 'mean_dice', 'min_dice']].mean()
+    print()
+    print(summary.round(3).to_string())
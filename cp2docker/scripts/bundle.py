@@ -0,0 +1,310 @@
+#! /usr/bin/env python3
+
+# * Output bundles
+# One subject produces hundreds of small files in the output folders
+# of the stages. On parallel file systems, the metadata operations on
+# these files (listing, syncing, archiving) are slow. A bundle packs
+# the output of a subject into one HDF5 file:
+# - NIfTI images are stored as chunked, compressed arrays (in their
+#   on-disk data type) with their header, so that a single volume, or
+#   part of it, can be read without unpacking the bundle (see volume).
+# - All other files (transforms, tables, logs, figures, HTML) are
+#   stored as compressed byte arrays.
+# - A manifest (JSON, in the dataset 'manifest') lists each file with
+#   its size, checksum and modification time (of the original file).
+# Files are stored under their path relative to the output folder, so
+# extract() restores the original layout.
+
+# * Libraries
+import argparse
+import contextlib
+import fnmatch
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import h5py
+import nibabel as nb
+import numpy as np
+
+
+# * Environment
+OUTPUT = '/data/out'
+STAGES = ['02_Template', '03_Segment', '04_ApplyWarp', '05_Report']
+BUNDLES = OUTPUT + '/bundles'
+bundleVersion = 1
+
+
+# * Function to get the file name of the bundle of a subject
+def bundlePath(SID, output=OUTPUT):
+    return output + '/bundles/sub-' + SID + '.h5'
+
+
+# * Function to list the output files of a subject
+def subjectFiles(SID, output=OUTPUT):
+    """Return the paths (relative to 'output') of all files of subject
+    'SID' in the stage folders."""
+
+    files = []
+    for stage in STAGES:
+        for root, _, names in os.walk(os.path.join(output, stage, 'sub-' + SID)):
+            files += [os.path.relpath(os.path.join(root, name), output) for name in sorted(names)]
+    return files
+
+
+# * Function to pack the output of a subject
+def pack(SID, remove=False, output=OUTPUT):
+    """Write the bundle of subject 'SID' and return its file name. With
+    'remove', the packed stage folders of the subject are removed once
+    the bundle is complete."""
+
+    files = subjectFiles(SID, output)
+    if not files:
+        raise FileNotFoundError('No output of subject ' + SID + ' in ' + output)
+    oFile = bundlePath(SID, output)
+    os.makedirs(os.path.dirname(oFile), exist_ok=True)
+    tmp = oFile + '.part'
+
+    entries = []
+    try:
+        writeBundle(tmp, SID, output, files, entries)
+    except BaseException:
+        # Do not leave an incomplete bundle behind
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, oFile)
+
+    if remove:
+        for stage in STAGES:
+            shutil.rmtree(os.path.join(output, stage, 'sub-' + SID), ignore_errors=True)
+    return oFile
+
+
+# * Function to write the files of a subject into a bundle
+def writeBundle(tmp, SID, output, files, entries):
+    # (libver='latest' allows header attributes larger than 64 kB)
+    with h5py.File(tmp, 'w', libver='latest') as h5:
+        h5.attrs['version'] = bundleVersion
+        h5.attrs['subject'] = SID
+        for path in files:
+            source = os.path.join(output, path)
+            with open(source, 'rb') as f:
+                content = f.read()
+            entry = {'path': path,
+                     'size': len(content),
+                     'sha256': hashlib.sha256(content).hexdigest(),
+                     'mtime': os.stat(source).st_mtime}
+
+            # ** NIfTI images
+            # The data are stored unscaled, in their on-disk type, and
+            # everything before the data (header and extensions) is
+            # kept as it is, so the uncompressed image is restored
+            # byte for byte.
+            # (The offset of the data is taken from the file: nibabel
+            # resets 'vox_offset' in the header of a loaded image.)
+            image = None
+            if path.endswith(('.nii', '.nii.gz')):
+                try:
+                    raw = gzip.decompress(content) if path.endswith('.gz') else content
+                    image = nb.Nifti1Image.from_bytes(raw)
+                    offset = int(image.dataobj.offset)
+                except Exception:
+                    image = None
+            if image is not None and image.ndim > 0 and offset > 0:
+                data = np.asanyarray(image.dataobj.get_unscaled())
+                dataset = h5.create_dataset(path, data=data, chunks=True,
+                                            compression='gzip', shuffle=True)
+                dataset.attrs['prefix'] = np.void(raw[:offset])
+                entry.update({'kind': 'nifti', 'shape': list(data.shape), 'dtype': str(data.dtype)})
+
+            # ** Other files
+            else:
+                h5.create_dataset(path, data=np.frombuffer(content, dtype=np.uint8),
+                                  compression='gzip' if content else None)
+                entry['kind'] = 'file'
+
+            entries.append(entry)
+        h5.create_dataset('manifest', data=json.dumps(entries))
+
+
+# * Function to read the manifest of a bundle
+def manifest(bundle):
+    with h5py.File(bundle, 'r') as h5:
+        return json.loads(h5['manifest'][()])
+
+
+# * Function to read the header of an image in a bundle
+def header(dataset):
+    return nb.Nifti1Header.from_fileobj(io.BytesIO(dataset.attrs['prefix'].tobytes()), check=False)
+
+
+# * Array view of an image in a bundle
+class BundleArray:
+    """Array-like view of an image in a bundle that applies the NIfTI
+    scaling. Indexing reads only the chunks that are needed."""
+
+    is_proxy = True
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.slope, self.inter = header(dataset).get_slope_inter()
+        self.shape = dataset.shape
+        self.ndim = dataset.ndim
+        self.dtype = np.dtype(np.float64) if self.scaled() else dataset.dtype
+
+    def scaled(self):
+        return self.slope not in (None, 1.0) or self.inter not in (None, 0.0)
+
+    def __getitem__(self, slicer):
+        data = self.dataset[slicer]
+        if self.scaled():
+            data = data * (1.0 if self.slope is None else self.slope) + (self.inter or 0.0)
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        return data if dtype is None else data.astype(dtype)
+
+
+# * Function to read one image from a bundle
+def volume(h5, path):
+    """Return the image 'path' (e.g., 04_ApplyWarp/sub-01/ses-1/cgm.nii.gz)
+    of the open bundle 'h5' as a nibabel image. The data are only read
+    when they are accessed, and 'image.dataobj[...]' only reads the
+    requested part."""
+
+    dataset = h5[path]
+    return nb.Nifti1Image(BundleArray(dataset), None, header(dataset))
+
+
+# * Function to extract files from a bundle
+def extract(bundle, target=OUTPUT, patterns=None):
+    """Write the files of 'bundle' that match any of the glob
+    'patterns' (all files if None) below 'target', one file at a time.
+    Returns the number of files written."""
+
+    n = 0
+    with h5py.File(bundle, 'r') as h5:
+        for entry in json.loads(h5['manifest'][()]):
+            path = entry['path']
+            if patterns and not any(fnmatch.fnmatch(path, p) for p in patterns):
+                continue
+            oFile = os.path.join(target, path)
+            os.makedirs(os.path.dirname(oFile), exist_ok=True)
+            tmp = oFile + '.part'
+            dataset = h5[path]
+            if entry['kind'] == 'nifti':
+                # Header and extensions, then the data in the byte order
+                # of the header (NIfTI data are in Fortran order)
+                dtype = header(dataset).get_data_dtype()
+                with (gzip.open(tmp, 'wb') if path.endswith('.gz') else open(tmp, 'wb')) as f:
+                    f.write(dataset.attrs['prefix'].tobytes())
+                    f.write(dataset[()].astype(dtype, copy=False).tobytes(order='F'))
+            else:
+                with open(tmp, 'wb') as f:
+                    f.write(dataset[()].tobytes())
+            os.replace(tmp, oFile)
+            os.utime(oFile, (entry['mtime'], entry['mtime']))
+            n += 1
+    return n
+
+
+# * Function to check a round trip through a bundle
+def check():
+    """Pack, read and extract a synthetic subject in a temporary folder:
+    a scaled int16 image (.nii.gz), an unscaled image (.nii), an empty
+    file and a table. Raises an AssertionError if anything does not come
+    back as it was."""
+
+    with tempfile.TemporaryDirectory() as output:
+        folder = os.path.join(output, '04_ApplyWarp', 'sub-check', 'ses-1')
+        os.makedirs(folder)
+        data = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+        image = nb.Nifti1Image(data, np.diag([1.5, 1, 1, 1]))
+        image.header.set_slope_inter(0.5, 3)
+        nb.save(image, os.path.join(folder, 'scaled.nii.gz'))
+        nb.save(nb.Nifti1Image(data.astype(np.float32), np.eye(4)), os.path.join(folder, 'plain.nii'))
+        open(os.path.join(folder, 'empty.txt'), 'wb').close()
+        with open(os.path.join(folder, 'table.csv'), 'w') as f:
+            f.write('SUB,SES\ncheck,1\n')
+        original = {}
+        for name in os.listdir(folder):
+            with open(os.path.join(folder, name), 'rb') as f:
+                content = f.read()
+            original[name] = gzip.decompress(content) if name.endswith('.gz') else content
+
+        # ** Pack
+        oFile = pack('check', remove=True, output=output)
+        assert not os.path.exists(folder) and not os.path.exists(oFile + '.part')
+        kinds = {os.path.basename(e['path']): e['kind'] for e in manifest(oFile)}
+        assert kinds == {'scaled.nii.gz': 'nifti', 'plain.nii': 'nifti',
+                         'empty.txt': 'file', 'table.csv': 'file'}, kinds
+
+        # ** Read an image and part of it
+        with h5py.File(oFile, 'r') as h5:
+            scaled = volume(h5, '04_ApplyWarp/sub-check/ses-1/scaled.nii.gz')
+            assert np.allclose(scaled.get_fdata(), data * 0.5 + 3)
+            assert np.allclose(scaled.dataobj[1:3, 2, :], data[1:3, 2, :] * 0.5 + 3)
+
+        # ** Extract
+        assert extract(oFile, output) == len(original)
+        for name, content in original.items():
+            with open(os.path.join(folder, name), 'rb') as f:
+                restored = f.read()
+            restored = gzip.decompress(restored) if name.endswith('.gz') else restored
+            assert restored == content, name + ' was not restored byte for byte'
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Pack the output of a '
+        'subject (' + ', '.join(STAGES) + ') into one HDF5 file in ' + BUNDLES +
+        ', list the content of a bundle, or extract files from it into the '
+        'original layout.')
+    commands = parser.add_subparsers(dest='command')
+    # (not add_subparsers(required=True), which needs Python 3.7)
+    commands.required = True
+
+    packParser = commands.add_parser('pack', help='Pack the output of subjects')
+    packParser.add_argument('SID', nargs='+', help='Subject ID(s)')
+    packParser.add_argument('--remove', action='store_true',
+                            help='Remove the packed output folders')
+
+    listParser = commands.add_parser('list', help='List the files of a bundle')
+    listParser.add_argument('bundle', help='Bundle (.h5)')
+
+    extractParser = commands.add_parser('extract', help='Extract files from a bundle')
+    extractParser.add_argument('bundle', help='Bundle (.h5)')
+    extractParser.add_argument('--to', default=OUTPUT,
+                               help='Output folder (default: ' + OUTPUT + ')')
+    extractParser.add_argument('--include', nargs='+',
+                               help='Only extract files that match these patterns, '
+                               'e.g., "04_ApplyWarp/*.csv"')
+
+    commands.add_parser('check', help='Check a round trip (pack, read, extract) '
+                        'of a synthetic subject')
+
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        for SID in args.SID:
+            try:
+                print('Bundle written to: ' + pack(SID, args.remove))
+            except FileNotFoundError as err:
+                print(err, file=sys.stderr)
+                sys.exit(1)
+    elif args.command == 'list':
+        for entry in manifest(args.bundle):
+            print('%-6s %12d  %s' % (entry['kind'], entry['size'], entry['path']))
+    elif args.command == 'extract':
+        n = extract(args.bundle, args.to, args.include)
+        print(str(n) + ' files extracted to: ' + args.to)
+    elif args.command == 'check':
+        check()
+        print('Bundle round trip OK')
@@ -0,0 +1,18 @@
+#!/bin/bash
+
+# * Release intermediate files
+# This file is sourced by the processing scripts. Intermediate files
+# are released right after the last step that consumes them, rather
+# than at the end of a script, to keep the peak disk usage per subject
+# low. Intermediate files that are consumed by a later stage are
+# released by CVET.py once that stage has finished.
+#
+# Usage: release <file or folder> [...]
+# Nothing is deleted if intermediate files are kept (INTERMEDIATE=1).
+release() {
+
+    if [ ${INTERMEDIATE} -eq 0 ]; then
+        rm -rvf "$@"
+    fi
+
+}
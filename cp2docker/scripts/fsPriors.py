@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import sys
+import nibabel as nb
+import numpy as np
+from scipy import ndimage
+
+
+# * FreeSurfer labels (FreeSurferColorLUT.txt) of each tissue class
+# Cortex, cerebellar cortex, thalamus, caudate, putamen, pallidum,
+# hippocampus, amygdala, accumbens
+GM = [3, 42, 8, 47, 10, 49, 11, 50, 12, 51, 13, 52, 17, 53, 18, 54, 26, 58]
+# Cerebral and cerebellar WM, brain stem, ventral DC, WM
+# hypointensities, optic chiasm, corpus callosum
+WM = [2, 41, 7, 46, 16, 28, 60, 77, 78, 79, 85, 251, 252, 253, 254, 255]
+# All other voxels inside the brain mask (ventricles, CSF, choroid
+# plexus, vessels, unlabeled) are CSF.
+
+
+# * Function to create the tissue priors
+def fsPriors(aseg, mask, zooms, sigma):
+    """Return the GM, WM and CSF priors (float32 arrays) of a FreeSurfer
+    segmentation 'aseg' within the binary brain 'mask'.
+
+    Each class is smoothed with a Gaussian kernel of 'sigma' mm, so
+    that the priors guide Atropos without fixing the tissue borders of
+    FreeSurfer. Inside the mask, the priors add up to one; outside
+    they are zero.
+    """
+
+    aseg = np.rint(aseg).astype(np.int32)
+    mask = mask > 0
+    gm = np.isin(aseg, GM) & mask
+    wm = np.isin(aseg, WM) & mask
+    classes = [gm, wm, mask & ~gm & ~wm]
+
+    # ** Smooth each class
+    sigmaVoxels = [sigma / z for z in zooms[:3]]
+    priors = [ndimage.gaussian_filter(c.astype(np.float32), sigmaVoxels) for c in classes]
+
+    # ** Normalize within the mask
+    total = np.sum(priors, axis=0)
+    for prior in priors:
+        np.divide(prior, total, out=prior, where=total > 0)
+        prior[~mask] = 0
+    return priors
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Create smoothed GM, '
+        'WM and CSF priors for Atropos from a FreeSurfer segmentation (aseg) '
+        'in native space.')
+
+    parser.add_argument('aseg',
+                        help='FreeSurfer segmentation on the grid of the T1 image')
+    parser.add_argument('mask',
+                        help='Brain mask on the same grid')
+    parser.add_argument('output',
+                        help='Output file name with %%d for the class number '
+                        '(1=GM, 2=WM, 3=CSF), e.g., prior%%d.nii.gz')
+    parser.add_argument('--sigma',
+                        help='Standard deviation of the smoothing kernel (mm)',
+                        default=1.0,
+                        type=float)
+
+    args = parser.parse_args()
+
+    # * Load data
+    asegImage = nb.load(args.aseg)
+    maskImage = nb.load(args.mask)
+    if asegImage.shape[:3] != maskImage.shape[:3]:
+        print('Images ' + args.aseg + ' and ' + args.mask + ' are not on the same grid.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    # * Create and save the priors
+    priors = fsPriors(asegImage.get_fdata(dtype=np.float32),
+                      maskImage.get_fdata(dtype=np.float32),
+                      asegImage.header.get_zooms(),
+                      args.sigma)
+    for n, prior in enumerate(priors, 1):
+        header = asegImage.header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+        nb.save(nb.Nifti1Image(prior, asegImage.affine, header), args.output % n)
@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+# * Cohort cache of initial transforms
+# The registration of each subject (template) to SUIT space starts
+# from the centers of mass of both images and spends its translation,
+# rigid and affine stages finding a pose that is very similar for all
+# subjects of the same scanner protocol or site. This cache keeps,
+# per protocol, the linear (3x3) part of the affine transform to SUIT
+# space of every subject that completed. A new subject starts from
+# the average linear part, centered on the centers of mass of both
+# images, so the linear stages start close to their solution and
+# converge sooner. The cache is updated as subjects complete; a
+# subject that is processed again replaces its earlier entry.
+
+# * Libraries
+import argparse
+import fcntl
+import json
+import os
+import re
+import sys
+import nibabel as nb
+import numpy as np
+from scipy import io as sio
+from scipy import ndimage
+
+
+# * Environment
+CACHE = '/data/out/initCache'
+# Exit status of 'init' if the cache has too few subjects (any other
+# non-zero status is an error)
+TOOFEW = 3
+
+
+# * Function to get the cache file of a protocol
+def cachePath(key):
+    return os.path.join(CACHE, re.sub('[^A-Za-z0-9.-]+', '-', key) + '.json')
+
+
+# * Function to read an ITK affine transform
+def readAffine(file):
+    """Return the matrix (3x3), translation and center of an ITK affine
+    transform, from an ANTs .mat file or an ITK text file."""
+
+    if file.endswith('.mat'):
+        content = sio.loadmat(file)
+        parameters = next(v for k, v in content.items() if k.startswith('AffineTransform')).ravel()
+        center = content['fixed'].ravel()
+    else:
+        with open(file, 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        parameters = np.array(fields['Parameters'].split(), dtype=float)
+        center = np.array(fields['FixedParameters'].split(), dtype=float)
+    return parameters[:9].reshape(3, 3), parameters[9:12], center
+
+
+# * Function to write an ITK affine transform
+def writeAffine(file, matrix, translation, center):
+    with open(file, 'w') as f:
+        f.write('#Insight Transform File V1.0\n'
+                '#Transform 0\n'
+                'Transform: AffineTransform_double_3_3\n'
+                'Parameters: ' + ' '.join('%.10g' % p for p in list(matrix.ravel()) + list(translation)) + '\n'
+                'FixedParameters: ' + ' '.join('%.10g' % c for c in center) + '\n')
+
+
+# * Function to calculate the center of mass of an image
+def centerOfMass(file):
+    """Return the intensity weighted center of mass in physical LPS
+    coordinates (the coordinates of ITK transforms)."""
+
+    image = nb.load(file)
+    data = np.clip(image.get_fdata(dtype=np.float32), 0, None)
+    ras = nb.affines.apply_affine(image.affine, ndimage.center_of_mass(data))
+    return ras * np.array([-1, -1, 1])
+
+
+# * Functions to read and change the cache of a protocol
+# The cache is read and written under an exclusive lock, because
+# several CVET jobs may share the same output folder.
+def load(key):
+    try:
+        with open(cachePath(key), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'key': key, 'subjects': {}}
+
+
+def update(key, SID, transform):
+    """Add (or replace) the linear part of the affine transform of
+    subject 'SID' in the cache of 'key'."""
+
+    matrix, _, _ = readAffine(transform)
+    if not 0.2 < np.linalg.det(matrix) < 5:
+        raise ValueError('Affine transform ' + transform + ' is implausible (determinant '
+                         + str(np.linalg.det(matrix)) + '). Not added to the cache.')
+    os.makedirs(CACHE, exist_ok=True)
+    with open(cachePath(key) + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = load(key)
+        cache['subjects'][SID] = list(matrix.ravel())
+        tmp = cachePath(key) + '.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, cachePath(key))
+    return len(cache['subjects'])
+
+
+# * Function to create the initial transform of a subject
+def initialTransform(key, fixed, moving, output, minimum=3, SID=None):
+    """Write the initial transform from 'fixed' to 'moving' (ITK text
+    file) and return the number of subjects it is based on, or 0 (and
+    write nothing) if the cache of 'key' has fewer than 'minimum'
+    subjects. The subject itself ('SID') is left out of the average.
+
+    The transform has the average linear part of the cache, and maps
+    the center of mass of 'fixed' onto that of 'moving', like the
+    center of mass initializer of antsRegistration.
+    """
+
+    matrices = [m for s, m in load(key)['subjects'].items() if s != SID]
+    if len(matrices) < minimum:
+        return 0
+    matrix = np.mean(np.array(matrices), axis=0).reshape(3, 3)
+    center = centerOfMass(fixed)
+    translation = centerOfMass(moving) - center
+    writeAffine(output, matrix, translation, center)
+    return len(matrices)
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Cohort cache of the '
+        'initial transforms of the registration to SUIT space, per protocol '
+        'or site (stored in ' + CACHE + ').')
+    commands = parser.add_subparsers(dest='command')
+    # (not add_subparsers(required=True), which needs Python 3.7)
+    commands.required = True
+
+    initParser = commands.add_parser('init', help='Write the initial transform of a subject')
+    initParser.add_argument('--key', required=True, help='Protocol or site')
+    initParser.add_argument('--fixed', required=True, help='Fixed image (SUIT template)')
+    initParser.add_argument('--moving', required=True, help='Moving image (subject template)')
+    initParser.add_argument('--output', required=True, help='Initial transform (ITK text file)')
+    initParser.add_argument('--minimum', default=3, type=int,
+                            help='Minimum number of subjects in the cache')
+    initParser.add_argument('--SID', help='Subject ID (left out of the average)')
+
+    updateParser = commands.add_parser('update', help='Add the transform of a subject')
+    updateParser.add_argument('--key', required=True, help='Protocol or site')
+    updateParser.add_argument('--SID', required=True, help='Subject ID')
+    updateParser.add_argument('--transform', required=True,
+                              help='Affine transform to SUIT space (ants_0GenericAffine.mat)')
+
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        n = initialTransform(args.key, args.fixed, args.moving, args.output, args.minimum, args.SID)
+        if n == 0:
+            print('Cohort cache ' + cachePath(args.key) + ' has fewer than '
+                  + str(args.minimum) + ' subjects.')
+            sys.exit(TOOFEW)
+        print('Initial transform from the cohort cache ' + cachePath(args.key)
+              + ' (' + str(n) + ' subjects)')
+    elif args.command == 'update':
+        try:
+            n = update(args.key, args.SID, args.transform)
+        except ValueError as err:
+            print(err, file=sys.stderr)
+            sys.exit(1)
+        print('Cohort cache ' + cachePath(args.key) + ' updated (' + str(n) + ' subjects)')
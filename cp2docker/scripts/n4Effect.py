@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import sys
+import nibabel as nb
+import numpy as np
+
+
+# * Function to calculate the effect of the bias field correction
+def n4Effect(original, corrected):
+    """Return z(original) - z(corrected) as a float32 array.
+
+    Both images are z-transformed with the mean and standard deviation
+    of all their voxels (as 'fslstats -m' and '-s' do). The result is
+    computed in place, so only two image arrays are held in memory.
+    """
+
+    # ** Load data
+    a = nb.load(original).get_fdata(dtype=np.float32)
+    b = nb.load(corrected).get_fdata(dtype=np.float32)
+    if a.shape != b.shape:
+        raise ValueError('Images ' + original + ' and ' + corrected +
+                         ' are not on the same grid.')
+
+    # ** Z-transform and subtract
+    # The statistics are accumulated in float64 for precision.
+    sa = a.std(dtype=np.float64, ddof=1)
+    sb = b.std(dtype=np.float64, ddof=1)
+    a -= a.mean(dtype=np.float64)
+    a /= sa if sa > 0 else 1.0
+    b -= b.mean(dtype=np.float64)
+    b /= sb if sb > 0 else 1.0
+    a -= b
+
+    return a
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Create the quality '
+        'control image of the N4 bias field correction: the difference of '
+        'the z-transformed original and corrected T1 images.')
+
+    parser.add_argument('original',
+                        help='T1 image before the bias field correction')
+    parser.add_argument('corrected',
+                        help='T1 image after the bias field correction')
+    parser.add_argument('output',
+                        help='Output image (e.g., N4_effect.nii.gz)')
+
+    args = parser.parse_args()
+
+    # * Calculate and save
+    try:
+        effect = n4Effect(args.original, args.corrected)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    image = nb.load(args.original)
+    header = image.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    nb.save(nb.Nifti1Image(effect, image.affine, header), args.output)
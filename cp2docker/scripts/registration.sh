@@ -0,0 +1,115 @@
+#!/bin/bash
+
+# * Registration presets
+# This file is sourced by 02_MkTmplt.sh (subject -> SUIT) and
+# 03_Segment.sh (MNI -> session). It defines the multi-resolution
+# schedules of the antsRegistration calls for each registration
+# preset, and a function that runs the registration with the
+# schedule of the selected preset.
+#
+# fast:     coarser pyramids, fewer iterations, lower metric
+#           sampling rate and a smaller CC radius. Meant for pilot
+#           runs and large screening cohorts.
+# standard: the schedule CVET has always used (default).
+# accurate: the linear stages of standard, a denser metric sampling
+#           rate, an extra coarse (6x) SyN level in front of the
+#           standard pyramid (which already ends at full resolution),
+#           more SyN iterations and a tighter SyN convergence.
+#
+# Use benchmarkRegistration.py to measure the accuracy/time tradeoff
+# of the presets on your own data.
+
+
+# * Set the schedule of a preset
+# Usage: setRegistrationPreset <fast|standard|accurate>
+setRegistrationPreset() {
+
+    case ${1} in
+        fast)
+            SAMPLING=0.15                          # Mattes sampling rate
+            LINCONV=[1000x500x100,1.e-6,10]        # Linear stages: convergence
+            TRANSSHRINK=8x4x2                      # Translation: shrink factors
+            LINSHRINK=8x4x2                        # Rigid/affine: shrink factors
+            LINSMOOTH=4x2x1vox                     # Linear stages: smoothing
+            SYNCONV=[60x30,-0.01,5]                # SyN: convergence
+            SYNSHRINK=4x2                          # SyN: shrink factors
+            SYNSMOOTH=1x0.5vox                     # SyN: smoothing
+            CCRADIUS=2                             # SyN: CC radius
+            ;;
+        standard)
+            SAMPLING=0.3
+            LINCONV=[10000x111110x11110,1.e-8,20]
+            TRANSSHRINK=6x4x2
+            LINSHRINK=3x2x1
+            LINSMOOTH=4x2x1vox
+            SYNCONV=[100x100x50,-0.01,5]
+            SYNSHRINK=4x2x1
+            SYNSMOOTH=1x0.5x0vox
+            CCRADIUS=4
+            ;;
+        accurate)
+            SAMPLING=0.5
+            LINCONV=[10000x111110x11110,1.e-8,20]
+            TRANSSHRINK=6x4x2
+            LINSHRINK=3x2x1
+            LINSMOOTH=4x2x1vox
+            SYNCONV=[100x100x70x20,1.e-7,10]
+            SYNSHRINK=6x4x2x1
+            SYNSMOOTH=3x2x1x0vox
+            CCRADIUS=4
+            ;;
+        *)
+            echo "Unknown registration preset: ${1}"
+            exit 1
+            ;;
+    esac
+
+    REGPRESET=${1}
+
+}
+
+
+# * Run the registration
+# Usage: runRegistration <fixed> <moving> <initial transform> <output>
+# The initial transform and output are passed on to antsRegistration's
+# '-r' and '-o' options.
+runRegistration() {
+
+    local T=${1}
+    local M=${2}
+
+    echo "Registration preset: ${REGPRESET}"
+
+    antsRegistration \
+        -d 3 \
+        --winsorize-image-intensities [0.005,0.995] \
+        -r ${3} \
+        -m mattes[ "${T}" , "${M}" , 1 , 32, regular, ${SAMPLING} ] \
+        -t translation[ 0.1 ] \
+        -c ${LINCONV} \
+        -s ${LINSMOOTH} \
+        -f ${TRANSSHRINK} -l 1 \
+        -m mattes[ "${T}" , "${M}" , 1 , 32, regular, ${SAMPLING} ] \
+        -t rigid[ 0.1 ] \
+        -c ${LINCONV} \
+        -s ${LINSMOOTH} \
+        -f ${LINSHRINK} -l 1 \
+        -m mattes[ "${T}" , "${M}" , 1 , 32, regular, ${SAMPLING} ] \
+        -t affine[ 0.1 ] \
+        -c ${LINCONV} \
+        -s ${LINSMOOTH} \
+        -f ${LINSHRINK} -l 1 \
+        -m mattes[ "${T}" , "${M}" , 0.5 , 32 ] \
+        -m cc[ "${T}" , "${M}" , 0.5 , ${CCRADIUS} ] \
+        -t SyN[ .20, 3, 0 ] \
+        -c ${SYNCONV} \
+        -s ${SYNSMOOTH} \
+        -f ${SYNSHRINK} -l 1 -u 1 -z 1 \
+        -o ${4} \
+        -v 1
+
+}
+
+
+# * Default preset
+setRegistrationPreset standard
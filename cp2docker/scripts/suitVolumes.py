@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import sys
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from assets import loadIndex
+from volumes import indexVolumes
+
+
+# * Function to calculate the lobule volumes in SUIT space
+def suitVolumes(atlas, gmFile, jacobianFile):
+    """Return the GM volume (in mm3, native space) of each label of
+    'atlas' (a SUIT space atlas, see assets.LABELS).
+
+    'gmFile' is the GM map warped to SUIT space (not modulated) and
+    'jacobianFile' the Jacobian determinant of the full transformation
+    from SUIT to native space (affine and non-linear parts), both on
+    the grid of the atlas. The native volume of a voxel is its SUIT
+    volume times the Jacobian, so the sum of GM times Jacobian over the
+    voxels of a label is the native GM volume of that label.
+    """
+
+    # ** Label index
+    indices, voxels, offsets, shape = loadIndex(atlas)
+
+    # ** Images
+    gmImage = nb.load(gmFile)
+    if gmImage.shape[:3] != shape:
+        raise ValueError('GM map ' + gmFile + ' is not on the grid of the atlas ' + atlas + '.')
+    gm = np.asanyarray(gmImage.dataobj)
+    jacobian = np.asanyarray(nb.load(jacobianFile).dataobj)
+    voxelVolume = float(np.prod(gmImage.header.get_zooms()[:3]))
+
+    return indexVolumes(voxels, offsets, gm, voxelVolume, jacobian)
+
+
+# * Function to compare the SUIT space volumes with the native ones
+def validation(native, suit):
+    """Return a table with the native and SUIT space volume of each
+    lobule and their (relative) difference. 'native' is a volume table
+    of 04_ApplyWarp.sh (cGM.csv) and 'suit' the SUIT space volumes in
+    the order of its lobules."""
+
+    lobules = native.columns[2:2 + len(suit)]
+    table = pd.DataFrame({'LOBULE': lobules,
+                          'NATIVE': native.loc[0, lobules].astype(float).to_numpy(),
+                          'SUIT': suit})
+    table['DIFF'] = table['SUIT'] - table['NATIVE']
+    table['RELDIFF'] = table['DIFF'] / table['NATIVE'].where(table['NATIVE'] > 0)
+    total = table[['NATIVE', 'SUIT', 'DIFF']].sum()
+    table.loc[len(table)] = ['Total', total['NATIVE'], total['SUIT'], total['DIFF'],
+                             total['DIFF'] / total['NATIVE'] if total['NATIVE'] > 0 else np.nan]
+    return table
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Calculate lobule '
+        'volumes in SUIT space as Jacobian weighted sums of the warped GM '
+        'map over the voxels of each lobule. Prints the volumes separated '
+        'by commas.')
+
+    parser.add_argument('--atlas',
+                        help='Atlas in SUIT space',
+                        default='/software/SUIT-templates/Cerebellum-SUIT.nii.gz')
+    parser.add_argument('--gm',
+                        help='GM map in SUIT space (wcgm.nii.gz)',
+                        required=True)
+    parser.add_argument('--jacobian',
+                        help='Jacobian determinant of the transformation from SUIT '
+                        'to native space',
+                        required=True)
+    parser.add_argument('--native',
+                        help='Volume table of the native space extraction to '
+                        'compare with (cGM.csv)')
+    parser.add_argument('--validation',
+                        help='Output table of the comparison with "--native"')
+
+    args = parser.parse_args()
+
+    # * Calculate
+    try:
+        volumes = suitVolumes(args.atlas, args.gm, args.jacobian)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+
+    # * Compare with the native space volumes
+    if args.native and args.validation:
+        table = validation(pd.read_csv(args.native, dtype={'SUB': str, 'SES': str}), volumes)
+        table.to_csv(args.validation, index=False, float_format='%0.5f')
+        print('Total: native %0.1f, SUIT %0.1f mm3 (%+0.2f%%)'
+              % (table['NATIVE'].iloc[-1], table['SUIT'].iloc[-1], 100 * table['RELDIFF'].iloc[-1]),
+              file=sys.stderr)
+
+    print(','.join('%0.5f' % v for v in volumes))
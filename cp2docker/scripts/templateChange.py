@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+# * Libraries
+import argparse
+import sys
+import nibabel as nb
+import numpy as np
+
+
+# * Function to measure the change between two templates
+def templateChange(previous, current):
+    """Return (1 - NCC, relative mean absolute difference) of two images.
+
+    Both images must be on the same grid, which is the case for
+    successive iterations of antsMultivariateTemplateConstruction2.sh.
+    """
+
+    # ** Load data
+    a = nb.load(previous).get_fdata(dtype=np.float32).ravel()
+    b = nb.load(current).get_fdata(dtype=np.float32).ravel()
+    if a.shape != b.shape:
+        raise ValueError('Templates ' + previous + ' and ' + current +
+                         ' are not on the same grid.')
+
+    # ** Normalized cross correlation
+    a0 = a - a.mean()
+    b0 = b - b.mean()
+    denominator = np.sqrt(np.dot(a0, a0) * np.dot(b0, b0))
+    ncc = np.dot(a0, b0) / denominator if denominator > 0 else 1.0
+
+    # ** Mean absolute intensity change relative to the mean intensity
+    # Only voxels inside either template are taken into account.
+    inside = (a != 0) | (b != 0)
+    scale = np.abs(b[inside]).mean() if inside.any() else 0.0
+    mad = np.abs(a[inside] - b[inside]).mean() / scale if scale > 0 else 0.0
+
+    return 1.0 - ncc, mad
+
+
+# * Input arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Cerebellar Volume Extraction Tool. Measure the change '
+        'between two successive subject templates. Prints "1-NCC,MAD", '
+        'where MAD is the mean absolute intensity change relative to the '
+        'mean template intensity.')
+
+    parser.add_argument('previous',
+                        help='Template of the previous iteration')
+    parser.add_argument('current',
+                        help='Template of the current iteration')
+
+    args = parser.parse_args()
+
+    # * Measure and print
+    try:
+        dncc, mad = templateChange(args.previous, args.current)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    print(f'{dncc:.8f},{mad:.8f}')
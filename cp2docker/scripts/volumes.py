@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+
+# * Cerebellar volume extraction helpers
+# Volumes are computed the same way as in 04_ApplyWarp.sh:
+# the GM volume of a region is the sum of the GM probabilities
+# of its voxels multiplied by the voxel volume.
+
+# * Libraries
+import numpy as np
+
+
+# * Function to read a label table
+def readLabels(labelFile):
+    """Read a label table with one 'index name' pair per line.
+
+    Fields may be separated by white space or commas, and lines
+    starting with '#' are ignored. Returns a list of (index, name)
+    tuples in the order of the file.
+    """
+
+    labels = []
+    with open(labelFile, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.replace(',', ' ').split()
+            labels.append((int(fields[0]), fields[1]))
+    return labels
+
+
+# * Function to calculate the volume per label
+def labelVolumes(atlas, gm, voxelVolume, indices):
+    """Return the GM volume (in mm3) of each label in 'indices'.
+
+    'atlas' is an integer label image and 'gm' the GM probability map
+    on the same grid. All labels are summed in a single pass over the
+    GM map.
+    """
+
+    atlas = np.asarray(atlas).ravel()
+    gm = np.asarray(gm, dtype=np.float64).ravel()
+    inside = atlas > 0
+    sums = np.bincount(atlas[inside].astype(np.int64),
+                       weights=gm[inside],
+                       minlength=max(indices) + 1)
+    return [sums[i] * voxelVolume for i in indices]
+
+
+# * Function to index the voxels of each label
+def labelIndex(atlas, indices):
+    """Return the flat voxel indices of the labels in 'indices', grouped
+    by label, and the offsets of the groups: the voxels of label
+    indices[n] are voxels[offsets[n]:offsets[n + 1]].
+
+    The index only depends on the atlas, so for an atlas in template
+    space it is computed once and used for all sessions (see
+    indexVolumes).
+    """
+
+    atlas = np.asarray(atlas).ravel()
+    lookup = np.full(max(int(atlas.max()), max(indices)) + 1, -1, dtype=np.int64)
+    lookup[list(indices)] = np.arange(len(indices))
+    inside = np.flatnonzero(lookup[np.clip(atlas, 0, None).astype(np.int64)] >= 0)
+    position = lookup[atlas[inside].astype(np.int64)]
+    order = np.argsort(position, kind='stable')
+    voxels = inside[order].astype(np.int32 if atlas.size < 2**31 else np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(position, minlength=len(indices)))])
+    return voxels, offsets
+
+
+# * Function to calculate the volume per label from a label index
+def indexVolumes(voxels, offsets, gm, voxelVolume, weights=None):
+    """Return the GM volume (in mm3) of each label of a label index
+    (see labelIndex).
+
+    Only the voxels of the labels are read from 'gm' (and from
+    'weights', e.g., a Jacobian determinant map, by which the GM
+    values are multiplied), so no other image is resampled or masked.
+    """
+
+    values = np.asarray(gm).ravel()[voxels].astype(np.float64)
+    if weights is not None:
+        values *= np.asarray(weights).ravel()[voxels]
+    sums = np.concatenate([[0.0], np.cumsum(values)])
+    return list((sums[offsets[1:]] - sums[offsets[:-1]]) * voxelVolume)